@@ -0,0 +1,41 @@
+"""
+Compares dispatching through formatted event names with pre-resolved event handles.
+
+Run from the repository root:
+
+    python -m benchmarks.events
+"""
+from core.events import Events
+import timeit
+
+iterations = 200000
+
+def relay_cell(circuit_id, stream_id, c):
+    pass
+
+def main():
+    events = Events()
+    circuit_id, stream_id = 2882343476, 4242
+
+    events.register('%d_%d_got_relay_%s' % (circuit_id, stream_id, 'RELAY_DATA'),
+        relay_cell)
+    events.register((circuit_id, stream_id, 'RELAY_DATA'), relay_cell)
+    handle = events.handle((circuit_id, stream_id, 'RELAY_DATA'))
+
+    def string_event():
+        events.trigger('%d_%d_got_relay_%s' % (circuit_id, stream_id, 'RELAY_DATA'),
+            circuit_id, stream_id, None)
+
+    def tuple_event():
+        events.trigger((circuit_id, stream_id, 'RELAY_DATA'), circuit_id, stream_id, None)
+
+    def handle_event():
+        handle(circuit_id, stream_id, None)
+
+    for name, function in [ ('string', string_event), ('tuple', tuple_event),
+                            ('handle', handle_event) ]:
+        elapsed = min(timeit.repeat(function, number=iterations, repeat=5))
+        print('%-8s %8.1f ns/event' % (name, elapsed / iterations * 1e9))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+Compares sending relay cells through a 3 hop circuit one at a time with sending them
+as a batch through Circuit.send_relay_cells().
+
+Run from the repository root:
+
+    python -m benchmarks.relay_crypto
+"""
+from core.LocalModule import LocalModule
+from modules.Tor.Circuit import Circuit
+from modules.Tor import crypto
+import os
+import timeit
+
+cells = 1000
+
+def circuit():
+    """
+    A built 3 hop circuit with random keys that throws its cells away.
+    """
+    proxy = LocalModule()
+    proxy.register_local('send_cell', lambda c, data=None: None)
+    proxy.register_local('send_cells', lambda circuit_id, body, count: None)
+
+    c = Circuit.__new__(Circuit)
+    LocalModule.__init__(c)
+    c._events = proxy._events
+
+    c.circuit_id = 1
+    c.window = c.package_window = 1 << 30
+    c.circuit = [ crypto.Hop({ 'name': str(i) }, os.urandom(20), os.urandom(20),
+        os.urandom(16), os.urandom(16)) for i in range(3) ]
+    c.sent_cells = 0
+    c.sendme_sent = []
+    c.recent_bytes = 0.0
+    c.recent_update = 0.0
+    c.send_cell_event = c.handle_local('send_cell')
+    c.send_cells_event = c.handle_local('send_cells')
+    return c
+
+def main():
+    c = circuit()
+    payloads = [ os.urandom(498) for _ in range(cells) ]
+
+    def per_cell():
+        for payload in payloads:
+            c.send_relay_cell('RELAY_DATA', 1, payload)
+
+    def batched():
+        c.send_relay_cells('RELAY_DATA', 1, payloads)
+
+    for name, function in [ ('per cell', per_cell), ('batched', batched) ]:
+        elapsed = min(timeit.repeat(function, number=1, repeat=5))
+        print('%-8s %8.2f us/cell, %7.1f MB/s' % (name, elapsed / cells * 1e6,
+            cells * 498 / elapsed / 1e6))
+
+if __name__ == '__main__':
+    main()
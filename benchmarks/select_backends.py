@@ -0,0 +1,58 @@
+"""
+Measures the cost of one loop wakeup for each polling backend as the number of idle
+connections registered with it grows.
+
+Run from the repository root:
+
+    python -m benchmarks.select_backends
+"""
+from modules.Select import backends, get_backend
+import select
+import socket
+import timeit
+
+iterations = 2000
+idle_counts = [ 10, 100, 1000, 5000 ]
+
+def wakeup(backend, writer, reader):
+    """
+    One loop iteration with a single active connection: make it readable, poll, read.
+    """
+    writer.send(b'x')
+    for fno, mask in backend.poll(None):
+        if fno == reader.fileno():
+            reader.recv(1)
+
+def main():
+    print('%-10s %s' % ('backend', ''.join('%10d' % n for n in idle_counts)))
+
+    for name, available, _ in backends:
+        if not available():
+            continue
+
+        row = []
+        for count in idle_counts:
+            # select() can't handle fds above FD_SETSIZE.
+            if name == 'select' and count * 2 >= 1000:
+                row.append('%10s' % '-')
+                continue
+
+            backend = get_backend(name)
+            idle = [ socket.socketpair() for _ in range(count) ]
+            for a, b in idle:
+                backend.register(a.fileno(), select.POLLIN)
+
+            writer, reader = socket.socketpair()
+            backend.register(reader.fileno(), select.POLLIN)
+
+            elapsed = min(timeit.repeat(lambda: wakeup(backend, writer, reader),
+                number=iterations, repeat=3))
+            row.append('%8.1fus' % (elapsed / iterations * 1e6))
+
+            for sock in [ writer, reader ] + [ s for pair in idle for s in pair ]:
+                sock.close()
+
+        print('%-10s %s' % (name, ''.join(row)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+class BufferPool(object):
+    """
+    Preallocated receive buffers shared by the sockets on the select loop. Sockets read
+    into a buffer with recv_into() and hand it back once the data has been handled, so
+    a busy connection doesn't allocate a fresh 64 KiB object for every read.
+
+    The loop is single threaded, so a buffer is only ever taken out for the length of
+    one readable callback. More than one is needed when a callback ends up reading
+    from another socket.
+    """
+
+    # Size of each buffer, in bytes.
+    buffer_size = 65536
+
+    # Most spare buffers kept around.
+    max_buffers = 8
+
+    def __init__(self):
+        self.buffers = []
+
+    def acquire(self):
+        """
+        Get a buffer, a spare one if there is one.
+        """
+        if self.buffers:
+            return self.buffers.pop()
+        return bytearray(self.buffer_size)
+
+    def release(self, buf):
+        """
+        Hand a buffer back, views into it must not be used anymore.
+        """
+        if len(self.buffers) < self.max_buffers:
+            self.buffers.append(buf)
+
+# Buffers shared by every socket on the loop.
+buffer_pool = BufferPool()
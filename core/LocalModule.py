@@ -37,6 +37,18 @@ class LocalModule(Module):
         """
         self._events.unregister(event, function)
 
+    def handle_local(self, event):
+        """
+        Get a handle for a local event that can be fired directly.
+        """
+        return self._events.handle(event)
+
+    def release_local(self, handle):
+        """
+        Release a handle for a local event.
+        """
+        self._events.release(handle)
+
     def trigger_local(self, event, *args, **kwargs):
         """
         Trigger a local event.
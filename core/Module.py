@@ -109,6 +109,18 @@ class Module(object):
         """
         self.events.unregister(event, function)
 
+    def handle(self, event):
+        """
+        Get a handle for a global event that can be fired directly.
+        """
+        return self.events.handle(event)
+
+    def release(self, handle):
+        """
+        Release a handle for a global event.
+        """
+        self.events.release(handle)
+
     def trigger(self, event, *args, **kwargs):
         """
         Trigger a global event.
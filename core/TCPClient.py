@@ -1,5 +1,8 @@
 from core.Module import Module
 from core.LocalModule import LocalModule
+from core.BufferPool import buffer_pool
+from collections import deque
+from itertools import islice
 import socket
 import errno
 import logging
@@ -10,6 +13,25 @@ class TCPClient(LocalModule):
     """
     Base async TCP class. Networked plugins should probably inherit from this module.
     """
+
+    # Seconds to wait for a connection before giving up.
+    connect_timeout = 30
+
+    # Whether queued buffers are written with a single sendmsg() call, rather than
+    # being joined up first.
+    scatter_gather = hasattr(socket.socket, 'sendmsg')
+
+    # Most queued buffers written in one go.
+    max_iov = 256
+
+    # Bytes queued to send before whoever is sending is asked to pause, and the level
+    # the queue has to drain back down to before they're told to resume.
+    high_water = 256 * 1024
+    low_water = 64 * 1024
+
+    # Most reads done for one readable event before going back to the loop.
+    max_reads = 4
+
     def __init__(self, host, port):
         """
         Local events registered:
@@ -23,7 +45,12 @@ class TCPClient(LocalModule):
         self.port = port
 
         self.reads = []
-        self.write_buffer = b''
+        self.write_buffer = deque()
+        self.write_offset = 0
+        self.write_size = 0
+        self.paused = False
+        self.writing = False
+        self.timer = None
 
         self.register_local('send', self.send)
         self.register_local('close', self.die)
@@ -31,20 +58,60 @@ class TCPClient(LocalModule):
 
     def readable(self, client):
         """
-        Callback for the readable socket. Receives 65535 bytes and will either pass it
-        along or detect that the socket is closed.
+        Callback for the readable socket. Reads into a buffer from the buffer pool and
+        will either pass the data along or detect that the socket is closed. The socket
+        is read until it would block, up to max_reads times, so a busy socket doesn't
+        take a trip round the loop for every read. Data the socket has buffered itself,
+        see pending(), is always read.
+
+        The data is handed on as a memoryview into the buffer, which is reused once this
+        returns. Anything that keeps the data around has to copy it.
+
+        Returns true if max_reads ran out before the socket would block, so there may be
+        more waiting. Edge-triggered select backends use this to keep reading until the
+        socket would block.
 
         Local events raised:
             * closed          - indicates that the socket has been closed.
             * received <data> - indicates that data was received.
         """
-        data = self.sock.recv(65535)
-        if not data:
-            self.closed = True
-            self.trigger_local('closed')
-            self.die()
-
-        self.trigger_local('received', data)
+        buf = buffer_pool.acquire()
+        reads = 0
+
+        try:
+            while True:
+                try:
+                    num_bytes = self.sock.recv_into(buf)
+                except socket.error as e:
+                    if e.args[0] in [ errno.EAGAIN, errno.EWOULDBLOCK ]:
+                        return False
+                    raise
+
+                if not num_bytes:
+                    self.closed = True
+                    self.trigger_local('closed')
+                    self.die()
+
+                    self.trigger_local('received', memoryview(b''))
+                    return False
+
+                self.trigger_local('received', memoryview(buf)[:num_bytes])
+
+                if self.closed:
+                    return False
+
+                reads += 1
+                if reads >= self.max_reads and not self.pending():
+                    return True
+        finally:
+            buffer_pool.release(buf)
+
+    def pending(self):
+        """
+        Returns the number of bytes already read from the socket and buffered on our
+        side, which the select loop won't report as readable.
+        """
+        return 0
 
     def writable(self, client):
         """
@@ -52,27 +119,115 @@ class TCPClient(LocalModule):
         the socket is now connected. If we are already connected we try to send everything
         in our send buffer. If the send buffer is empty then we mark the socket unwritable.
 
+        Returns true if there is still data queued and the socket didn't say it would
+        block, so it may take more. Edge-triggered select backends use this to keep
+        writing until the socket would block, as they won't report it writable again
+        before then.
+
         Events raised:
             * fd_unwritable <sock> - indicates that the socket no longer needs to write.
             * fd_readable <sock>   - indicates that we want to read from the socket,
                                      raised when we connect.
 
         Local events raised:
-            * connected - indicates that the socket has successfully connected.
+            * connected      - indicates that the socket has successfully connected.
+            * flush          - the socket is about to be written to, anything waiting
+                               to go out can still be sent now and go out with it.
+            * resume_writing - the send buffer has drained below low_water, sending can
+                               carry on.
+            * drained        - the send buffer has been written out, more data can be
+                               sent now without it queueing up.
         """
         if self.connecting:
             self.connecting = False
+            self.stop_timer()
 
+            self.writing = False
             self.trigger('fd_unwritable', self.sock)
             self.trigger('fd_readable', self.sock)
             self.trigger_local('connected')
         else:
-            num_bytes = self.sock.send(self.write_buffer)
-            self.write_buffer = self.write_buffer[num_bytes:]
+            self.trigger_local('flush')
+
+            try:
+                num_bytes = self.write_out()
+            except socket.error as e:
+                if e.args[0] not in [ errno.EAGAIN, errno.EWOULDBLOCK ]:
+                    raise
+                return False
+
+            # Nothing went out, give up on what's queued.
+            if not num_bytes:
+                self.clear_buffer()
+
+            if self.paused and self.write_size <= self.low_water:
+                self.paused = False
+                self.trigger_local('resume_writing')
 
-            if not self.write_buffer or not num_bytes:
-                self.write_buffer = b''
+            if not self.write_buffer:
+                self.trigger_local('drained')
+
+            # drained may have queued more.
+            if not self.write_buffer:
+                self.writing = False
                 self.trigger('fd_unwritable', self.sock)
+                return False
+
+            return not self.closed
+
+    def clear_buffer(self):
+        """
+        Drops everything queued to send.
+        """
+        self.write_buffer.clear()
+        self.write_offset = 0
+        self.write_size = 0
+
+    def write_out(self):
+        """
+        Writes as much of the send buffer as the socket takes and returns the number of
+        bytes written. The buffer is a queue of memoryviews and write_offset is how far
+        into the first one has been written already, so nothing is copied to drop the
+        part that went out.
+
+        Without scatter_gather the first few buffers are joined into one, which stays at
+        the front of the queue until it has been written.
+        """
+        buffers = self.write_buffer
+
+        # send() asks for write interest even when it is given nothing to queue.
+        if not buffers:
+            return 0
+
+        if self.scatter_gather:
+            iov = list(islice(buffers, self.max_iov))
+            iov[0] = iov[0][self.write_offset:]
+            num_bytes = self.sock.sendmsg(iov)
+        else:
+            if len(buffers) > 1:
+                data = bytearray(buffers.popleft()[self.write_offset:])
+                for _ in range(min(len(buffers), self.max_iov - 1)):
+                    data += buffers.popleft()
+
+                buffers.appendleft(memoryview(data))
+                self.write_offset = 0
+
+            num_bytes = self.sock.send(buffers[0][self.write_offset:])
+
+        self.write_size -= num_bytes
+
+        left = num_bytes
+        while left:
+            size = len(buffers[0]) - self.write_offset
+            if left < size:
+                self.write_offset += left
+                break
+
+            buffers.popleft()
+            self.write_offset = 0
+            left -= size
+
+        return num_bytes
 
     def exceptional(self, client):
         """
@@ -82,13 +237,71 @@ class TCPClient(LocalModule):
 
     def send(self, data):
         """
-        Call back for the local send event. Adds the data to the write_buffer.
+        Call back for the local send event. Adds the data to the write_buffer, it is
+        queued as is so it shouldn't be changed afterwards. Nothing is written until the
+        socket is writable, so everything sent before then goes out together.
+
+        Events triggered:
+            * fd_writable <sock> - indicates that we want to write on the socket, only
+                                   raised if we didn't already.
+
+        Local events raised:
+            * pause_writing - more than high_water bytes are queued, stop sending until
+                              resume_writing.
+        """
+        if data:
+            self.write_buffer.append(memoryview(data))
+            self.write_size += len(data)
+
+            if self.write_size > self.high_water and not self.paused:
+                self.paused = True
+                self.trigger_local('pause_writing')
+
+        self.want_write()
+
+    def want_write(self):
+        """
+        Asks to be told when the socket is writable, unless we already have. Subclasses
+        that keep their own queue call this and hand the data over on flush.
 
         Events triggered:
             * fd_writable <sock> - indicates that we want to write on the socket.
         """
-        self.write_buffer += data
-        self.trigger('fd_writable', self.sock)
+        if not self.writing:
+            self.writing = True
+            self.trigger('fd_writable', self.sock)
+
+    def start_timer(self, delay):
+        """
+        Starts, or restarts, the socket timeout. If it runs out before stop_timer() is
+        called the socket is closed.
+
+        Events raised:
+            * call_later <delay> <callback> - schedule the timeout.
+        """
+        self.stop_timer()
+        self.timer = self.trigger('call_later', delay, self.timed_out)
+
+    def stop_timer(self):
+        """
+        Cancels the socket timeout.
+        """
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+    def timed_out(self):
+        """
+        The socket timed out, close it.
+
+        Local events raised:
+            * timeout - indicates that the socket timed out.
+        """
+        self.timer = None
+        log.error('connection to %s:%d timed out.' % (self.host, self.port))
+
+        self.trigger_local('timeout')
+        self.die()
 
     def init(self):
         """
@@ -99,16 +312,14 @@ class TCPClient(LocalModule):
             * fd_writable <sock>    - indicates that the socket is writable.
             * fd_exceptional <sock> - indicates that we want to know when the socket is
                                       exceptional.
+            * fd_register <sock> <readable> <writable> <exceptional>
+                                    - adds the socket to the select loop's dispatch
+                                      table so its events come straight to us.
 
         Local events raised:
             * setup - indicates that the socket is about to connect and any setup should
                       be done here.
             * init - indicates that we've just initialized the socket.
-
-        Events registered:
-            * fd_<sock>_readable <sock>    - raised when the socket is readable.
-            * fd_<sock>_writable <sock>    - raised when the socket is writable.
-            * fd_<sock>_exceptional <sock> - raised when the socket is exceptional.
         """
         self.die()
 
@@ -125,11 +336,12 @@ class TCPClient(LocalModule):
             return
 
         self.connecting = True
+        self.start_timer(self.connect_timeout)
 
-        self.register('fd_%s_readable' % self.sock, self.readable)
-        self.register('fd_%s_writable' % self.sock, self.writable)
-        self.register('fd_%s_exceptional' % self.sock, self.exceptional)
+        self.trigger('fd_register', self.sock, self.readable, self.writable,
+            self.exceptional)
 
+        self.writing = True
         self.trigger('fd_writable', self.sock)
         self.trigger('fd_exceptional', self.sock)
 
@@ -145,27 +357,25 @@ class TCPClient(LocalModule):
             * fd_unwritable <sock>    - indicates that we don't want to write to the socket.
             * fd_unexceptional <sock> - indicates that we don't want to know when the socket
                                         is exceptional.
+            * fd_unregister <sock>    - removes the socket from the dispatch table.
 
         Local events raised:
             * die - indicates that the socket was just closed.
-
-        Events unregistered:
-            * fd_<sock>_readable <sock>    - raised when the socket is readable.
-            * fd_<sock>_writable <sock>    - raised when the socket is writable.
-            * fd_<sock>_exceptional <sock> - raised when the socket is exceptional.
         """
         if not hasattr(self, 'sock') or not self.sock:
             return
         
         self.closed = True
+        self.writing = False
+        self.paused = False
+        self.clear_buffer()
+        self.stop_timer()
 
         self.trigger('fd_unreadable', self.sock)
         self.trigger('fd_unwritable', self.sock)
         self.trigger('fd_unexceptional', self.sock)
 
-        self.unregister('fd_%s_readable' % self.sock, self.readable)
-        self.unregister('fd_%s_writable' % self.sock, self.writable)
-        self.unregister('fd_%s_exceptional' % self.sock, self.exceptional)
+        self.trigger('fd_unregister', self.sock)
 
         self.sock = None
         self.connecting = False
@@ -23,6 +23,7 @@ class TCPLineClient(TCPClient):
         """
         Parses a chunk. If in line-mode we will forward all complete lines and store the
         last line until we have a complete line. In chunked mode we just pass it along.
+        The data is a view into a reused buffer, so it is copied first.
 
         Local events raised:
             * chunk <data> - raised when we receive a chunk.
@@ -30,6 +31,8 @@ class TCPLineClient(TCPClient):
             * line_closed  - raised when the socket is closed and we have read
                              all data.
         """
+        data = data.tobytes()
+
         if self.chunked:
             self.trigger_local('chunk', self.data + data)
             self.data = ''
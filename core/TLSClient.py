@@ -10,6 +10,12 @@ class TLSClient(TCPClient):
     Variation of the TCPClient that supports TLS.
     """
 
+    # Seconds to wait for the TLS handshake to complete before giving up.
+    handshake_timeout = 30
+
+    # TLS sockets don't do sendmsg().
+    scatter_gather = False
+
     def __init__(self, host, port):
         """
         Local events registered:
@@ -36,7 +42,7 @@ class TLSClient(TCPClient):
             return
 
         try:
-            super(TLSClient, self).readable(client)
+            return super(TLSClient, self).readable(client)
         except ssl.SSLError as err:
             if err.args[0] != ssl.SSL_ERROR_WANT_READ:
                 self.die()
@@ -45,6 +51,13 @@ class TLSClient(TCPClient):
             log.error('socket error: %s' % e)
             self.die()
 
+    def pending(self):
+        """
+        Returns the number of decrypted bytes the TLS socket holds, they are left over
+        from a record that didn't fit in the last read.
+        """
+        return self.sock.pending()
+
     def do_ssl(self):
         """
         Setup the TLS socket context and wraps the socket.
@@ -59,15 +72,20 @@ class TLSClient(TCPClient):
 
     def do_handshake(self):
         """
-        Does the TLS handshake on a fresh connection.
+        Does the TLS handshake on a fresh connection. The handshake timeout starts
+        with the first attempt.
         
         Local events raised:
             * handshook - indicates that the TLS handshake has completed and the socket
                           is ready for use.
         """
+        if not self.timer:
+            self.start_timer(self.handshake_timeout)
+
         try:
             self.sock.do_handshake()
             self.handshook = True
+            self.stop_timer()
             self.trigger_local('handshook')
         except ssl.SSLError as err:
             if err.args[0] != ssl.SSL_ERROR_WANT_READ:
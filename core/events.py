@@ -3,14 +3,114 @@ import traceback
 import logging
 log = logging.getLogger(__name__)
 
+class EventHandle(object):
+    """
+    Pre-resolved reference to a single event. Modules that fire an event on a hot path
+    can look the handle up once and call fire() on it directly, skipping the name
+    formatting and dictionary lookup done by Events.trigger().
+
+    A handle stays bound to its event for as long as it is held, callbacks registered
+    or unregistered by name afterwards are seen by the handle.
+    """
+    __slots__ = ('owner', 'name', 'functions', 'once', 'refs')
+
+    def __init__(self, owner, name):
+        self.owner = owner
+        self.name = name
+        self.functions = []
+        self.once = []
+        self.refs = 0
+
+    def __repr__(self):
+        return '<EventHandle %r: %d callbacks>' % (self.name, len(self.functions))
+
+    def fire(self, *args, **kwargs):
+        """
+        Raises the event. Behaves the same as Events.trigger() but without logging.
+        """
+        ret = None
+
+        if not self.once:
+            for function in self.functions:
+                ret = function(*args, **kwargs)
+                if ret:
+                    break
+            return ret
+
+        to_be_deleted = []
+
+        for function in self.functions:
+            if function in self.once:
+                to_be_deleted.append(function)
+
+            ret = function(*args, **kwargs)
+            if ret:
+                break
+
+        for function in to_be_deleted:
+            if function in self.functions:
+                self.functions.remove(function)
+            if function in self.once:
+                self.once.remove(function)
+
+        self.owner.discard(self)
+
+        return ret
+
+    # Calling the handle fires it, without going through another call.
+    __call__ = fire
+
 class Events(object):
     """
     Event handler that allows registering and triggering events.
+
+    Event names can be any hashable object. Most events are strings, but tuples are
+    handy for events keyed on ids (circuit ids, stream ids, file descriptors) since
+    they don't need to be formatted into a string every time they are raised.
     """
     def __init__(self):
         self.events  = {}
         self.pending = {}
-        self.self_destruct = {}
+
+    def handle(self, event):
+        """
+        Returns the EventHandle for an event, creating it if necessary. The handle is
+        kept alive until it is released with release().
+        """
+        handle = self.events.get(event)
+
+        if handle is None:
+            handle = self.events[event] = EventHandle(self, event)
+
+        handle.refs += 1
+        return handle
+
+    def release(self, handle):
+        """
+        Releases a handle retrieved with handle(). Once no one holds the handle and it
+        has no callbacks it is dropped.
+        """
+        if handle.refs > 0:
+            handle.refs -= 1
+
+        self.discard(handle)
+
+    def discard(self, handle):
+        """
+        Drops a handle that isn't held and has no callbacks.
+        """
+        if handle.refs or handle.functions:
+            return
+
+        if self.events.get(handle.name) is handle:
+            del self.events[handle.name]
+
+    def registered(self, event):
+        """
+        Returns true if there are any callbacks registered for the event.
+        """
+        handle = self.events.get(event)
+        return handle is not None and bool(handle.functions)
 
     def register(self, event, function, append=True):
         """
@@ -20,16 +120,21 @@ class Events(object):
         If the append argument is false, the event will be placed
         at the beginning of the list.
         """
-        if event not in self.events:
-            self.events[event] = []
+        handle = self.events.get(event)
+
+        if handle is None:
+            handle = self.events[event] = EventHandle(self, event)
 
-        log.debug("registering '%s' in %s" % (event, self.do_trace()))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("registering '%s' in %s" % (event, self.do_trace()))
 
-        if function not in self.events[event]:
+        if function not in handle.functions:
             if append:
-                self.events[event].append(function)
+                handle.functions.append(function)
             else:
-                self.events[event] = [ function ] + self.events[event]
+                # A new list, so a trigger that is running can't see the callbacks shift
+                # under it.
+                handle.functions = [ function ] + handle.functions
 
         if event in self.pending:
             for pending in self.pending[event]:
@@ -49,30 +154,35 @@ class Events(object):
         unregistered.
         """
         self.register(event, function)
-
-        if event not in self.self_destruct:
-            self.self_destruct[event] = []
-
-        self.self_destruct[event].append(function)
+        self.events[event].once.append(function)
 
     def unregister(self, event, function):
         """
         Unregisters a callback function from an event.
         """
-        if event not in self.events:
+        handle = self.events.get(event)
+
+        if handle is None:
             return
 
-        if function in self.events[event]:
-            self.events[event].remove(function)
+        if function in handle.functions:
+            handle.functions.remove(function)
 
-        if not self.events[event]:
-            del self.events[event]
+        if function in handle.once:
+            handle.once.remove(function)
+
+        self.discard(handle)
 
     def unregister_all(self):
         """
-        Resets the event object.
+        Resets the event object. Handles that are still held are emptied but remain
+        bound to their events.
         """
-        self.events  = {}
+        for handle in list(self.events.values()):
+            del handle.functions[:]
+            del handle.once[:]
+            self.discard(handle)
+
         self.pending = {}
 
     def trigger_avail(self, event, *args, **kwargs):
@@ -81,7 +191,7 @@ class Events(object):
         the function gets added to the list of pending events and triggers
         once the event is registered.
         """
-        if event not in self.events:
+        if not self.registered(event):
             if event in self.pending:
                 self.pending[event].append([ args, kwargs ])
             else:
@@ -93,29 +203,15 @@ class Events(object):
         """
         Raises an event. If the event does not exist it will do nothing.
         """
-        log.debug("raising '%s' in %s" % (event, self.do_trace()))
-
-        if event not in self.events:
-            return
-
-        to_be_deleted = []
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("raising '%s' in %s" % (event, self.do_trace()))
 
-        for function in self.events[event]:
-            if event in self.self_destruct and function in self.self_destruct[event]:
-                to_be_deleted.append(function)
+        handle = self.events.get(event)
 
-            ret = function(*args, **kwargs)
-            if ret:
-               break
-
-        for function in to_be_deleted:
-            self.events[event].remove(function)
-            self.self_destruct[event].remove(function)
-
-            if not self.self_destruct[event]:
-                del self.self_destruct[event]
+        if handle is None:
+            return
 
-        return ret
+        return handle.fire(*args, **kwargs)
 
     def do_trace(self):
         """
@@ -123,7 +219,7 @@ class Events(object):
         """
 
         # Trace is expensive so only do it when we need it
-        if log.level > logging.DEBUG:
+        if not log.isEnabledFor(logging.DEBUG):
             return ''
 
         trace = traceback.extract_stack()[::-1]
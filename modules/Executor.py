@@ -0,0 +1,60 @@
+from core.Module import Module
+
+try:
+    from concurrent import futures
+except ImportError:
+    futures = None
+
+import logging
+log = logging.getLogger(__name__)
+
+class Executor(Module):
+    """
+    Runs CPU heavy functions in a worker pool and hands the result back to the select
+    loop.
+    """
+    dependencies = [ 'Select' ]
+
+    # Either 'thread' or 'process'. A process pool sidesteps the GIL but only takes
+    # functions and arguments that can be pickled.
+    mode = 'thread'
+    workers = 4
+
+    def module_load(self):
+        """
+        Events registered:
+            * run_in_executor <function> <callback> [args] - run function(*args) in the
+                                                             pool, callback(future) is
+                                                             called on the loop once it
+                                                             is done.
+        """
+        self.pool = None
+
+        if not futures:
+            log.warning('concurrent.futures is not available, work will not be '
+                'offloaded.')
+            return
+
+        if self.mode == 'process':
+            self.pool = futures.ProcessPoolExecutor(self.workers)
+        else:
+            self.pool = futures.ThreadPoolExecutor(self.workers)
+
+        self.register('run_in_executor', self.run)
+
+    def module_unload(self):
+        if self.pool:
+            self.pool.shutdown(wait=False)
+
+    def run(self, function, callback, *args):
+        """
+        Submit a function to the pool. Returns the future.
+
+        Events raised (from the worker):
+            * call_soon_threadsafe <callback> <future> - passes the finished future back
+                                                         to the loop.
+        """
+        future = self.pool.submit(function, *args)
+        future.add_done_callback(lambda f: self.trigger('call_soon_threadsafe',
+            callback, f))
+        return future
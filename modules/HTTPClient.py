@@ -7,6 +7,11 @@ except ImportError:
     import urllib.parse as urlparse
 import re
 
+try:
+    from time import monotonic as now
+except ImportError:
+    from time import time as now
+
 import logging
 log = logging.getLogger(__name__)
 
@@ -19,20 +24,35 @@ class HTTPRequest(TorLineClient):
     Tor-based HTTP client.
     """
 
+    # Seconds without any data received before the request is abandoned.
+    timeout = 60
+
+    # Bytes of the request body sent at a time.
+    body_chunk = 16 * 1024
+
     def __init__(self, url, directory=False, data=None, headers=None, method='GET'):
         """
         Local events registered:
-            * connected     - the socket has connected.
-            * line <line>   - indicates that a line has been received.
-            * chunk <chunk> - indicates that a chunk has been received.
-            * line_closed   - indicates that the socket has closed and all data has
-                              been read.
+            * connected      - the socket has connected.
+            * line <line>    - indicates that a line has been received.
+            * chunk <chunk>  - indicates that a chunk has been received.
+            * line_closed    - indicates that the socket has closed and all data has
+                               been read.
+            * closed         - the socket has closed, stops the timeout.
+            * received       - data has been received, puts the timeout off.
+            * resume_writing - the stream can take more of the request body.
         """
         self.method = method
         self.headers = headers or {}
         self.data = data
 
+        # TorLineClient keeps its line buffer in data, so the body is kept apart.
+        self.body = data
+        self.body_offset = 0
+
         self.res = {}
+        self.timer = None
+        self.last_received = None
 
         self.response_headers = {}
         self.response_status = 0
@@ -46,6 +66,9 @@ class HTTPRequest(TorLineClient):
         self.register_local('line', self.parse)
         self.register_local('chunk', self.parse_chunk)
         self.register_local('line_closed', self.tcp_closed)
+        self.register_local('closed', self.stop_timeout)
+        self.register_local('received', self.received)
+        self.register_local('resume_writing', self.send_body)
 
     def tcp_closed(self):
         """
@@ -54,8 +77,18 @@ class HTTPRequest(TorLineClient):
         Local events raised:
             * done - indicates that the HTTP request has completed.
         """
+        self.stop_timeout()
         self.trigger_local('done')
 
+    def stop_timeout(self):
+        """
+        Cancels the request timeout. The socket can close with a partial line still
+        buffered, in which case line_closed never comes, so this also runs on closed.
+        """
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
     def module_load(self):
         """
         On module load begin connecting.
@@ -63,8 +96,45 @@ class HTTPRequest(TorLineClient):
         Local events raised:
             * connect - begin the connection.
         """
+        self.last_received = now()
+        self.start_timeout(self.timeout)
         self.trigger_local('connect')
 
+    def received(self, data):
+        """
+        Notes when data was last received. The timer isn't touched, see timed_out().
+        """
+        self.last_received = now()
+
+    def start_timeout(self, delay):
+        """
+        Schedules the request timeout.
+
+        Events raised:
+            * call_later <delay> <callback> - schedule the timeout.
+        """
+        if self.closed:
+            return
+
+        self.timer = self.trigger('call_later', delay, self.timed_out)
+
+    def timed_out(self):
+        """
+        The timeout ran out. If data was received since it was scheduled it is
+        scheduled again for what is left of the timeout, so a busy request costs one
+        timer per timeout rather than one per read. Otherwise nothing was received for
+        too long, give up on the request and end its stream.
+        """
+        self.timer = None
+
+        idle = now() - self.last_received
+        if idle < self.timeout:
+            self.start_timeout(self.timeout - idle)
+            return
+
+        log.error('http request to %s timed out.' % self.url.geturl())
+        self.close()
+
     def connected(self):
         """
         Excecuted once the socket is connected. Will send the HTTP request.
@@ -74,6 +144,20 @@ class HTTPRequest(TorLineClient):
         """
         self.trigger_local('send', self.build_http())
         self.chunked = False
+        self.send_body()
+
+    def send_body(self):
+        """
+        Sends the request body, if any, body_chunk bytes at a time for as long as the
+        socket is writable. The rest is sent on resume_writing.
+
+        Local events raised:
+            * send <data> - sends data on the socket.
+        """
+        while self.body and self.writable and self.body_offset < len(self.body):
+            chunk = self.body[self.body_offset:self.body_offset + self.body_chunk]
+            self.body_offset += len(chunk)
+            self.trigger_local('send', chunk)
 
     def parse(self, line):
         """
@@ -89,6 +173,8 @@ class HTTPRequest(TorLineClient):
             * die               - closes the HTTP request.
 
         """
+        if self.closed:
+            return
 
         # If we haven't gotten the status yet, we try to parse that. If the status line
         # doesn't parse we close the connection.
@@ -141,6 +227,9 @@ class HTTPRequest(TorLineClient):
             * data <chunk> - HTTP body data ready.
             * die          - close the connection.
         """
+        if self.closed:
+            return
+
         self.res['num_bytes'] += len(chunk)
 
         self.trigger_local('data', chunk)
@@ -190,6 +279,9 @@ class HTTPRequest(TorLineClient):
         if 'User-Agent' not in self.headers:
             self.headers['User-Agent'] = ''
 
+        if self.body and 'Content-Length' not in self.headers:
+            self.headers['Content-Length'] = len(self.body)
+
         for header in self.headers:
             request += '{header}: {value}\r\n'.format(header=header,
                 value=self.headers[header])
@@ -1,5 +1,13 @@
 from core.Module import Module
+from array import array
+from collections import deque
+import errno
+import heapq
+import itertools
+import math
+import os
 import select
+import socket
 import logging
 log = logging.getLogger(__name__)
 
@@ -8,60 +16,404 @@ if not hasattr(select, 'poll'):
     select.POLLOUT = 4
     select.POLLPRI = 2
 
+try:
+    import selectors
+except ImportError:
+    selectors = None
+
+# Only needed for the Waker's pipe, which isn't used where there is eventfd.
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    from time import monotonic as now
+except ImportError:
+    from time import time as now
+
+# Polling backend used by the Select module, see backends below. 'auto' picks the best
+# one available on this platform.
+backend = 'auto'
+
 class SelectPoll(object):
+    """
+    poll() lookalike built on select.select() for platforms without poll.
+    """
+    edge_triggered = False
+
     def __init__(self):
         self.fds = {}
+        self.events = {
+            select.POLLIN: set(),
+            select.POLLOUT: set(),
+            select.POLLPRI: set()
+        }
 
-    def poll(self):
-        r, w, x = select.select(self.readable(), self.writable(), self.exceptional())
+    def poll(self, timeout=None):
+        r, w, x = select.select(self.events[select.POLLIN], self.events[select.POLLOUT],
+            self.events[select.POLLPRI], timeout)
 
-        events = {} 
+        events = {}
         self.collate_events(r, select.POLLIN, events)
         self.collate_events(w, select.POLLOUT, events)
         self.collate_events(x, select.POLLPRI, events)
 
-        final_events = []
-        for fd in events:
-            mask = 0
+        return list(events.items())
+
+    def register(self, fd, events):
+        self.fds[fd] = events
+
+        for event in self.events:
+            if events & event:
+                self.events[event].add(fd)
+            else:
+                self.events[event].discard(fd)
+
+    def unregister(self, fd):
+        if fd in self.fds:
+            del self.fds[fd]
+
+        for event in self.events:
+            self.events[event].discard(fd)
+
+    def collate_events(self, fds, event, events):
+        for fd in fds:
+            events[fd] = events.get(fd, 0) | event
+
+class PollPoll(object):
+    """
+    Backend using select.poll().
+    """
+    edge_triggered = False
 
-            for event in events[fd]:
-                mask |= event
+    def __init__(self):
+        self._poll = select.poll()
 
-            final_events.append([ fd, mask ])
+    def poll(self, timeout=None):
+        # Round up, a timer due in under a millisecond would otherwise spin the loop
+        # with zero timeouts until it is.
+        if timeout is not None:
+            timeout = int(math.ceil(timeout * 1000))
 
-        return final_events
+        return self._poll.poll(timeout)
 
     def register(self, fd, events):
-        self.fds[fd] = events
+        self._poll.register(fd, events)
 
     def unregister(self, fd):
+        self._poll.unregister(fd)
+
+class EpollPoll(object):
+    """
+    Backend using select.epoll(), either level-triggered or edge-triggered. In
+    edge-triggered mode readable callbacks must keep reading until the socket would
+    block, see Select.booted().
+    """
+    def __init__(self, edge_triggered=False):
+        self._poll = select.epoll()
+        self.fds = {}
+        self.edge_triggered = edge_triggered
+        self.flags = select.EPOLLET if edge_triggered else 0
+
+    def poll(self, timeout=None):
+        if timeout is None:
+            timeout = -1
+
+        try:
+            return self._poll.poll(timeout)
+        except (IOError, OSError) as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+    def register(self, fd, events):
+        # poll(), select() and epoll() share the bit values for IN, PRI and OUT.
+        mask = events | self.flags
+
         if fd in self.fds:
-            del self.fds[fd]
+            self._poll.modify(fd, mask)
+        else:
+            self._poll.register(fd, mask)
+
+        self.fds[fd] = events
 
-    def readable(self):
-        return self.select_event(select.POLLIN)
+    def unregister(self, fd):
+        if fd not in self.fds:
+            return
 
-    def writable(self):
-        return self.select_event(select.POLLOUT)
+        del self.fds[fd]
 
-    def exceptional(self):
-        return self.select_event(select.POLLPRI)
+        try:
+            self._poll.unregister(fd)
+        except (IOError, OSError, ValueError):
+            pass
 
-    def collate_events(self, fds, event, events):
-        for fd in fds:
-            if fd in events:
-                events[fd].append(event)
+class SelectorsPoll(object):
+    """
+    Backend using the selectors module's default selector. selectors only knows about
+    read and write readiness, so exceptional conditions are never reported.
+    """
+    edge_triggered = False
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+
+    def poll(self, timeout=None):
+        events = []
+
+        for key, mask in self.selector.select(timeout):
+            events.append((key.fd, (select.POLLIN if mask & selectors.EVENT_READ else 0) |
+                (select.POLLOUT if mask & selectors.EVENT_WRITE else 0)))
+
+        return events
+
+    def register(self, fd, events):
+        mask = (selectors.EVENT_READ if events & select.POLLIN else 0) | \
+            (selectors.EVENT_WRITE if events & select.POLLOUT else 0)
+
+        if fd in self.selector.get_map():
+            if not mask:
+                self.selector.unregister(fd)
+            else:
+                self.selector.modify(fd, mask)
+        elif mask:
+            self.selector.register(fd, mask)
+
+    def unregister(self, fd):
+        if fd in self.selector.get_map():
+            self.selector.unregister(fd)
+
+# Available polling backends, by preference.
+backends = [
+    ('epoll', lambda: hasattr(select, 'epoll'), EpollPoll),
+    ('epoll_et', lambda: hasattr(select, 'epoll'), lambda: EpollPoll(edge_triggered=True)),
+    ('poll', lambda: hasattr(select, 'poll'), PollPoll),
+    ('selectors', lambda: selectors is not None, SelectorsPoll),
+    ('select', lambda: True, SelectPoll)
+]
+
+def get_backend(name='auto'):
+    """
+    Create a polling backend by name. 'auto' returns the first one that is available.
+    """
+    for backend_name, available, backend_class in backends:
+        if name not in [ 'auto', backend_name ]:
+            continue
+
+        if not available():
+            if name == 'auto':
+                continue
+            raise ValueError('polling backend %s is not available.' % name)
+
+        # epoll_et is opt-in, it changes what readable callbacks have to do.
+        if name == 'auto' and backend_name == 'epoll_et':
+            continue
+
+        return backend_class()
+
+    raise ValueError('unknown polling backend: %s' % name)
+
+class Timer(object):
+    """
+    A callback scheduled on the select loop, returned by the call_later and call_at
+    events.
+    """
+    __slots__ = ('when', 'callback', 'args', 'kwargs', 'cancelled', 'scheduler')
+
+    def __init__(self, when, callback, args, kwargs, scheduler):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.cancelled = False
+        self.scheduler = scheduler
+
+    def cancel(self):
+        """
+        Cancel the timer. Cancelled timers are skipped when they come due, so this is
+        O(1).
+        """
+        if self.cancelled:
+            return
+
+        self.cancelled = True
+
+        # The scheduler is cleared once the timer has left the heap.
+        if self.scheduler:
+            self.scheduler.timer_cancelled()
+
+    def run(self):
+        self.callback(*self.args, **self.kwargs)
+
+class Scheduler(object):
+    """
+    Heap of pending timers. Arming a timer is O(log n) and cancelling is O(1), with
+    cancelled timers purged from the heap once they make up half of it.
+    """
+    def __init__(self):
+        self.timers = []
+        self.cancelled = 0
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.timers) - self.cancelled
+
+    def call_at(self, when, callback, *args, **kwargs):
+        timer = Timer(when, callback, args, kwargs, self)
+        heapq.heappush(self.timers, (when, next(self.counter), timer))
+        return timer
+
+    def call_later(self, delay, callback, *args, **kwargs):
+        return self.call_at(now() + delay, callback, *args, **kwargs)
+
+    def timer_cancelled(self):
+        self.cancelled += 1
+
+        if self.cancelled > 64 and self.cancelled * 2 > len(self.timers):
+            timers = []
+            for t in self.timers:
+                if t[2].cancelled:
+                    t[2].scheduler = None
+                else:
+                    timers.append(t)
+
+            heapq.heapify(timers)
+            self.timers = timers
+            self.cancelled = 0
+
+    def timeout(self):
+        """
+        Seconds until the next timer is due, or None if there aren't any.
+        """
+        while self.timers and self.timers[0][2].cancelled:
+            heapq.heappop(self.timers)[2].scheduler = None
+            self.cancelled -= 1
+
+        if not self.timers:
+            return None
+
+        return max(0, self.timers[0][0] - now())
+
+    def run(self):
+        """
+        Run every timer that is due. Timers scheduled by the callbacks run on a later
+        pass, even if they are already due.
+        """
+        due = []
+        end = now()
+
+        while self.timers and self.timers[0][0] <= end:
+            timer = heapq.heappop(self.timers)[2]
+            timer.scheduler = None
+
+            if timer.cancelled:
+                self.cancelled -= 1
             else:
-                events[fd] = [ event ]
+                due.append(timer)
 
-    def select_event(self, event):
-        selected = []
+        for timer in due:
+            # A callback can cancel a timer that is due in the same pass.
+            if timer.cancelled:
+                continue
 
-        for fd in self.fds:
-            if self.fds[fd] & event:
-                selected.append(fd)
+            timer.cancelled = True
+            try:
+                timer.run()
+            except Exception:
+                log.exception('timer callback %r failed.' % timer.callback)
+
+class Waker(object):
+    """
+    Lets other threads hand callbacks to the select loop. post() queues a callback and
+    wakes up poll() through an eventfd, or a pipe where eventfd isn't available. Without
+    fcntl (ie. on Windows, where select() only takes sockets) a socket pair is used
+    instead. The callbacks are run from readable() in the loop's thread.
+    """
+    def __init__(self):
+        self.callbacks = deque()
+        self.woken = False
+        self.socks = None
+
+        if hasattr(os, 'eventfd'):
+            self.rfd = self.wfd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+        elif fcntl is None:
+            self.socks = socket.socketpair()
+            for sock in self.socks:
+                sock.setblocking(False)
+
+            self.rfd, self.wfd = [ sock.fileno() for sock in self.socks ]
+        else:
+            self.rfd, self.wfd = os.pipe()
+
+            for fd in [ self.rfd, self.wfd ]:
+                flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+                fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+                flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+                fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+    def fileno(self):
+        return self.rfd
+
+    def post(self, callback, *args, **kwargs):
+        """
+        Queue a callback to run on the loop. Safe to call from any thread.
+        """
+        self.callbacks.append((callback, args, kwargs))
+
+        # Only one wakeup is needed until the loop gets around to draining the queue.
+        if self.woken:
+            return
+
+        self.woken = True
+        try:
+            if self.rfd == self.wfd:
+                os.eventfd_write(self.wfd, 1)
+            elif self.socks:
+                self.socks[1].send(b'\x00')
+            else:
+                os.write(self.wfd, b'\x00')
+        except (IOError, OSError) as e:
+            if e.args[0] not in [ errno.EAGAIN, errno.EWOULDBLOCK ]:
+                raise
 
-        return selected
+    def readable(self, fd):
+        """
+        Clears the wakeup and runs the queued callbacks.
+        """
+        try:
+            if self.socks:
+                while self.socks[0].recv(4096):
+                    pass
+
+            while not self.socks and os.read(self.rfd, 4096) and self.rfd != self.wfd:
+                pass
+        except (IOError, OSError) as e:
+            if e.args[0] not in [ errno.EAGAIN, errno.EWOULDBLOCK ]:
+                raise
+
+        # Clear the flag before running anything so that callbacks posted from now on
+        # wake us up again.
+        self.woken = False
+
+        while self.callbacks:
+            callback, args, kwargs = self.callbacks.popleft()
+
+            try:
+                callback(*args, **kwargs)
+            except Exception:
+                log.exception('posted callback %r failed.' % callback)
+
+    def close(self):
+        if self.socks:
+            for sock in self.socks:
+                sock.close()
+            return
+
+        os.close(self.rfd)
+        if self.wfd != self.rfd:
+            os.close(self.wfd)
 
 class Select(Module):
     def module_load(self):
@@ -69,59 +421,175 @@ class Select(Module):
             Events registered:
                 booted                    - run on boot by start() in daemon.py
                 quit                      - end the select loop
+                fd_register <object> <readable> <writable> <exceptional>
+                                          - dispatch events for an fd straight to the
+                                            given callbacks
+                fd_unregister <object>    - remove an fd from the dispatch table
                 fd_readable <object>      - register an fd as readable
                 fd_unreadable <object>    - un-register fd from read list
                 fd_writable <object>      - register an fd as writable
                 fd_unwritable <object>    - un-register fd from write list
                 fd_exceptional <object>   - register an fd as exceptional
                 fd_unexceptional <object> - un-register fd from exception list
+                call_later <delay> <callback> [args]
+                                          - call the callback after delay seconds,
+                                            returns a Timer
+                call_at <when> <callback> [args]
+                                          - call the callback at a time on the loop's
+                                            monotonic clock, returns a Timer
+                call_soon_threadsafe <callback> [args]
+                                          - run the callback on the loop, can be raised
+                                            from any thread
         """
         self.running = True
 
         self.register('booted', self.booted)
         self.register('quit', self.quit)
+        self.register('fd_register', self.fd_register)
+        self.register('fd_unregister', self.fd_unregister)
         self.register('fd_readable', self.fd_readable)
         self.register('fd_unreadable', self.fd_unreadable)
         self.register('fd_writable', self.fd_writable)
         self.register('fd_unwritable', self.fd_unwritable)
         self.register('fd_exceptional', self.fd_exceptional)
         self.register('fd_unexceptional', self.fd_unexceptional)
+        self.register('call_later', self.call_later)
+        self.register('call_at', self.call_at)
+        self.register('call_soon_threadsafe', self.call_soon_threadsafe)
 
         self.fds = {}
-
-        if hasattr(select, 'poll'):
-            self.poll = select.poll()
-        else:
-            self.poll = SelectPoll()
+        self.wanted = array('H')
+        self.registered = array('H')
+        self.dropped = array('H')
+        self.changed = []
+        self.scheduler = Scheduler()
+        self.dispatch = {}
+
+        self.poll = get_backend(backend)
+        self.ready = []
+        log.info('using %s polling backend (edge-triggered: %s).' %
+            (self.poll.__class__.__name__, self.poll.edge_triggered))
+
+        self.waker = Waker()
+        self.fd_register(self.waker, self.waker.readable, None, None)
+        self.fd_readable(self.waker)
+
+    def module_unload(self):
+        """
+        Closes the waker.
+        """
+        self.fd_unreadable(self.waker)
+        self.fd_unregister(self.waker)
+        self.waker.close()
 
     def booted(self):
         """
-        Main I/O loop of the application.
+        Main I/O loop of the application. File descriptors in the dispatch table have
+        their callbacks called directly, anything else gets the fd events below. The
+        poll timeout is taken from the next timer due, and due timers are run after
+        the I/O callbacks.
+
+        With an edge-triggered backend a readable callback that returns true is taken
+        to mean that there may be more to read, and it is called again on the next
+        iteration until it returns false (ie. the socket would block). Writable
+        callbacks work the same way, returning true while there is more to write.
+
+        Changes to the fds' events are handed to the backend just before polling, see
+        init_fd().
         
         Events raised:
             * fd_<object>_readable <object>    - fd is readable.
             * fd_<object>_writable <object>    - fd is writable.
             * fd_<object>_exceptional <object> - fd is exceptional.
         """
+        scheduler = self.scheduler
+
         while self.running:
-            events = self.poll.poll()
+            if self.changed:
+                self.apply_changes()
+
+            timeout = 0 if self.ready else scheduler.timeout()
+            events = self.poll.poll(timeout)
+
+            if self.ready:
+                # Only the events the fds still want, they may have dropped some since.
+                wanted = self.wanted
+                events = list(events) + [ (fno, mask & wanted[fno])
+                    for fno, mask in self.ready if fno < len(wanted) ]
+                self.ready = []
 
-            event_strings = {
-                select.POLLIN: 'fd_%s_readable',
-                select.POLLOUT: 'fd_%s_writable',
-                select.POLLPRI: 'fd_%s_exceptional'
-            }
+            if events:
+                self.process(events)
 
-            if not events:
+            if scheduler.timers:
+                scheduler.run()
+
+    def process(self, events):
+        """
+        Calls the callbacks for the fds in a poll result.
+        """
+        dispatch = self.dispatch
+        edge_triggered = self.poll.edge_triggered
+
+        for fno, mask in events:
+            client = dispatch.get(fno)
+
+            if client is None:
+                self.dispatch_events(fno, mask)
                 continue
 
-            for event in events:
-                fd = self.fds[event[0]]['fd']
-                for e in event_strings:
-                    if not e & event[1]:
-                        continue
+            fd, readable, writable, exceptional = client
+
+            # A callback can close the fd, so make sure it is still ours before
+            # calling the next one.
+            again = 0
+            if mask & select.POLLIN:
+                if readable(fd):
+                    again |= select.POLLIN
+            if mask & select.POLLOUT and dispatch.get(fno) is client:
+                if writable(fd):
+                    again |= select.POLLOUT
+            if mask & select.POLLPRI and dispatch.get(fno) is client:
+                exceptional(fd)
 
-                    self.trigger(event_strings[e] % fd, fd)
+            if again and edge_triggered and dispatch.get(fno) is client:
+                self.ready.append((fno, again))
+
+    def dispatch_events(self, fno, mask):
+        """
+        Raises the fd events for an fd that isn't in the dispatch table.
+        """
+        # fds that have just lost all their events are only forgotten before the next
+        # poll.
+        if fno not in self.fds or not self.wanted[fno]:
+            return
+
+        fd = self.fds[fno]['fd']
+        handles = self.fds[fno]['handles']
+
+        if not handles:
+            # Resolve the event handles once per fd so that the loop doesn't have to
+            # format the event names on every poll result.
+            handles = self.fds[fno]['handles'] = [
+                self.handle('fd_%s_readable' % fd),
+                self.handle('fd_%s_writable' % fd),
+                self.handle('fd_%s_exceptional' % fd)
+            ]
+
+        readable, writable, exceptional = handles
+
+        again = 0
+        if mask & select.POLLIN:
+            if readable(fd):
+                again |= select.POLLIN
+        if mask & select.POLLOUT:
+            if writable(fd):
+                again |= select.POLLOUT
+        if mask & select.POLLPRI:
+            exceptional(fd)
+
+        if again and self.poll.edge_triggered:
+            self.ready.append((fno, again))
 
     def quit(self):
         """
@@ -129,9 +597,51 @@ class Select(Module):
         """
         self.running = False
 
+    def call_later(self, delay, callback, *args, **kwargs):
+        """
+        Schedules a callback to run after delay seconds. Returns the Timer, which can
+        be cancelled.
+        """
+        return self.scheduler.call_later(delay, callback, *args, **kwargs)
+
+    def call_at(self, when, callback, *args, **kwargs):
+        """
+        Schedules a callback to run at the given time on the loop's clock (see now()).
+        Returns the Timer, which can be cancelled.
+        """
+        return self.scheduler.call_at(when, callback, *args, **kwargs)
+
+    def call_soon_threadsafe(self, callback, *args, **kwargs):
+        """
+        Runs a callback on the loop as soon as possible. Unlike every other event this
+        one may be raised from another thread, it wakes up the loop if it is waiting
+        in poll().
+        """
+        self.waker.post(callback, *args, **kwargs)
+
+    def fd_register(self, fd, readable, writable, exceptional):
+        """
+        Adds an fd to the dispatch table. Poll results for the fd will call the
+        callbacks with the fd directly instead of going through the event handler.
+        """
+        self.dispatch[fd.fileno()] = (fd, readable, writable, exceptional)
+
+    def fd_unregister(self, fd):
+        """
+        Removes an fd from the dispatch table.
+        """
+        fno = fd.fileno()
+
+        if fno in self.dispatch and self.dispatch[fno][0] is fd:
+            del self.dispatch[fno]
+
     def init_fd(self, fd, event, add=True):
         """
-        Manages the poll file descriptor events.
+        Manages the poll file descriptor events. The events wanted for each fd are
+        kept in events, indexed by fd, and the backend is only told about them by
+        apply_changes() before the next poll. An fd whose events change back within
+        the same iteration never reaches the backend at all, unless the backend is
+        edge-triggered and an event was dropped and wanted again, see apply_changes().
         """
         fno = fd.fileno()
 
@@ -139,19 +649,62 @@ class Select(Module):
             if not add:
                 return
 
-            self.fds[fno] = {}
-            self.fds[fno] = { 'fd': fd, 'events': 0 }
+            self.fds[fno] = { 'fd': fd, 'handles': None }
 
-        if add:
-            self.fds[fno]['events'] |= event
-        elif self.fds[fno]['events'] & event:
-            self.fds[fno]['events'] ^= event
+            if fno >= len(self.wanted):
+                grow = max(fno + 1, len(self.wanted) * 2) - len(self.wanted)
+                self.wanted.extend([ 0 ] * grow)
+                self.registered.extend([ 0 ] * grow)
+                self.dropped.extend([ 0 ] * grow)
+
+        events = self.wanted[fno]
 
-        if self.fds[fno]['events'] == 0:
-            del self.fds[fno]
-            self.poll.unregister(fno)
+        if add:
+            self.wanted[fno] = events | event
         else:
-            self.poll.register(fno, self.fds[fno]['events'])
+            self.wanted[fno] = events & ~event
+            self.dropped[fno] |= events & event
+
+        # Only the first change since the backend was last updated needs noting.
+        if self.wanted[fno] != events and events == self.registered[fno]:
+            self.changed.append(fno)
+
+    def apply_changes(self):
+        """
+        Hands the fd event changes made since the last poll to the backend. fds left
+        without any events are unregistered and forgotten, the fd object is kept until
+        then so that its number can't be reused in the meantime.
+
+        An edge-triggered backend only reports an fd again once it has become ready
+        anew. If an event was dropped and wanted again since the last poll, say write
+        interest after a drained buffer got more data queued, the fd is registered
+        again even though its events are unchanged, so that the backend reports it
+        if it is already ready.
+        """
+        rearm = self.poll.edge_triggered
+
+        for fno in self.changed:
+            events = self.wanted[fno]
+            dropped = self.dropped[fno]
+            self.dropped[fno] = 0
+
+            if not events and fno in self.fds:
+                for handle in self.fds[fno]['handles'] or []:
+                    self.release(handle)
+
+                del self.fds[fno]
+
+            if events == self.registered[fno] and not (rearm and dropped & events):
+                continue
+
+            self.registered[fno] = events
+
+            if events:
+                self.poll.register(fno, events)
+            else:
+                self.poll.unregister(fno)
+
+        del self.changed[:]
 
     def fd_readable(self, fd):
         """
@@ -1,14 +1,26 @@
 from core.LocalModule import LocalModule
+from modules.Tor.build_times import circuit_build_times
 import modules.Tor.crypto as crypto
 from modules.Tor.TorStream import TorStream
 from modules.Tor.cell import cell
+from modules.Tor.cell.cell import to_bytes
 
+from collections import deque
 import socket
 import struct
 import random
+import math
 import logging
 log = logging.getLogger(__name__)
 
+try:
+    from time import monotonic as now
+except ImportError:
+    from time import time as now
+
+relay_data = cell.relay_name_to_command('RELAY_DATA')
+relay_extend2 = cell.relay_name_to_command('RELAY_EXTEND2')
+
 circuit = [
     {
         'name': 'SoulOfTheInternet',
@@ -38,14 +50,35 @@ class Circuit(LocalModule):
     Tor circuit.
     """
 
+    # Run the ntor key agreement for CREATED2/EXTENDED2 in the Executor's worker pool
+    # instead of on the select loop.
+    offload_handshakes = False
+
+    # Use CREATE_FAST for the first hop, skipping the public key work. The TLS link to
+    # the guard is all that keeps the first hop's keys secret.
+    create_fast = False
+
+    # Circuit level flow control windows, in RELAY_DATA cells. Each SENDME opens the
+    # window by increment cells.
+    window = 1000
+    window_increment = 100
+
+    # Weight of each new sample in the round trip time average.
+    rtt_weight = 0.25
+
+    # Seconds over which the throughput average decays.
+    throughput_window = 10.0
+
     def __init__(self, proxy, circuit_id=None):
         """
         Local events registered:
-            * <circuit_id>_got_cell_Created2 <circuit_id> <cell>     - Created2 cell
+            * (<circuit_id>, Created2) <circuit_id> <cell>           - Created2 cell
+                                                                       received in circuit.
+            * (<circuit_id>, CreatedFast) <circuit_id> <cell>        - CreatedFast cell
+                                                                       received in circuit.
+            * (<circuit_id>, Relay) <circuit_id> <cells>             - run of Relay cells
                                                                        received in circuit.
-            * <circuit_id>_got_cell_Relay <circuit_id> <cell>        - Relay cell received
-                                                                       in circuit.
-            * <circuit_id>_0_got_relay_EXTENDED2 <circuit_id> <cell> - EXTENDED2 cell
+            * (<circuit_id>, 0, RELAY_EXTENDED2) <circuit_id> <cell> - EXTENDED2 cell
                                                                        received in circuit.
             * <circuit_id>_do_ntor_handshake <node>                  - Do an ntor handshake
                                                                        with a node. Extends
@@ -53,27 +86,64 @@ class Circuit(LocalModule):
                                                                        circuit.
             * <circuit_id>_send_relay_cell <cell>                    - send a relay cell
                                                                        upstream.
+            * (<circuit_id>, send_relay_cells) <relay> <stream_id> <payloads>
+                                                                     - send a batch of
+                                                                       relay cells
+                                                                       upstream.
+            * (<circuit_id>, 0, RELAY_SENDME) <circuit_id> <cell>    - circuit level
+                                                                       SENDME received.
+            * <circuit_id>_destroy                                   - tear the circuit
+                                                                       down.
+
+        Events raised:
+            * call_later <delay> <callback> - schedule the build timeout.
         """
         super(Circuit, self).__init__()
         self._events = proxy._events
 
-        self.counter = 0
+        self.package_window = self.window
+        self.deliver_window = self.window
         self.circuit_id = circuit_id or random.randint(1<<31, 1<<32)
         self.established = False
         self.streams = {}
         self.pending_ntors = []
         self.pending_ntor = None
         self.circuit = []
-
-        self.register_local('%d_got_cell_Created2' % self.circuit_id, self.crypt_init_ntor)
-        self.register_local('%d_got_cell_Relay' % self.circuit_id, self.recv_relay_cell)
-        self.register_local('%d_%d_got_relay_RELAY_EXTENDED2' % (self.circuit_id, 0),
-            self.crypt_init_ntor)
-        self.register_local('%d_do_ntor_handshake' % self.circuit_id, self.do_ntor)
-        self.register_local('%d_send_relay_cell' % self.circuit_id, self.send_relay_cell)
+        self.started = now()
+        self.hop_started = None
+
+        self.rtt = None
+        self.sendme_sent = deque()
+        self.sent_cells = 0
+        self.recent_bytes = 0.0
+        self.recent_update = now()
+
+        self.handlers = [
+            ((self.circuit_id, 'Created2'), self.crypt_init_ntor),
+            ((self.circuit_id, 'CreatedFast'), self.crypt_init_fast),
+            ((self.circuit_id, 'Relay'), self.recv_relay_cells),
+            ((self.circuit_id, 0, 'RELAY_EXTENDED2'), self.crypt_init_ntor),
+            ('%d_do_ntor_handshake' % self.circuit_id, self.do_ntor),
+            ('%d_send_relay_cell' % self.circuit_id, self.send_relay_cell),
+            ((self.circuit_id, 'send_relay_cells'), self.send_relay_cells),
+            ((self.circuit_id, 0, 'RELAY_SENDME'), self.got_sendme),
+            ('%d_destroy' % self.circuit_id, self.destroy)
+        ]
+
+        for event, function in self.handlers:
+            self.register_local(event, function)
+
+        self.send_cell_event = self.handle_local('send_cell')
+        self.send_cells_event = self.handle_local('send_cells')
+        self.send_relay_cell_event = self.handle_local('%d_send_relay_cell' %
+            self.circuit_id)
+
+        self.build_timeout = circuit_build_times.timeout()
+        self.timer = self.trigger('call_later', self.build_timeout, self.timed_out)
 
         log.info('initializing circuit id %d' % self.circuit_id)
-        map(self.do_ntor, circuit)
+        for node in circuit:
+            self.do_ntor(node)
 
     def do_ntor(self, node):
         """
@@ -91,14 +161,21 @@ class Circuit(LocalModule):
             self.pending_ntors.remove(node)
 
         log.info('extending circuit id %d to %s.' % (self.circuit_id, node['name']))
+        self.hop_started = now()
+
+        if not self.circuit and self.create_fast:
+            c = cell.CreateFast(self.circuit_id)
+            self.pending_ntor = crypto.create_fast(node, c.key_material)
+            self.send_cell_event(c)
+            return
 
         self.pending_ntor = crypto.ntor(node)
         handshake = self.pending_ntor.get_handshake()
 
         if not self.circuit:
-            self.trigger_local('send_cell', cell.Create2(self.circuit_id), handshake)
+            self.send_cell_event(cell.Create2(self.circuit_id), handshake)
         else:
-            identity = crypto.b64decode(node['identity'])
+            identity = self.pending_ntor.identity
 
             data  = struct.pack('>B', 2)
             data += struct.pack('>BB4sH', 0, 6, socket.inet_aton(node['ip']),
@@ -106,36 +183,115 @@ class Circuit(LocalModule):
             data += struct.pack('>BB20s', 2, 20, identity)
             data += struct.pack('>HH', 2, len(handshake)) + handshake
 
-            self.trigger_local('%d_send_relay_cell' % self.circuit_id, 'RELAY_EXTEND2',
-                data=data)
+            self.send_relay_cell_event('RELAY_EXTEND2', data=data)
 
     def crypt_init_ntor(self, circuit_id, stream_id, c=None):
         """
-        Finish the ntor handshake once we receive the Created2
+        Finish the ntor handshake once we receive the Created2. If offload_handshakes is
+        set and an executor is loaded the key agreement runs in the worker pool, and the
+        circuit carries on in ntor_derived() once the result is back on the loop.
 
-        Local events triggered:
-            * die - kills the tor connection.
+        Events raised:
+            * run_in_executor <function> <callback> [args] - run the key agreement in
+                                                             the worker pool.
         """
 
         # hack for the created2 and extended2 cells.
         if not c:
             c = stream_id
 
-        cinfo, self.pending_ntor = self.pending_ntor, None
-
         if isinstance(c, cell.Relay):
-            _, c.Y, c.auth = struct.unpack('>H32s32s', c.data['data'][:66])
+            _, Y, auth = cell.created2_body.unpack_from(c.payload)
+        else:
+            Y, auth = c.Y, c.auth
+
+        cinfo = self.pending_ntor
+
+        if self.offload_handshakes and self.trigger('run_in_executor',
+            crypto.ntor_derive, lambda future: self.ntor_derived(cinfo, future),
+            *cinfo.derive_args(Y, auth)):
+            return
+
+        try:
+            cinfo.complete_handshake(Y, auth)
+        except crypto.NtorError as e:
+            self.handshake_failed(e)
+            return
+
+        self.hop_completed(cinfo)
+
+    def crypt_init_fast(self, circuit_id, c):
+        """
+        Finish the CREATE_FAST handshake with the first hop once we receive the
+        CreatedFast.
+        """
+        cinfo = self.pending_ntor
+
+        try:
+            cinfo.complete_handshake(c.key_material, c.derivative_key)
+        except crypto.HandshakeError as e:
+            self.handshake_failed(e)
+            return
+
+        self.hop_completed(cinfo)
+
+    def ntor_derived(self, cinfo, future):
+        """
+        The worker pool has finished the key agreement for a hop. The build may have been
+        abandoned in the meantime.
+        """
+        if cinfo is not self.pending_ntor:
+            return
 
         try:
-            cinfo.complete_handshake(c.Y, c.auth)
+            cinfo.finish(future.result())
         except crypto.NtorError as e:
-            log.error('bad ntor handshake: %s' % e)
-            self.trigger_local('die')
+            self.handshake_failed(e)
             return
 
+        self.hop_completed(cinfo)
+
+    def handshake_failed(self, e):
+        """
+        The handshake didn't verify, the build is abandoned.
+        """
+        self.pending_ntor = None
+        log.error('bad handshake: %s' % e)
+        self.build_failed()
+
+    def timed_out(self):
+        """
+        The circuit took longer to build than the learned build timeout, it is abandoned
+        so a fresh one can be built instead.
+        """
+        self.timer = None
+        log.warning('circuit id %d timed out after %.2fs with %d of %d hops.' % (
+            self.circuit_id, self.build_timeout, len(self.circuit), len(circuit)))
+
+        circuit_build_times.add_abandoned(self.build_timeout)
+        self.build_failed()
+
+    def build_failed(self):
+        """
+        Gives up on building the circuit.
+
+        Local events raised:
+            * <circuit_id>_circuit_failed <circuit_id> - the circuit couldn't be built.
+        """
+        self.destroy()
+        self.trigger_local('%d_circuit_failed' % self.circuit_id, self.circuit_id)
+
+    def hop_completed(self, cinfo):
+        """
+        Adds a hop whose handshake has completed to the circuit and moves on to the next
+        one.
+        """
+        self.pending_ntor = None
+
         log.info('completed handshake with %s in circuit id %d.' % (cinfo.node['name'], 
             self.circuit_id))
-        self.circuit.append(cinfo)
+        circuit_build_times.add_hop(len(self.circuit), now() - self.hop_started)
+        self.circuit.append(cinfo.hop)
 
         if self.pending_ntors:
             self.do_ntor(self.pending_ntors[0])
@@ -149,64 +305,135 @@ class Circuit(LocalModule):
         stream = TorStream(self, stream_id)
         self.streams[stream.stream_id] = stream
 
-    def recv_relay_cell(self, circuit_id, c):
+    def observe_rtt(self, rtt):
+        """
+        Adds a round trip time sample, from a BEGIN to its CONNECTED or from the cell
+        that prompted a SENDME to the SENDME, to the moving average.
         """
-        Relay cell received. We want to decrypt it and then relay it on to the correct
-        stream.
+        if self.rtt is None:
+            self.rtt = rtt
+        else:
+            self.rtt += self.rtt_weight * (rtt - self.rtt)
 
-        Local events raised:
-            * <circuit_id>_<stream_id>_got_relay_<relay> <circuit_id> <stream_id> <cell>
-                - relay cell received on this circuit for the given stream.
-            * <circuit_id>_send_relay_cell <relay_command>
-                - sends a relay cell.
+    def transferred(self, num_bytes):
+        """
+        Counts relay payload bytes sent or received towards the throughput average.
+        """
+        self.recent_bytes = self.throughput() * self.throughput_window + num_bytes
+        self.recent_update = now()
+
+    def throughput(self):
+        """
+        Returns the recent throughput in bytes per second, decayed over
+        throughput_window.
+        """
+        decay = math.exp((self.recent_update - now()) / self.throughput_window)
+        return self.recent_bytes * decay / self.throughput_window
+
+    def score(self, policy):
+        """
+        Returns how good a pick the circuit is for a new stream under the given policy,
+        lower is better.
+
+        least_loaded - fewest active streams, then the least recent traffic.
+        lowest_rtt   - lowest round trip time average, circuits without one count as
+                       the fastest so that they get measured.
+        random       - no preference.
+        """
+        if policy == 'least_loaded':
+            return (len(self.streams), self.throughput())
+        elif policy == 'lowest_rtt':
+            return (self.rtt or 0.0, len(self.streams))
+        return (random.random(),)
+
+    def recv_relay_cells(self, circuit_id, cells):
+        """
+        A run of relay cells was received. We want to decrypt them and then relay them on
+        to the correct streams.
+
+        Each hop decrypts all the cells that reach it in one go, AES-CTR being a stream
+        cipher the cells can be joined up. Cells the hop recognizes stop there and the
+        rest go on to the next hop.
         """
-        found = None
-        data = c.data
+        size = cell.relay_body.size
+        pending = list(range(len(cells)))
+        body = b''.join([ to_bytes(c.data) for c in cells ])
+
+        for hop in self.circuit:
+            body = hop.decrypt(body)
+
+            rest = []
+            for i, index in enumerate(pending):
+                offset = i * size
 
-        for OR in self.circuit:
-            c.data = data = OR.decrypt.update(data)
-            log.debug('OR %s decrypting cell.' % OR.node['name'])
+                digest = hop.recognize(body, offset)
+                if digest is None:
+                    rest.append(i)
+                    continue
+
+                hop.recv_digest = digest
+                cells[index].data = body[offset:offset + size]
+
+            if len(rest) < len(pending):
+                body = b''.join([ body[i * size:(i + 1) * size] for i in rest ])
+                pending = [ pending[i] for i in rest ]
+
+            if not pending:
+                break
+
+        if pending:
+            log.debug('circuit id %d: %d unrecognized relay cells dropped.' % (
+                self.circuit_id, len(pending)))
+
+        dropped = set(pending)
+        received = 0
+
+        for index, c in enumerate(cells):
+            if index in dropped:
+                continue
 
             try:
                 c.parse()
             except cell.CellError as e:
+                log.error('circuit id %d: %s' % (self.circuit_id, e))
                 continue
 
-            digest = OR.recv_digest.copy()
-            digest.update(c.get_str(False))
-            tmp_digest = digest.copy()
+            if c.command == relay_data:
+                received += len(c.payload)
 
-            digest = digest.finalize()[:4]
+            self.recv_relay_cell(c)
 
-            if c.data['digest'] != digest:
-                continue
-            else:
-                found = OR
-                break
-
-        if not found:
-            return
+        if received:
+            self.transferred(received)
 
-        found.recv_digest = tmp_digest
+    def recv_relay_cell(self, c):
+        """
+        Relays a decrypted relay cell on to the correct stream.
 
-        # Every RELAY_DATA cell increments the circuit counter. Once the circuit counter
-        # hits 100, we must tell the circuit we want more relay cells.
-        if c.data['command_text'] == 'RELAY_DATA':
-            self.counter += 1
-            log.debug('circuit id %d counter: %d' % (self.circuit_id, self.counter))
+        Local events raised:
+            * (<circuit_id>, <stream_id>, <relay>) <circuit_id> <stream_id> <cell>
+                - relay cell received on this circuit for the given stream.
+            * <circuit_id>_send_relay_cell <relay_command>
+                - sends a relay cell.
+        """
+        # Every RELAY_DATA cell closes the deliver window by one. Once it has closed by
+        # an increment, we tell the exit we want more relay cells.
+        if c.command == relay_data:
+            self.deliver_window -= 1
 
-            if self.counter == 100:
-                log.debug('sending RELAY_SENDME to reset cell counter.')
-                self.counter = 0
-                self.trigger_local('%d_send_relay_cell' % self.circuit_id, 'RELAY_SENDME')
+            if self.deliver_window <= self.window - self.window_increment:
+                log.debug('circuit id %d: sending RELAY_SENDME.' % self.circuit_id)
+                self.deliver_window += self.window_increment
+                self.send_relay_cell_event('RELAY_SENDME')
 
-        self.trigger_local('%d_%d_got_relay_%s' % (self.circuit_id, c.data['stream_id'],
-            c.data['command_text']), self.circuit_id, c.data['stream_id'], c)
+        self.trigger_local((self.circuit_id, c.stream_id, c.command_text),
+            self.circuit_id, c.stream_id, c)
 
     def send_relay_cell(self, command, stream_id=None, data=None, last=None):
         """
         Generate, encrypt, and send a relay cell with the given command. If the
-        command is a string, it will be converted to the command id.
+        command is a string, it will be converted to the command id. RELAY_DATA cells
+        close the package window, streams check it before sending.
 
         Circuit local events raised:
             * send_cell <cell> [stream_id] [data] - sends a cell.
@@ -214,32 +441,109 @@ class Circuit(LocalModule):
         if isinstance(command, str):
             command = cell.relay_name_to_command(command)
 
-        if command == cell.relay_name_to_command('RELAY_EXTEND2'):
+        if command == relay_extend2:
             c = cell.RelayEarly(self.circuit_id)
         else:
-            c = cell.Relay(self.circuit_id)
+            c = cell.Relay.acquire(self.circuit_id)
+
+        if command == relay_data:
+            self.package_window -= 1
+            self.transferred(len(data))
 
-        got_dest = None
+            # Time every cell the exit will answer with a SENDME, see got_sendme().
+            self.sent_cells += 1
+            if self.sent_cells % self.window_increment == 0:
+                self.sendme_sent.append(now())
+
+        body = None
         for OR in self.circuit[::-1]:
-            if not got_dest and last and OR.node['name'] != last:
+            if body is None and last and OR.node['name'] != last:
                 continue
 
-            if not got_dest:
-                got_dest = True
-
-                c.init_relay({
-                    'command': command,
-                    'stream_id': stream_id or 0,
-                    'data': data
-                })
+            if body is None:
+                c.init_relay(command, stream_id or 0, data)
 
                 OR.send_digest.update(c.get_str(False))
                 digest = OR.send_digest.copy()
-                c.data['digest'] = digest.finalize()[:4]
+                c.digest = digest.finalize()[:4]
+                body = c.get_str()
+
+            body = OR.encrypt(body)
+
+        c.data = body
+        self.send_cell_event(c)
+
+        # The cell has been packed onto the connection's write buffer, so it can be
+        # reused.
+        c.release()
+
+    def send_relay_cells(self, command, stream_id, payloads):
+        """
+        Sends a batch of relay cells with the same command to the last hop, one per
+        payload. The cells are packed into one buffer and every hop encrypts the whole
+        buffer in one go, so a batch costs about as much Python work as a single cell.
+        RELAY_DATA cells close the package window, streams check it before sending.
+
+        Circuit local events raised:
+            * send_cells <circuit_id> <data> <count> - sends relay cell bodies.
+        """
+        if isinstance(command, str):
+            command = cell.relay_name_to_command(command)
+
+        size = cell.relay_body.size
+        header = cell.relay_header
+        zero = b'\x00' * 4
+
+        buf = bytearray(size * len(payloads))
+        view = memoryview(buf)
+        digest = self.circuit[-1].send_digest
+
+        sent = 0
+        for i, payload in enumerate(payloads):
+            offset = i * size
+            start = offset + header.size
+
+            header.pack_into(buf, offset, command, 0, stream_id, zero, len(payload))
+            buf[start:start + len(payload)] = payload
+
+            # The digest covers the cell with its digest field zeroed, which it still is.
+            digest.update(view[offset:offset + size])
+            buf[offset + 5:offset + 9] = digest.copy().finalize()[:4]
+
+            sent += len(payload)
+
+        body = buf
+        for hop in self.circuit[::-1]:
+            body = hop.encrypt(body)
+
+        if command == relay_data:
+            self.package_window -= len(payloads)
+            self.transferred(sent)
+
+            # Time every cell the exit will answer with a SENDME, see got_sendme().
+            for _ in payloads:
+                self.sent_cells += 1
+                if self.sent_cells % self.window_increment == 0:
+                    self.sendme_sent.append(now())
+
+        self.send_cells_event(self.circuit_id, body, len(payloads))
+
+    def got_sendme(self, circuit_id, stream_id, c):
+        """
+        The exit wants more cells, open the package window and let the streams waiting
+        on it send.
+
+        Local events raised:
+            * (<circuit_id>, unblocked) - the circuit's package window has opened.
+        """
+        self.package_window += self.window_increment
+        log.debug('circuit id %d: package window %d.' % (self.circuit_id,
+            self.package_window))
 
-            c.data = OR.encrypt.update(c.get_str())
+        if self.sendme_sent:
+            self.observe_rtt(now() - self.sendme_sent.popleft())
 
-        self.trigger_local('send_cell', c)
+        self.trigger_local((self.circuit_id, 'unblocked'))
 
     def circuit_initialized(self):
         """
@@ -254,6 +558,47 @@ class Circuit(LocalModule):
                 - indicates that the circuit is ready to use.
         """
         self.established = True
+        self.stop_timer()
+        circuit_build_times.add(now() - self.started)
+
         log.info('established circuit id %d.' % self.circuit_id)
+        self.handlers.append(('%d_init_stream' % self.circuit_id, self.init_stream))
         self.register_local('%d_init_stream' % self.circuit_id, self.init_stream)
         self.trigger_local('%d_circuit_initialized' % self.circuit_id, self.circuit_id)
+
+    def destroy(self):
+        """
+        Tears the circuit down and stops listening for its cells.
+
+        Local events raised:
+            * send_cell <cell> [data] - sends the DESTROY cell.
+        """
+        log.info('destroying circuit id %d.' % self.circuit_id)
+
+        self.send_cell_event(cell.Destroy(self.circuit_id), b'\x00')
+        self.abandon()
+
+    def abandon(self):
+        """
+        Stops listening for the circuit's cells and gives up on any handshake still in
+        progress, without telling the other side. Used once the connection is gone.
+        """
+        self.stop_timer()
+        self.pending_ntor = None
+        self.pending_ntors = []
+
+        self.release_local(self.send_cell_event)
+        self.release_local(self.send_cells_event)
+        self.release_local(self.send_relay_cell_event)
+
+        for event, function in self.handlers:
+            self.unregister_local(event, function)
+        self.handlers = []
+
+    def stop_timer(self):
+        """
+        Cancels the build timeout.
+        """
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
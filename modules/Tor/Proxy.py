@@ -27,6 +27,10 @@ class Proxy(Module):
                                                           is ready for use.
             * tor_<or_name>_init_stream <stream_id>     - initialize a stream, will create
                                                           circuits as necessary.
+
+        Events raised:
+            * tor_<or_name>_score - get the score of a connection's best circuit, the
+                                    stream goes to the lowest.
         """
         if not self.connections and not self.connections_pending:
             OR = circuit[0]['name']
@@ -34,7 +38,7 @@ class Proxy(Module):
             TorConnection(circuit[0])
             self.connections_pending[OR] = [ stream_id ]
         elif self.connections:
-            OR = random.choice(self.connections)
+            OR = min(self.connections, key=lambda OR: self.trigger('tor_%s_score' % OR))
             self.trigger('tor_%s_init_stream' % OR, stream_id)
         else:
             OR = random.choice(self.connections_pending.keys())
@@ -1,8 +1,8 @@
 from core.TLSClient import TLSClient
 from modules.Tor.cell import cell
 from modules.Tor.cell import parser as cell_parser
+from modules.Tor.circuitmux import CircuitMux
 from modules.Tor.Circuit import Circuit
-import random
 import ssl
 from base64 import b16encode
 
@@ -13,25 +13,62 @@ class TorConnection(TLSClient):
     """
     Connection to a Tor router.
     """
+
+    # Number of clean circuits kept built ahead of time, so new streams don't have to
+    # wait for a circuit to be extended.
+    circuit_pool_size = 2
+
+    # Seconds a circuit keeps taking new streams once it has been used, like tor's
+    # MaxCircuitDirtiness.
+    circuit_dirtiness = 600
+
+    # Seconds a clean circuit waits in the pool before it's torn down and replaced.
+    circuit_idle_timeout = 3600
+
+    # How a new stream picks among the circuits already carrying streams, one of
+    # least_loaded, lowest_rtt or random. See Circuit.score().
+    stream_policy = 'least_loaded'
+
+    # Most bytes of cells handed to the socket's send buffer at a time, the rest wait
+    # on the circuit mux. Smaller budgets let the mux reorder more often, larger ones
+    # mean fewer sends.
+    write_budget = 64 * 1024
+
     def __init__(self, node):
         """
         Local events registered:
             * handshook                                       - TLS handshake completed.
             * received <data>                                 - data received from socket.
             * send_cell <cell> [data]                         - send a cell.
-            * 0_got_cell_Versions <circuit_id> <cell>         - got the version cell.
-            * 0_got_cell_Certs <circuit_id> <cell>            - got the certs cell.
-            * 0_got_cell_AuthChallenge <circuit_id> <cell>    - got the authchallenge cell.
-            * 0_got_cell_Netinfo <circuit_id> <cell>          - got the netinfo cell.
+            * send_cells <circuit_id> <data> <count>          - send a batch of relay
+                                                                cells.
+            * (0, Versions) <circuit_id> <cell>               - got the version cell.
+            * (0, Certs) <circuit_id> <cell>                  - got the certs cell.
+            * (0, AuthChallenge) <circuit_id> <cell>          - got the authchallenge cell.
+            * (0, Netinfo) <circuit_id> <cell>                - got the netinfo cell.
+            * die                                             - connection closed.
+            * flush                                           - the socket is about to
+                                                                be written to.
+            * drained                                         - the socket has sent
+                                                                everything it was given.
 
         Events registered:
             * tor_<or_name>_init_stream <stream_id> - initiate a stream with the given
                                                       stream id.
+            * tor_<or_name>_score                   - returns the score of the best
+                                                      circuit for a new stream.
         """
         self.node = node
         self.circuits = []
-        self.cell = None
-        self.in_buffer = b''
+        self.idle = []
+        self.building = set()
+        self.waiting = {}
+        self.timers = {}
+        self.ready = False
+        self.circuit_map = {}
+        self.mux = CircuitMux()
+        self.codec = cell.CellCodec()
+        self.framer = cell_parser.CellFramer(self.codec)
         self.name = node['name']
 
         super(TorConnection, self).__init__(node['ip'], node['or_port'])
@@ -59,14 +96,18 @@ class TorConnection(TLSClient):
         self.register_local('handshook', self.initial_handshake)
         self.register_local('received', self.received)
         self.register_local('send_cell', self.send_cell)
-        self.register_local('0_got_cell_Versions', self.got_versions)
-        self.register_local('0_got_cell_Certs', self.got_certs)
-        self.register_local('0_got_cell_AuthChallenge', self.got_authchallenge)
-        self.register_local('0_got_cell_Netinfo', self.got_netinfo)
+        self.register_local('send_cells', self.send_cells)
+        self.register_local((0, 'Versions'), self.got_versions)
+        self.register_local((0, 'Certs'), self.got_certs)
+        self.register_local((0, 'AuthChallenge'), self.got_authchallenge)
+        self.register_local((0, 'Netinfo'), self.got_netinfo)
+        self.register_local('die', self.drop_circuits)
+        self.register_local('flush', self.flush_cells)
+        self.register_local('drained', self.flush_cells)
         self.register('tor_%s_init_stream' % self.name, self.init_stream)
+        self.register('tor_%s_score' % self.name, self.score)
 
         self.init()
-        self.waiting = {}
 
     def initial_handshake(self):
         """
@@ -82,63 +123,327 @@ class TorConnection(TLSClient):
         """
         Received some data, parse it out and handle accordingly.
 
+        Consecutive relay cells for the same circuit are handed over together so that
+        the circuit can decrypt them in one go.
+
         Local events raised:
-            * <circuit_id>_got_cell_<cell_type> <circuit_id> <cell> - got a cell of the
-                                                                      given type.
-        """
-        self.in_buffer += data
-
-        while self.in_buffer:
-            try:
-                log.debug('received data: %s' % b16encode(self.in_buffer))
-                self.in_buffer, self.cell, ready, cont = cell_parser.parse_cell(
-                    self.in_buffer, self.cell)
-            except cell.CellError as e:
-                log.error('invalid cell received: %s' % e)
-                self.die()
-                break
-
-            if ready:
-                self.trigger_local('%d_got_cell_%s' %
-                    (self.cell.circuit_id, cell.cell_type_to_name(self.cell.cell_type)),
-                    self.cell.circuit_id, self.cell)
-                self.cell = None
-
-            if not cont:
-                log.debug("don't have enough bytes to read the entire cell, waiting.")
-                break
+            * (<circuit_id>, <cell_type>) <circuit_id> <cell> - got a cell of the given
+                                                                type.
+            * (<circuit_id>, Relay) <circuit_id> <cells>      - got a run of relay cells.
+        """
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('received data: %s' % b16encode(data))
+
+        run = []
+
+        try:
+            for c in self.framer.feed(data):
+                if c.__class__ is cell.Relay:
+                    if run and run[0].circuit_id != c.circuit_id:
+                        self.trigger_local((run[0].circuit_id, 'Relay'), run[0].circuit_id,
+                            run)
+                        run = []
+
+                    run.append(c)
+                    continue
+
+                if run:
+                    self.trigger_local((run[0].circuit_id, 'Relay'), run[0].circuit_id, run)
+                    run = []
+
+                if not self.closed:
+                    self.trigger_local((c.circuit_id, c.__class__.__name__), c.circuit_id,
+                        c)
+
+                if self.closed:
+                    break
+
+            if run and not self.closed:
+                self.trigger_local((run[0].circuit_id, 'Relay'), run[0].circuit_id, run)
+        except cell.CellError as e:
+            log.error('invalid cell received: %s' % e)
+            self.die()
 
     def send_cell(self, c, data=None):
         """
-        Send a cell down the wire.
+        Send a cell down the wire. Link cells go straight out, circuit cells are queued
+        on the circuit mux and taken off it when the socket is writable.
         
         Local events raised:
             * send <data> - sends data on the socket.
         """
         if not data:
-            data = ''
-        log.debug('sending cell type %s' % cell.cell_type_to_name(c.cell_type))
-        log.debug('sending cell: %s' % b16encode(c.pack(data)))
-        self.trigger_local('send', c.pack(data))
+            data = b''
+        data = c.pack(data, self.codec)
+
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('sending cell type %s' % cell.cell_type_to_name(c.cell_type))
+            log.debug('sending cell: %s' % b16encode(data))
+
+        if not c.circuit_id:
+            self.trigger_local('send', data)
+            return
+
+        self.mux.append(c.circuit_id, data)
+        self.want_write()
+
+    def send_cells(self, circuit_id, body, count):
+        """
+        Sends a batch of encrypted relay cell bodies from a circuit. The cell headers are
+        put in front of each body and the whole batch is queued on the circuit mux as one
+        buffer.
+        """
+        header = self.codec.header.pack(circuit_id, cell.Relay.cell_type)
+        size = cell.relay_body.size
+        step = len(header) + size
+
+        data = bytearray(step * count)
+        body = memoryview(body)
+
+        for i in range(count):
+            offset = i * step
+            data[offset:offset + len(header)] = header
+            data[offset + len(header):offset + step] = body[i * size:(i + 1) * size]
+
+        self.mux.append(circuit_id, data, count)
+        self.want_write()
+
+    def flush_cells(self):
+        """
+        Moves queued cells, in the order the circuit mux picks, to the socket's send
+        buffer until it holds write_budget bytes. This runs right before the socket is
+        written to, so every cell queued since the last write goes out together. Each
+        batch is queued as it is rather than joined up.
+
+        Local events raised:
+            * send <data> - sends data on the socket.
+        """
+        if not self.mux or self.closed:
+            return
+
+        room = self.write_budget - self.write_size
+        if room <= 0:
+            return
+
+        size = self.codec.header.size + 509
+
+        for data in self.mux.pop(max(1, room // size)):
+            self.trigger_local('send', data)
 
     def init_circuit(self):
         """
         Initialize a circuit.
+
+        Local events registered:
+            * <circuit_id>_circuit_initialized <circuit_id> - circuit has been initialized.
+            * <circuit_id>_circuit_failed <circuit_id>      - circuit couldn't be built.
+            * (<circuit_id>, stream_closed) <circuit_id> <stream_id>
+                                                            - a stream on the circuit
+                                                              has closed.
         """
         circuit = Circuit(self)
+        self.circuit_map[circuit.circuit_id] = circuit
+        self.building.add(circuit.circuit_id)
         self.register_local('%d_circuit_initialized' % circuit.circuit_id,
             self.circuit_initialized)
+        self.register_local('%d_circuit_failed' % circuit.circuit_id, self.circuit_failed)
+        self.register_local((circuit.circuit_id, 'stream_closed'), self.stream_closed)
         return circuit.circuit_id
 
+    def forget_circuit(self, circuit_id):
+        """
+        Stops listening for a circuit's events and forgets it.
+        """
+        self.circuit_map.pop(circuit_id, None)
+        self.unregister_local('%d_circuit_initialized' % circuit_id,
+            self.circuit_initialized)
+        self.unregister_local('%d_circuit_failed' % circuit_id, self.circuit_failed)
+        self.unregister_local((circuit_id, 'stream_closed'), self.stream_closed)
+
+    def close_circuit(self, circuit_id):
+        """
+        Tears a circuit down and forgets it.
+
+        Local events raised:
+            * <circuit_id>_destroy - tear the circuit down.
+        """
+        self.forget_circuit(circuit_id)
+        self.trigger_local('%d_destroy' % circuit_id)
+        self.mux.forget(circuit_id)
+
     def circuit_initialized(self, circuit_id):
-        self.circuits.append(circuit_id)
+        """
+        A circuit is built. It either goes to the streams that were waiting on it or into
+        the pool.
+        """
+        self.building.discard(circuit_id)
+
+        if circuit_id in self.waiting:
+            for stream_id in self.waiting.pop(circuit_id):
+                self.use_circuit(circuit_id, stream_id)
+        else:
+            log.debug('OR %s: circuit id %d added to pool.' % (self.name, circuit_id))
+            self.idle.append(circuit_id)
+            self.expire_circuit_in(circuit_id, self.circuit_idle_timeout)
+
+    def circuit_failed(self, circuit_id):
+        """
+        A build was abandoned. Streams waiting on it move to another build and the pool is
+        topped back up.
+        """
+        self.building.discard(circuit_id)
+        self.forget_circuit(circuit_id)
+        self.mux.forget(circuit_id)
+
+        streams = self.waiting.pop(circuit_id, [])
+
+        if self.closed:
+            self.fail_streams(streams)
+            return
+
+        if streams:
+            log.info('OR %s: retrying %d streams on a new circuit.' % (self.name,
+                len(streams)))
+            self.waiting.setdefault(self.pending_circuit(), []).extend(streams)
+
+        self.refill_pool()
+
+    def refill_pool(self):
+        """
+        Starts building circuits until there are circuit_pool_size clean ones built or on
+        their way. Builds that streams are waiting on don't count.
+        """
+        if not self.ready or self.closed:
+            return
+
+        while (len(self.idle) + len(self.building) - len(self.waiting) <
+            self.circuit_pool_size):
+            self.init_circuit()
+
+    def use_circuit(self, circuit_id, stream_id):
+        """
+        Attaches a stream to a circuit. The first stream on a clean circuit takes it out
+        of the pool and starts its dirtiness timer.
+
+        Local events raised:
+            * <circuit_id>_init_stream <stream_id> - initialize a stream on a circuit with
+                                                     the given stream id.
+        """
+        if circuit_id not in self.circuits:
+            if circuit_id in self.idle:
+                self.idle.remove(circuit_id)
+
+            self.circuits.append(circuit_id)
+            self.expire_circuit_in(circuit_id, self.circuit_dirtiness)
+
+        self.trigger_local('%d_init_stream' % circuit_id, stream_id)
+        self.refill_pool()
+
+    def expire_circuit_in(self, circuit_id, delay):
+        """
+        (Re)starts the timer after which the circuit stops taking new streams.
+
+        Events raised:
+            * call_later <delay> <callback> - schedule the expiry.
+        """
+        if circuit_id in self.timers:
+            self.timers[circuit_id].cancel()
+
+        self.timers[circuit_id] = self.trigger('call_later', delay, self.expire_circuit,
+            circuit_id)
+
+    def expire_circuit(self, circuit_id):
+        """
+        A circuit has been dirty or idle for too long. Dirty circuits keep the streams
+        they have but don't get new ones, and are torn down once the last one closes.
+        Idle circuits are torn down and replaced.
+        """
+        self.timers.pop(circuit_id, None)
+
+        if circuit_id in self.circuits:
+            log.info('OR %s: circuit id %d is too dirty for new streams.' % (self.name,
+                circuit_id))
+            self.circuits.remove(circuit_id)
+
+            if not self.circuit_map[circuit_id].streams:
+                self.close_circuit(circuit_id)
+        elif circuit_id in self.idle:
+            log.info('OR %s: circuit id %d expired unused.' % (self.name, circuit_id))
+            self.idle.remove(circuit_id)
+            self.close_circuit(circuit_id)
+            self.refill_pool()
+
+    def stream_closed(self, circuit_id, stream_id):
+        """
+        A stream on a circuit has closed. A circuit that is too dirty for new streams is
+        torn down once it has none left.
+        """
+        if (circuit_id in self.circuits or circuit_id in self.idle or
+            circuit_id in self.building or circuit_id not in self.circuit_map):
+            return
+
+        if not self.circuit_map[circuit_id].streams:
+            log.info('OR %s: last stream on expired circuit id %d closed.' % (self.name,
+                circuit_id))
+            self.close_circuit(circuit_id)
+
+    def drop_circuits(self):
+        """
+        The connection is closed, forget its circuits and stop listening for their
+        cells, there is no one left to send a DESTROY to. The streams on them are
+        closed, as are streams still waiting for a circuit, the connection may be
+        reinitialized but their builds are gone.
+        """
+        for timer in self.timers.values():
+            timer.cancel()
+
+        # Forgotten first, so that the streams closing don't tear the circuits down.
+        for circuit_id, circuit in list(self.circuit_map.items()):
+            self.forget_circuit(circuit_id)
+
+            for stream in list(circuit.streams.values()):
+                stream.teardown()
+
+            circuit.abandon()
+
+        waiting = self.waiting
+
+        self.timers = {}
+        self.circuit_map = {}
+        self.mux.clear()
+        self.circuits = []
+        self.idle = []
+        self.building = set()
+        self.waiting = {}
+        self.ready = False
+
+        for streams in waiting.values():
+            self.fail_streams(streams)
+
+    def fail_streams(self, stream_ids):
+        """
+        Closes streams that were waiting on a circuit that won't be built.
+
+        Events raised:
+            * tor_stream_<stream_id>_closed - the stream has closed.
+        """
+        for stream_id in stream_ids:
+            log.info('OR %s: no circuit for stream %d.' % (self.name, stream_id))
+            self.trigger('tor_stream_%s_closed' % stream_id)
 
     def got_versions(self, circuit_id, versions):
         """
-        Got versions cell, sets version to the highest that we share.
+        Got versions cell, sets the connection's version to the highest that we share.
         """
         log.info('OR %s: got versions' % self.name)
-        cell.proto_version = max(versions.versions)
+
+        shared = set(versions.versions) & set(cell.versions)
+        if not shared:
+            log.error('OR %s: no link protocol version in common.' % self.name)
+            self.die()
+            return
+
+        self.codec.set_version(max(shared))
 
     def got_certs(self, circuit_id, certs):
         """
@@ -172,34 +477,52 @@ class TorConnection(TLSClient):
             'other': netinfo.router_addresses[0]
         })
 
+        self.ready = True
+        self.refill_pool()
+
         self.trigger('tor_%s_proxy_initialized' % self.name, self.name)
 
     def init_stream(self, stream_id):
         """
-        Finds or creates a circuit for a directory stream.
-
-        Local events registered:
-            * <circuit_id>_circuit_initialized <circuit_id>  - circuit has been initialized.
-            * <circuit_id>_init_stream <stream_id>           - initialize a stream on a
-                                                               circuit with the given
-                                                               stream id.
-        """
-        if not self.circuits:
-            circuit_id = self.init_circuit()
-            self.waiting[circuit_id] = stream_id
-            self.register_once_local('%d_circuit_initialized' % circuit_id,
-                self.do_stream)
+        Finds or creates a circuit for a stream. Clean circuits from the pool are used
+        first, then circuits already carrying streams. Failing that the stream waits for a
+        circuit that is already being built, and only if there is none is a circuit
+        built for it. Any number of streams can wait on one build.
+        """
+        if self.idle:
+            self.use_circuit(self.idle[0], stream_id)
+        elif self.circuits:
+            self.use_circuit(self.best_circuit(), stream_id)
         else:
-            self.trigger_local('%d_init_stream' % random.choice(self.circuits), stream_id)
+            self.waiting.setdefault(self.pending_circuit(), []).append(stream_id)
 
-    def do_stream(self, circuit_id):
+    def best_circuit(self):
         """
-        Initialize a directory stream on a circuit.
+        Returns the circuit carrying streams that is the best pick for a new stream under
+        stream_policy.
+        """
+        policy = self.stream_policy
+        return min(self.circuits, key=lambda c: self.circuit_map[c].score(policy))
 
-        Local events raised:
-            * <circuit_id>_init_stream <stream_id> - initialize a stream on a circuit with
-                                                     the given stream id.
+    def score(self):
         """
-        stream_id = self.waiting[circuit_id]
-        del self.waiting[circuit_id]
-        self.trigger_local('%d_init_stream' % circuit_id, stream_id)
+        Returns the score of the circuit a new stream would get, so that the proxy can
+        pick between connections. Clean and pending circuits score as unloaded.
+        """
+        if self.idle or not self.circuits:
+            return (0.0, 0.0)
+
+        return self.circuit_map[self.best_circuit()].score(self.stream_policy)
+
+    def pending_circuit(self):
+        """
+        Returns a circuit being built for new streams to wait on. Builds that already have
+        streams waiting are shared first, a circuit is only built if none are in flight.
+        """
+        for circuit_id in self.waiting:
+            return circuit_id
+
+        for circuit_id in self.building:
+            return circuit_id
+
+        return self.init_circuit()
@@ -35,6 +35,7 @@ class TorLineClient(TorSocket):
         """
         Parses a chunk. If in line-mode we will forward all complete lines and store the
         last line until we have a complete line. In chunked mode we just pass it along.
+        Data that arrives once the socket is closed is dropped.
 
         Local events raised:
             * chunk <data> - raised when we receive a chunk.
@@ -42,6 +43,9 @@ class TorLineClient(TorSocket):
             * line_closed  - raised when the socket is closed and we have read
                              all data.
         """
+        if self.closed:
+            return
+
         if self.chunked:
             self.trigger_local('chunk', self.data + data)
             self.data = ''
@@ -52,6 +56,8 @@ class TorLineClient(TorSocket):
             lines, self.data = lines[:-1], lines[-1]
 
             for line in lines:
+                if self.closed:
+                    break
                 self.trigger_local('line', line)
 
         if self.closed and not self.data and not self.chunked:
@@ -16,9 +16,13 @@ class TorSocket(LocalModule):
             * tor_stream_<stream_id>_connected   - initial connection through Tor completed.
             * tor_stream_<stream_id>_recv <data> - received data from Tor stream.
             * tor_stream_<stream_id>_closed      - indicates that the stream has closed.
+            * tor_stream_<stream_id>_blocked     - too much is queued on the stream behind
+                                                   its flow control windows, stop sending.
+            * tor_stream_<stream_id>_unblocked   - the stream's queue has drained.
 
         Local events registered:
             * send <data> - send data through the stream.
+            * close       - end the stream.
         """
         super(TorSocket, self).__init__()
 
@@ -30,16 +34,27 @@ class TorSocket(LocalModule):
         self.register('tor_stream_%s_connected' % self.stream_id, self._connected)
         self.register('tor_stream_%s_recv' % self.stream_id, self.recv)
         self.register('tor_stream_%s_closed' % self.stream_id, self.die)
+        self.register('tor_stream_%s_blocked' % self.stream_id, self.blocked)
+        self.register('tor_stream_%s_unblocked' % self.stream_id, self.unblocked)
         self.register_local('send', self.send)
+        self.send_event = self.handle('tor_stream_%s_send' % self.stream_id)
+        self.register_local('close', self.close)
 
         self.closed = False
+        self.writable = True
         self.connect()
 
     def initialized(self):
         """
-        Indicates that the stream is ready to use.
+        Indicates that the stream is ready to use. A socket closed while its stream was
+        waiting for a circuit ends the stream straight away.
+
+        Events raised:
+            * tor_stream_<stream_id>_close - end the stream.
         """
-        if not self.directory:
+        if self.closed:
+            self.trigger('tor_stream_%d_close' % self.stream_id)
+        elif not self.directory:
             self.trigger('tor_stream_%d_init_tcp_stream' % self.stream_id, self.host[0],
                 self.host[1])
         else:
@@ -63,8 +78,20 @@ class TorSocket(LocalModule):
         """
         if not self.closed:
             self.closed = True
+            self.release(self.send_event)
             self.trigger_local('closed')
 
+    def close(self):
+        """
+        Ends the stream and closes the socket. The stream may still be waiting for a
+        circuit, in which case it is ended once it has one.
+
+        Events raised:
+            * tor_stream_<stream_id>_close - end the stream.
+        """
+        self.trigger('tor_stream_%d_close' % self.stream_id)
+        self.die()
+
     def recv(self, data):
         """
         Received data from stream.
@@ -74,14 +101,35 @@ class TorSocket(LocalModule):
         """
         self.trigger_local('received', data)
 
+    def blocked(self):
+        """
+        Tor won't take more data on the stream for now. Anything sent is still queued.
+
+        Local events raised:
+            * pause_writing - stop sending until resume_writing.
+        """
+        self.writable = False
+        self.trigger_local('pause_writing')
+
+    def unblocked(self):
+        """
+        The stream has caught up.
+
+        Local events raised:
+            * resume_writing - send more data.
+        """
+        self.writable = True
+        self.trigger_local('resume_writing')
+
     def send(self, data):
         """
-        Send data through stream.
+        Send data through stream. Data sent while the socket isn't writable is still
+        queued, but senders should wait for resume_writing to keep memory bounded.
         
         Events raised:
             * tor_stream_<stream_id>_send <data> - send data through stream.
         """
-        self.trigger('tor_stream_%s_send' % self.stream_id, data)
+        self.send_event(data)
 
     def connect(self):
         """
@@ -1,22 +1,46 @@
 from core.LocalModule import LocalModule
+from collections import deque
 import struct
+import random
 import logging
 log = logging.getLogger(__name__)
 
+try:
+    from time import monotonic as now
+except ImportError:
+    from time import time as now
+
 class TorStream(LocalModule):
     """
     A Tor stream in a circuit.
     """
 
+    # Stream level flow control windows, in RELAY_DATA cells. Each SENDME opens the
+    # window by increment cells.
+    window = 500
+    window_increment = 50
+
+    # Most relay cells handed to the circuit in one batch.
+    batch_cells = 32
+
+    # Bytes queued on the stream, waiting for the flow control windows to open, before
+    # the socket is asked to pause, and the level the queue has to drain back down to
+    # before it is told to resume.
+    high_water = 128 * 1024
+    low_water = 32 * 1024
+
     def __init__(self, circuit, stream_id=None):
         """
         Circuit local events registered:
-            * <circuit_id>_<stream_id>_got_relay_RELAY_CONNECTED <circuit_id> <stream_id>
-                <cell> - got a RELAY_CONNECTED cell.
-            * <circuit_id>_<stream_id>_got_relay_RELAY_END <circuit_id> <stream_id> <cell>
+            * (<circuit_id>, <stream_id>, RELAY_CONNECTED) <circuit_id> <stream_id> <cell>
+                - got a RELAY_CONNECTED cell.
+            * (<circuit_id>, <stream_id>, RELAY_END) <circuit_id> <stream_id> <cell>
                 - got a RELAY_END cell.
-            * <circuit_id>_<stream_id>_got_relay_RELAY_DATA <circuit_id> <stream_id> <cell>
+            * (<circuit_id>, <stream_id>, RELAY_DATA) <circuit_id> <stream_id> <cell>
                 - got a RELAY_DATA cell.
+            * (<circuit_id>, <stream_id>, RELAY_SENDME) <circuit_id> <stream_id> <cell>
+                - got a stream level SENDME.
+            * (<circuit_id>, unblocked) - the circuit's package window has opened.
 
 
         Events registered:
@@ -24,6 +48,7 @@ class TorStream(LocalModule):
                                                                      directory stream.
             * tor_stream_<stream_id>_init_tcp_stream <host> <port> - initialize a TCP
                                                                      stream.
+            * tor_stream_<stream_id>_close                         - end the stream.
 
         Events raised:
             * tor_stream_<stream id>_initialized - indicates that the stream has been
@@ -38,20 +63,37 @@ class TorStream(LocalModule):
         self.data    = ''
         self.stream_id = stream_id or random.randint(1, 65535)
 
-        self.circuit.register_local('%d_%d_got_relay_RELAY_CONNECTED' % 
-            (self.circuit.circuit_id, self.stream_id), self.got_relay_connected)
-        self.circuit.register_local('%d_%d_got_relay_RELAY_END' % (self.circuit.circuit_id, 
-            self.stream_id), self.got_relay_end)
-        self.circuit.register_local('%d_%d_got_relay_RELAY_DATA' % (self.circuit.circuit_id,
-            self.stream_id), self.got_relay_data)
+        self.circuit.register_local((self.circuit.circuit_id, self.stream_id,
+            'RELAY_CONNECTED'), self.got_relay_connected)
+        self.circuit.register_local((self.circuit.circuit_id, self.stream_id, 'RELAY_END'),
+            self.got_relay_end)
+        self.circuit.register_local((self.circuit.circuit_id, self.stream_id, 'RELAY_DATA'),
+            self.got_relay_data)
+        self.circuit.register_local((self.circuit.circuit_id, self.stream_id,
+            'RELAY_SENDME'), self.got_sendme)
+        self.circuit.register_local((self.circuit.circuit_id, 'unblocked'), self.flush)
+
+        self.send_relay_cell = self.circuit.handle_local('%d_send_relay_cell' %
+            self.circuit.circuit_id)
+        self.send_relay_cells = self.circuit.handle_local((self.circuit.circuit_id,
+            'send_relay_cells'))
+        self.recv_event = self.handle('tor_stream_%s_recv' % self.stream_id)
+        self.closed_event = self.handle('tor_stream_%s_closed' % self.stream_id)
 
         self.register('tor_stream_%d_init_directory_stream' % self.stream_id,
             self.directory_stream)
         self.register('tor_stream_%d_init_tcp_stream' % self.stream_id, self.tcp_stream)
+        self.register('tor_stream_%d_close' % self.stream_id, self.close)
 
-        self.trigger('tor_stream_%d_initialized' % self.stream_id)
+        self.package_window = self.window
+        self.deliver_window = self.window
+        self.queue = deque()
+        self.offset = 0
+        self.queued = 0
+        self.blocked = False
+        self.begin_sent = None
 
-        self.counter = 0
+        self.trigger('tor_stream_%d_initialized' % self.stream_id)
 
     def got_relay_connected(self, circuit_id, stream_id, _cell):
         """
@@ -66,21 +108,79 @@ class TorStream(LocalModule):
         log.info('stream %d: got relay connected cell' % stream_id)
 
         self.connected = True
+        if self.begin_sent is not None:
+            self.circuit.observe_rtt(now() - self.begin_sent)
+
         self.register('tor_stream_%s_send' % self.stream_id, self.send)
         self.trigger('tor_stream_%s_connected' % self.stream_id, self.stream_id)
 
     def got_relay_end(self, circuit_id, stream_id, _cell):
         """
         Handles received relay end cells.
+        """
+        log.info('stream %d: got relay end cell' % stream_id)
+        self.teardown()
+
+    def close(self):
+        """
+        Ends the stream from our side, the exit is told with a RELAY_END and anything
+        that still arrives for the stream is dropped.
+
+        Circuit-local events raised:
+            * <circuit_id>_send_relay_cell <relay> <stream_id> <data> - send the
+                                                                        RELAY_END.
+        """
+        if self.closed:
+            return
+
+        log.info('stream %d: closing' % self.stream_id)
+
+        if self.begin_sent is not None:
+            self.send_relay_cell('RELAY_END', self.stream_id, data='\x06')
+
+        self.teardown()
+
+    def teardown(self):
+        """
+        Takes the stream off its circuit, stops listening for its events and tells
+        everyone it has closed.
 
         Events raised:
             * tor_stream_<stream_id>_closed - stream closed.
+
+        Circuit-local events raised:
+            * (<circuit_id>, stream_closed) <circuit_id> <stream_id>
+                - the stream is no longer on the circuit.
         """
-        log.info('stream %d: got relay end cell' % stream_id)
+        circuit_id = self.circuit.circuit_id
 
         self.connected = False
         self.closed = True
-        self.trigger('tor_stream_%s_closed' % self.stream_id)
+        self.queue.clear()
+        self.offset = 0
+        self.queued = 0
+        self.circuit.streams.pop(self.stream_id, None)
+        self.closed_event()
+
+        for relay, function in [ ('RELAY_CONNECTED', self.got_relay_connected),
+            ('RELAY_END', self.got_relay_end), ('RELAY_DATA', self.got_relay_data),
+            ('RELAY_SENDME', self.got_sendme) ]:
+            self.circuit.unregister_local((circuit_id, self.stream_id, relay), function)
+        self.circuit.unregister_local((circuit_id, 'unblocked'), self.flush)
+
+        self.unregister('tor_stream_%d_init_directory_stream' % self.stream_id,
+            self.directory_stream)
+        self.unregister('tor_stream_%d_init_tcp_stream' % self.stream_id, self.tcp_stream)
+        self.unregister('tor_stream_%d_close' % self.stream_id, self.close)
+        self.unregister('tor_stream_%s_send' % self.stream_id, self.send)
+
+        self.circuit.release_local(self.send_relay_cell)
+        self.circuit.release_local(self.send_relay_cells)
+        self.release(self.recv_event)
+        self.release(self.closed_event)
+
+        self.circuit.trigger_local((circuit_id, 'stream_closed'), circuit_id,
+            self.stream_id)
 
     def got_relay_data(self, circuit_id, stream_id, _cell):
         """
@@ -95,27 +195,89 @@ class TorStream(LocalModule):
         """
         log.debug('stream %d: got relay data cell' % stream_id)
 
-        self.counter += 1
+        self.deliver_window -= 1
 
-        if self.counter == 50:
-            self.counter = 0
-            self.circuit.trigger_local('%d_send_relay_cell' % self.circuit.circuit_id,
-                'RELAY_SENDME', stream_id=self.stream_id)
+        if self.deliver_window <= self.window - self.window_increment:
+            self.deliver_window += self.window_increment
+            self.send_relay_cell('RELAY_SENDME', stream_id=self.stream_id)
 
-        self.trigger('tor_stream_%s_recv' % self.stream_id, _cell.data['data'])
+        self.recv_event(_cell.payload)
+        _cell.release()
+
+    def got_sendme(self, circuit_id, stream_id, _cell):
+        """
+        The exit wants more cells on this stream, open the package window.
+        """
+        self.package_window += self.window_increment
+        log.debug('stream %d: package window %d' % (stream_id, self.package_window))
+        self.flush()
 
     def send(self, data):
         """
-        Send data down a stream, breaks into PAYLOAD_LEN - 11 byte chunks.
+        Send data down a stream, breaks into PAYLOAD_LEN - 11 byte chunks. The data is
+        queued as is and sent as far as the stream and circuit package windows allow,
+        the chunks are views into it rather than copies.
+        """
+        if not data:
+            return
+
+        # Views of a bytearray would see the caller reuse it. bytes() of a memoryview is
+        # its repr on python 2.
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        elif not isinstance(data, bytes):
+            data = bytes(bytearray(data))
+
+        self.queue.append(memoryview(data))
+        self.queued += len(data)
+        self.flush()
+
+    def flush(self, circuit_id=None):
+        """
+        Sends queued data while both package windows are open, in batches of up to
+        batch_cells chunks. Whatever is left waits for a SENDME. The stream is blocked
+        once more than high_water bytes are waiting, and unblocked when they have gone
+        down to low_water.
 
         Circuit-local events raised:
-            * <circuit_id>_send_relay_cell <relay> <stream_id> <data> - send relay cell over
-                                                                        circuit.
+            * (<circuit_id>, send_relay_cells) <relay> <stream_id> <payloads>
+                - send a batch of relay cells over the circuit.
+
+        Events raised:
+            * tor_stream_<stream_id>_blocked   - the stream can't take much more data for
+                                                 now.
+            * tor_stream_<stream_id>_unblocked - the stream's queue has drained, send
+                                                 more.
         """
-        while data:
-            self.circuit.trigger_local('%d_send_relay_cell' % self.circuit.circuit_id,
-                'RELAY_DATA', self.stream_id, data[:509-11])
-            data = data[509-11:]
+        queue = self.queue
+        circuit = self.circuit
+        size = 509 - 11
+
+        while queue and self.package_window > 0 and circuit.package_window > 0:
+            count = min(self.package_window, circuit.package_window, self.batch_cells)
+
+            payloads = []
+            while queue and len(payloads) < count:
+                data = queue[0]
+                payloads.append(data[self.offset:self.offset + size])
+                self.offset += size
+
+                if self.offset >= len(data):
+                    queue.popleft()
+                    self.offset = 0
+
+            self.package_window -= len(payloads)
+            self.queued -= sum(len(payload) for payload in payloads)
+            self.send_relay_cells('RELAY_DATA', self.stream_id, payloads)
+
+        if self.queued > self.high_water and not self.blocked:
+            log.debug('stream %d: blocked' % self.stream_id)
+            self.blocked = True
+            self.trigger('tor_stream_%s_blocked' % self.stream_id)
+        elif self.queued <= self.low_water and self.blocked:
+            log.debug('stream %d: unblocked' % self.stream_id)
+            self.blocked = False
+            self.trigger('tor_stream_%s_unblocked' % self.stream_id)
 
     def directory_stream(self):
         """
@@ -126,8 +288,8 @@ class TorStream(LocalModule):
                                                                  circuit.
         """
         log.info('stream %d: opening directory stream' % self.stream_id)
-        self.circuit.trigger_local('%d_send_relay_cell' % self.circuit.circuit_id,
-            'RELAY_BEGIN_DIR', self.stream_id)
+        self.begin_sent = now()
+        self.send_relay_cell('RELAY_BEGIN_DIR', self.stream_id)
 
     def tcp_stream(self, host, port):
         """
@@ -138,5 +300,5 @@ class TorStream(LocalModule):
                                                                         over circuit.
         """
         log.info('stream %d: opening tcp stream to: %s:%d' % (self.stream_id, host, port))
-        self.circuit.trigger_local('%d_send_relay_cell' % self.circuit.circuit_id,
-            'RELAY_BEGIN', self.stream_id, data='%s:%d\00' % (host, port))
+        self.begin_sent = now()
+        self.send_relay_cell('RELAY_BEGIN', self.stream_id, data='%s:%d\00' % (host, port))
@@ -1,5 +1,7 @@
 from core.Module import Module
 from core.module_driver import modules
+import modules.Tor.crypto as crypto
+from modules.Tor.build_times import circuit_build_times
 
 import logging
 log = logging.getLogger(__name__)
@@ -12,11 +14,20 @@ class Tor(Module):
 
     def module_load(self):
         """
+        Events registered:
+            * quit - save the circuit build times.
+
         Events raised:
             * tor_get_router <flags> - get a router with the given flags.
         """
         log.info('initializing Tor.')
 
+        # Start generating ntor keypairs before the first circuit needs one.
+        crypto.key_pool.refill()
+
+        circuit_build_times.load()
+        self.register('quit', circuit_build_times.save)
+
         modules.load_module('Tor.Proxy')
         modules.load_module('Tor.DirServ')
 
@@ -0,0 +1,210 @@
+from collections import deque
+from math import log as ln
+import os
+import logging
+log = logging.getLogger(__name__)
+
+# Where the observed build times are kept between runs.
+state_file = 'data/circuit_build_times'
+
+class CircuitBuildTimes(object):
+    """
+    Learns how long circuits take to build and derives the build timeout from it, the
+    same way tor's circuit build timeout estimator does (path-spec.txt, section 2.4).
+
+    Build times are kept in milliseconds for the most recent builds, completed and
+    abandoned alike, and binned into a histogram. They are assumed to follow a Pareto
+    distribution. Xm is estimated from the most common bins and alpha by maximum
+    likelihood. Abandoned builds are right censored, they count as lasting as long as
+    the timeout they hit but only completed builds count towards alpha. The timeout is
+    the point where the quantile cutoff of builds should have completed.
+
+    Until enough builds have been seen the initial timeout is used.
+    """
+
+    # Number of recent builds the estimate is based on.
+    max_builds = 1000
+
+    # Builds needed before the timeout is learned rather than the initial one.
+    min_builds = 100
+
+    # Histogram bin width, in milliseconds.
+    bin_width = 10
+
+    # Number of the most common bins Xm is averaged over.
+    modes = 3
+
+    # Fraction of builds expected to complete within the timeout.
+    quantile = 0.8
+
+    # Timeouts in seconds, before there are enough builds and the lowest allowed.
+    initial_timeout = 60.0
+    min_timeout = 1.5
+
+    # Recorded builds between saves.
+    save_interval = 10
+
+    def __init__(self, path=None):
+        self.path = path or state_file
+
+        # (ms, completed) for each of the most recent builds.
+        self.records = deque(maxlen=self.max_builds)
+        self.hops = {}
+        self.unsaved = 0
+        self.cutoff = None
+
+    def add(self, seconds):
+        """
+        Records how long a completed build took.
+        """
+        self.records.append((int(seconds * 1000), True))
+        self.changed()
+
+    def add_abandoned(self, seconds):
+        """
+        Records a build that was given up on after seconds.
+        """
+        self.records.append((int(seconds * 1000), False))
+        self.changed()
+
+    def add_hop(self, hop, seconds):
+        """
+        Records how long extending to the hop at the given position took. These are
+        kept for stats only, the timeout covers the whole build.
+        """
+        if hop not in self.hops:
+            self.hops[hop] = deque(maxlen=self.max_builds)
+
+        self.hops[hop].append(int(seconds * 1000))
+
+    def builds(self):
+        """
+        Returns the times of the completed builds in the window.
+        """
+        return [ ms for ms, completed in self.records if completed ]
+
+    def abandoned(self):
+        """
+        Returns the times of the abandoned builds in the window.
+        """
+        return [ ms for ms, completed in self.records if not completed ]
+
+    def changed(self):
+        self.cutoff = None
+        self.unsaved += 1
+
+        if self.unsaved >= self.save_interval:
+            self.save()
+
+    def histogram(self, times=None):
+        """
+        Returns the histogram of build times as a dict of bin to count, bins are
+        labelled with the time in milliseconds they start at.
+        """
+        bins = {}
+        for ms in self.builds() if times is None else times:
+            b = ms - ms % self.bin_width
+            bins[b] = bins.get(b, 0) + 1
+        return bins
+
+    def xm(self):
+        """
+        Estimates Xm, the distribution's minimum, as the weighted average of the most
+        common bins.
+        """
+        bins = sorted(self.histogram().items(), key=lambda b: b[1], reverse=True)
+        bins = bins[:self.modes]
+
+        total = sum(count for _, count in bins)
+        return sum((b + self.bin_width / 2.0) * count for b, count in bins) / total
+
+    def timeout(self):
+        """
+        Returns the current build timeout in seconds.
+        """
+        if self.cutoff is None:
+            self.cutoff = self.estimate()
+        return self.cutoff
+
+    def estimate(self):
+        builds = self.builds()
+        if len(builds) < self.min_builds:
+            return self.initial_timeout
+
+        xm = self.xm()
+
+        a = sum(ln(max(ms, xm)) for ms, _ in self.records)
+        a -= len(self.records) * ln(xm)
+
+        if a <= 0:
+            return self.initial_timeout
+
+        alpha = len(builds) / a
+        timeout = xm / (1 - self.quantile) ** (1 / alpha) / 1000.0
+
+        log.debug('circuit build timeout: xm %dms, alpha %f, timeout %.2fs.' % (xm,
+            alpha, timeout))
+
+        return max(timeout, self.min_timeout)
+
+    def stats(self):
+        """
+        Returns the number of builds, abandoned builds, the timeout, and the median time
+        of each hop in milliseconds.
+        """
+        hops = {}
+        for hop, times in self.hops.items():
+            hops[hop] = sorted(times)[len(times) // 2]
+
+        return len(self.builds()), len(self.abandoned()), self.timeout(), hops
+
+    def load(self):
+        """
+        Loads the builds recorded by a previous run. Lines are either bin <ms> <count>
+        or abandoned <ms> <count>.
+        """
+        try:
+            lines = open(self.path).read().splitlines()
+        except (IOError, OSError):
+            return
+
+        for line in lines:
+            line = line.split()
+
+            try:
+                kind, ms, count = line[0], int(line[1]), int(line[2])
+            except (IndexError, ValueError):
+                log.warning('bad line in %s: %s' % (self.path, ' '.join(line)))
+                continue
+
+            if kind == 'bin':
+                self.records.extend([ (ms, True) ] * count)
+            elif kind == 'abandoned':
+                self.records.extend([ (ms, False) ] * count)
+
+        self.cutoff = None
+        log.info('loaded %d circuit build times, timeout %.2fs.' % (len(self.records),
+            self.timeout()))
+
+    def save(self):
+        """
+        Writes the histogram out, the bins are saved rather than every build.
+        """
+        self.unsaved = 0
+
+        lines = []
+        for kind, times in [ ('bin', self.builds()), ('abandoned', self.abandoned()) ]:
+            for b, count in sorted(self.histogram(times).items()):
+                lines.append('%s %d %d\n' % (kind, b + self.bin_width // 2, count))
+
+        try:
+            dirs = os.path.split(self.path)[0]
+            if dirs and not os.path.isdir(dirs):
+                os.makedirs(dirs)
+
+            open(self.path, 'w').write(''.join(lines))
+        except (IOError, OSError) as e:
+            log.warning('could not save circuit build times: %s' % e)
+
+# Build times shared by every circuit.
+circuit_build_times = CircuitBuildTimes()
@@ -8,8 +8,24 @@ import socket
 import logging
 log = logging.getLogger(__name__)
 
-# default protocol version before negotiation
-proto_version = 3
+# Link protocol versions we support.
+versions = [ 3, 4 ]
+
+# Maximum number of spare relay cells kept for reuse, 0 disables the free-list.
+relay_free_list_size = 64
+relay_free_list = []
+
+# Precompiled cell layouts.
+relay_header = struct.Struct('>BHH4sH')
+relay_body = struct.Struct('>BHH4sH498s')
+create_fast_body = struct.Struct('>20s')
+created_fast_body = struct.Struct('>20s20s')
+create2_header = struct.Struct('>HH')
+created2_body = struct.Struct('>H32s32s')
+netinfo_time = struct.Struct('>I')
+address_header = struct.Struct('>BB')
+cert_header = struct.Struct('>BH')
+auth_challenge_header = struct.Struct('>32sH')
 
 class CellError(Exception):
     """
@@ -23,142 +39,213 @@ class TorError(Exception):
     """
     pass
 
+class CellCodec(object):
+    """
+    Link protocol state of one OR connection. Holds the negotiated version and the
+    precompiled cell headers for it, cells are packed and framed through it.
+    """
+    def __init__(self, version=3):
+        self.set_version(version)
+
+    def set_version(self, version):
+        """
+        Switch to a newly negotiated link protocol version. Versions before 4 use 2 byte
+        circuit ids, 4 and up use 4 bytes.
+        """
+        circuit_id = 'H' if version < 4 else 'I'
+
+        self.version = version
+        self.header = struct.Struct('>%sB' % circuit_id)
+        self.variable_header = struct.Struct('>%sBH' % circuit_id)
+        self.fixed_cell = struct.Struct('>%sB509s' % circuit_id)
+
+    def pack_fixed(self, circuit_id, cell_type, data):
+        return self.fixed_cell.pack(circuit_id, cell_type, data)
+
+    def pack_variable(self, circuit_id, cell_type, data):
+        return self.variable_header.pack(circuit_id, cell_type, len(data)) + data
+
+# Codec for connections that haven't negotiated a version yet. VERSIONS cells always
+# use it.
+default_codec = CellCodec(3)
+
+def to_bytes(data):
+    """
+    Copies a memoryview, like the cell bodies handed out by the cell framer, into
+    bytes. Anything else is returned as is.
+    """
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    return data
+
 class FixedCell(object):
     """
     Fixed length cell.
     """
+    __slots__ = ('circuit_id', 'data')
+
     cell_type = -1
+    fixed = True
 
     def __init__(self, circuit_id=None):
-        self.fixed = True
         self.circuit_id = circuit_id or 0
 
+    @classmethod
+    def acquire(cls, circuit_id=None):
+        """
+        Get a cell of this type, cell types with a free-list reuse a spare one.
+        """
+        return cls(circuit_id)
+
+    def release(self):
+        """
+        Hand the cell back once nothing refers to it anymore.
+        """
+        pass
+
     def unpack(self, data):
-        self.data = data
+        self.data = to_bytes(data)
 
-    def pack(self, data):
+    def pack(self, data, codec=default_codec):
         """
         Pack the circuit id, cell type, and data.
         """
-        if proto_version < 4:
-            data = struct.pack('>HB509s', self.circuit_id, self.cell_type, data)
-        else:
-            data = struct.pack('>IB509s', self.circuit_id, self.cell_type, data)
-        return data
+        return codec.pack_fixed(self.circuit_id, self.cell_type, data)
 
 class VariableCell(object):
     """
     Variable lengthed cell.
     """
+    __slots__ = ('circuit_id', 'data', 'length')
+
     cell_type = -1
+    fixed = False
 
     def __init__(self, circuit_id=None):
-        self.fixed = False
         self.circuit_id = circuit_id or 0
 
-    def has_len(self):
-        """
-        Returns true if the length header has been parsed.
-        """
-        return hasattr(self, 'length')
+    @classmethod
+    def acquire(cls, circuit_id=None):
+        return cls(circuit_id)
 
-    def len(self, data=None):
-        """
-        Get or set the length of the cell.
-        """
-        if data:
-            self.length = struct.unpack('>H', data[:2])[0]
-        elif self.has_len():
-            return self.length
+    def release(self):
+        pass
 
     def unpack(self, data):
-        self.data = data[:self.length]
+        self.data = to_bytes(data[:self.length])
 
-    def pack(self, data):
+    def pack(self, data, codec=default_codec):
         """
         Pack the circuit id, cell type, length, and data.
         """
-        if proto_version < 4:
-            header = struct.pack('>HBH', self.circuit_id, self.cell_type, len(data))
-        else:
-            header = struct.pack('>IBH', self.circuit_id, self.cell_type, len(data))
-        return header + data
+        return codec.pack_variable(self.circuit_id, self.cell_type, data)
 
 class Relay(FixedCell):
     """
-    Relay cell.
+    Relay cell. data holds the cell body as it is on the wire, or decrypted once
+    parsed. The relay header fields and the payload are kept as attributes.
     """
+    __slots__ = ('command', 'stream_id', 'digest', 'payload')
+
     cell_type = 3
 
-    def get_str(self, include_digest=True):
+    @classmethod
+    def acquire(cls, circuit_id=None):
         """
-        Returns the packed data without sending so that it can be encrypted.
+        Reuse a relay cell from the free-list. RELAY_EARLY cells aren't pooled.
         """
-        if isinstance(self.data, str):
-            return self.data
+        if cls is Relay and relay_free_list:
+            c = relay_free_list.pop()
+            c.circuit_id = circuit_id or 0
+            return c
+        return cls(circuit_id)
+
+    def release(self):
+        """
+        Put the cell on the free-list, if there's room. Cells on the free-list have no
+        data, so releasing one twice doesn't put it there twice.
+        """
+        if getattr(self, 'data', None) is None:
+            return
+
+        if self.__class__ is Relay and len(relay_free_list) < relay_free_list_size:
+            self.data = self.payload = None
+            relay_free_list.append(self)
 
-        if not self.data['data']:
-            self.data['data'] = ''
+    @property
+    def command_text(self):
+        return relay_commands[self.command]
 
+    def unpack(self, data):
+        """
+        Relay cells are decrypted as soon as they are received, which makes a copy, so
+        the view from the framer is kept as is.
+        """
+        self.data = data
+
+    def get_str(self, include_digest=True):
+        """
+        Returns the packed data without sending so that it can be encrypted.
+        """
         if include_digest:
-            digest = self.data['digest']
+            digest = self.digest
         else:
-            digest = '\x00' * 4
+            digest = b'\x00' * 4
 
-        return struct.pack('>BHH4sH498s', self.data['command'], 0,
-            self.data['stream_id'], digest, len(self.data['data']), self.data['data'])
+        return relay_body.pack(self.command, 0, self.stream_id, digest,
+            len(self.payload), self.payload)
 
     def parse(self):
         """
         Parse a received relay cell after decryption. This currently can't be implemented
         as a part of the unpack() function because the data must first be decrypted.
         """
-        headers = struct.unpack('>BHH4sH', self.data[:11])
-        self.data = self.data[11:]
+        command, recognized, stream_id, digest, length = relay_header.unpack_from(
+            self.data)
 
-        if len(self.data) < headers[4] or headers[1]:
+        if length > len(self.data) - relay_header.size or recognized:
             raise CellError('Invalid relay packet (possibly not from this OR).')
 
-        try:
-            text = relay_commands[headers[0]]
-        except IndexError:
+        if command >= len(relay_commands):
             raise CellError('Invalid relay packet command.')
 
-        self.data = {
-            'command': headers[0],
-            'command_text': text,
-            'recognized': headers[1],
-            'stream_id': headers[2],
-            'digest': headers[3],
-            'length': headers[4],
-            'data': self.data[:headers[4]]
-        }
+        self.command = command
+        self.stream_id = stream_id
+        self.digest = digest
+        self.payload = self.data[relay_header.size:relay_header.size + length]
 
-    def pack(self, data):
-        return super(Relay, self).pack(self.data)
+    def pack(self, data, codec=default_codec):
+        return super(Relay, self).pack(self.data, codec)
 
-    def init_relay(self, data):
+    def init_relay(self, command, stream_id=0, payload=None):
         """
-        Set the relay cell data.
+        Set the relay header and payload of a cell we're going to send.
         """
-        self.data = data
+        self.command = command
+        self.stream_id = stream_id
+        self.digest = b'\x00' * 4
+        self.payload = payload or b''
 
 class Padding(FixedCell):
     """
     Padding cell.
     """
+    __slots__ = ()
+
     cell_type = 0
 
 class Destroy(FixedCell):
     """
     Destroy cell.
     """
+    __slots__ = ()
+
     cell_type = 4
 
     def unpack(self, data):
         super(Destroy, self).unpack(data)
 
-        reason = struct.unpack('>B', self.data[0])[0]
+        reason = bytearray(self.data[:1])[0]
         reasons = [
             'No reason given.', 'Tor protocol violation.', 'Internal error.',
             'A client sent a TRUNCATE command.',
@@ -179,20 +266,24 @@ class CreateFast(FixedCell):
     """
     CreateFast cell.
     """
+    __slots__ = ('key_material',)
+
     cell_type = 5
 
     def __init__(self, circuit_id=None):
         super(CreateFast, self).__init__(circuit_id=circuit_id)
         self.key_material = os.urandom(20)
 
-    def pack(self, data):
-        data = struct.pack('>20s', self.key_material)
-        return super(CreateFast, self).pack(data)
+    def pack(self, data, codec=default_codec):
+        data = create_fast_body.pack(self.key_material)
+        return super(CreateFast, self).pack(data, codec)
 
 class CreatedFast(FixedCell):
     """
     CreatedFast cell.
     """
+    __slots__ = ('key_material', 'derivative_key')
+
     cell_type = 6
 
     def unpack(self, data):
@@ -200,12 +291,14 @@ class CreatedFast(FixedCell):
         Unpack the key material.
         """
         super(CreatedFast, self).unpack(data)
-        self.key_material, self.derivative_key = struct.unpack('>20s20s', self.data[:40])
+        self.key_material, self.derivative_key = created_fast_body.unpack_from(self.data)
 
 class Versions(VariableCell):
     """
     Versions cell.
     """
+    __slots__ = ('versions',)
+
     cell_type = 7
 
     def unpack(self, data):
@@ -215,17 +308,20 @@ class Versions(VariableCell):
         super(Versions, self).unpack(data)
         self.versions = struct.unpack('>' + 'H' * int(len(self.data) / 2), self.data)
 
-    def pack(self, data):
+    def pack(self, data, codec=default_codec):
         """
-        Pack our known versions.
+        Pack our known versions. VERSIONS cells always have 2 byte circuit ids, whatever
+        the connection has negotiated.
         """
-        data = struct.pack('>HH', 3,4)
-        return super(Versions, self).pack(data)
+        data = struct.pack('>' + 'H' * len(versions), *versions)
+        return super(Versions, self).pack(data, default_codec)
 
 class Netinfo(FixedCell):
     """
     Netinfo cell.
     """
+    __slots__ = ('our_address', 'router_addresses')
+
     cell_type = 8
 
     def unpack(self, data):
@@ -235,7 +331,7 @@ class Netinfo(FixedCell):
         super(Netinfo, self).unpack(data)
 
         data = self.data
-        time = struct.unpack('>I', data[:4])[0]
+        time = netinfo_time.unpack_from(data)[0]
         data = data[4:]
 
         # decode our IP address
@@ -258,7 +354,7 @@ class Netinfo(FixedCell):
         """
         Decode IPv4 and IPv6 addresses.
         """
-        host_type, size = struct.unpack('>BB', data[:2])
+        host_type, size = address_header.unpack_from(data)
         data = data[2:]
 
         address = struct.unpack('>%ds' % size, data[:size])[0]
@@ -273,55 +369,63 @@ class Netinfo(FixedCell):
 
         return host_type, address, data
 
-    def pack(self, data):
+    def pack(self, data, codec=default_codec):
         """
         Pack our own netinfo.
         """
         ips = data
 
-        data  = struct.pack('>I', int(time()))
+        data  = netinfo_time.pack(int(time()))
         data += self.encode_ip(ips['other'])
         data += struct.pack('>B', 1)
         data += self.encode_ip(ips['me'])
 
-        return super(Netinfo, self).pack(data)
+        return super(Netinfo, self).pack(data, codec)
 
     def encode_ip(self, ip):
         """
         Encode an IPv4 address.
         """
-        return struct.pack('>BB', 4, 4) + socket.inet_aton(ip)
+        return address_header.pack(4, 4) + socket.inet_aton(ip)
 
 class RelayEarly(Relay):
     """
     RelayEarly cell.
     """
+    __slots__ = ()
+
     cell_type = 9
 
 class Create2(FixedCell):
     """
     Create2 cell.
     """
+    __slots__ = ()
+
     cell_type = 10
 
-    def pack(self, data):
-        data = struct.pack('>HH', 0x2, len(data)) + data
-        return super(Create2, self).pack(data)
+    def pack(self, data, codec=default_codec):
+        data = create2_header.pack(0x2, len(data)) + data
+        return super(Create2, self).pack(data, codec)
 
 class Created2(FixedCell):
     """
     Created2 cell.
     """
+    __slots__ = ('Y', 'auth')
+
     cell_type = 11
 
     def unpack(self, data):
         super(Created2, self).unpack(data)
-        length, self.Y, self.auth = struct.unpack('>H32s32s', data[:66])
+        length, self.Y, self.auth = created2_body.unpack_from(self.data)
 
 class Certs(VariableCell):
     """
     Certs cell.
     """
+    __slots__ = ('certs',)
+
     cell_type = 129
 
     def unpack(self, data):
@@ -344,7 +448,7 @@ class Certs(VariableCell):
         self.certs = {}
         for _ in range(num_certs):
             # get cert type and length
-            cert_info = struct.unpack('>BH', data[:3])
+            cert_info = cert_header.unpack_from(data)
             data = data[3:]
 
             # unpack the cert
@@ -371,6 +475,8 @@ class AuthChallenge(VariableCell):
     """
     AuthChallenge cell.
     """
+    __slots__ = ()
+
     cell_type = 130
 
     def unpack(self, data):
@@ -379,7 +485,7 @@ class AuthChallenge(VariableCell):
         """
         super(AuthChallenge, self).unpack(data)
 
-        struct.unpack('>32sH', self.data[:34])
+        auth_challenge_header.unpack_from(self.data)
 
 def cell_type_to_name(cell_type):
     """
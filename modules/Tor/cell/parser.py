@@ -3,57 +3,96 @@ import struct
 import logging
 log = logging.getLogger(__name__)
 
-def parse_cell(in_buffer, _cell=None):
+length_header = struct.Struct('>H')
+
+class CellFramer(object):
     """
-    Parses a cell. Returns the new input buffer, the cell, whether or not the cell
-    is completely read and whether it needs more data.
+    Splits the byte stream from an OR connection into cells.
+
+    feed() walks the received data with a read offset and yields every complete cell
+    in it, with the cell bodies unpacked from memoryview slices of the data rather
+    than from copies. Only an incomplete cell at the end is copied and kept for the
+    next call, and the next call only copies as much of the new data as it needs to
+    finish that cell off.
+
+    Headers are parsed with the connection's codec. It is looked up for every cell, so
+    a version negotiated part way through a read applies to the rest of it.
     """
-    ready = False
-
-    # If the cell is None, then this is a new cell. Parse the entire header to determine
-    # cell type and circuit id.
-    if not _cell:
-        if cell.proto_version < 4 and len(in_buffer) < 3:
-            return in_buffer, _cell, ready, False
-        elif cell.proto_version == 4 and len(in_buffer) < 5:
-            return in_buffer, _cell, ready, False
-
-        if cell.proto_version < 4:
-            header = struct.unpack('>HB', in_buffer[:3])
-            in_buffer = in_buffer[3:]
-        else:
-            header = struct.unpack('>IB', in_buffer[:5])
-            in_buffer = in_buffer[5:]
+    def __init__(self, codec):
+        self.codec = codec
+        self.partial = b''
+
+    def frame(self, view, offset):
+        """
+        Parses the header of the cell at offset. Returns the cell class, circuit id,
+        body offset and end offset, or None if the header isn't all there yet.
+        """
+        header = self.codec.header
+
+        if len(view) - offset < header.size:
+            return None
 
-        if header[1] in cell.cell_types:
-            _cell = cell.cell_types[header[1]](header[0])
+        circuit_id, cell_type = header.unpack_from(view, offset)
+
+        if cell_type not in cell.cell_types:
+            log.warning('received unknown cell type: %d.' % cell_type)
+            raise cell.CellError('Unknown cell type: %d.' % cell_type)
+
+        cell_class = cell.cell_types[cell_type]
+        start = offset + header.size
+
+        if cell_class.fixed:
+            end = start + 509
         else:
-            log.warning('received unknown cell type: %d.' % header[1])
-            raise cell.CellError('Unknown cell type: %d.' % header[1])
-
-        log.debug('received cell header type %s' % cell.cell_type_to_name(header[1]))
-    # Parse a fixed cell, just read in 509 bytes.
-    elif _cell and _cell.fixed:
-        if len(in_buffer) < 509:
-            return in_buffer, _cell, ready, False
-
-        _cell.unpack(in_buffer[:509])
-        in_buffer = in_buffer[509:]
-        ready = True
-    # Read length of a variable length cell.
-    elif _cell and not _cell.fixed and not _cell.has_len():
-        if len(in_buffer) < 2:
-            return in_buffer, _cell, ready, False
-
-        _cell.len(in_buffer[:2])
-        in_buffer = in_buffer[2:]
-    # Parse the variable length cell.
-    elif _cell and not _cell.fixed:
-        if len(in_buffer) < _cell.len():
-            return in_buffer, _cell, ready, False
-
-        _cell.unpack(in_buffer[:_cell.len()])
-        in_buffer = in_buffer[_cell.len():]
-        ready = True
-
-    return in_buffer, _cell, ready, True
+            if len(view) - start < length_header.size:
+                return None
+
+            end = start + length_header.size + length_header.unpack_from(view, start)[0]
+            start += length_header.size
+
+        return cell_class, circuit_id, start, end
+
+    def cell(self, view, framed):
+        """
+        Creates and unpacks a framed cell.
+        """
+        cell_class, circuit_id, start, end = framed
+
+        c = cell_class.acquire(circuit_id)
+        if not c.fixed:
+            c.length = end - start
+        c.unpack(view[start:end])
+        return c
+
+    def feed(self, data):
+        """
+        Adds received data and yields the complete cells. The bodies may be views into
+        data, so cells must be handled before data is reused.
+        """
+        data = memoryview(data)
+        offset = 0
+
+        if self.partial:
+            # Work out how big the pending cell is, the header is enough for that.
+            head = memoryview(self.partial + data[:7].tobytes())
+            framed = self.frame(head, 0)
+
+            if not framed or framed[3] - len(self.partial) > len(data):
+                self.partial += data.tobytes()
+                return
+
+            offset = framed[3] - len(self.partial)
+            view = memoryview(self.partial + data[:offset].tobytes())
+            self.partial = b''
+
+            yield self.cell(view, framed)
+
+        while offset < len(data):
+            framed = self.frame(data, offset)
+
+            if not framed or framed[3] > len(data):
+                self.partial = data[offset:].tobytes()
+                break
+
+            offset = framed[3]
+            yield self.cell(data, framed)
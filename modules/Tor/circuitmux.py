@@ -0,0 +1,166 @@
+from collections import deque
+import heapq
+import itertools
+import math
+import logging
+log = logging.getLogger(__name__)
+
+try:
+    from time import monotonic as now
+except ImportError:
+    from time import time as now
+
+class CircuitQueue(object):
+    """
+    Cells waiting to go out on one circuit, with its activity average and queue depth
+    counters. Entries are (data, count), count being the number of cells in data.
+    """
+    __slots__ = ('circuit_id', 'cells', 'depth', 'ewma', 'active', 'closing',
+        'max_depth', 'queued', 'sent')
+
+    def __init__(self, circuit_id):
+        self.circuit_id = circuit_id
+        self.cells = deque()
+        self.depth = 0
+        self.ewma = 0.0
+        self.active = False
+        self.closing = False
+        self.max_depth = 0
+        self.queued = 0
+        self.sent = 0
+
+class CircuitMux(object):
+    """
+    Decides which circuit's cells go out next on an OR connection, the way tor's EWMA
+    circuitmux does. Cells are queued per circuit and each circuit keeps an
+    exponentially weighted count of the cells it has sent recently, decaying with
+    halflife. The circuit with the lowest count goes first, so a circuit that only sends
+    the odd cell isn't stuck behind one that is busy with a bulk transfer.
+
+    Rather than decaying every circuit's count as time passes, new cells are counted
+    with a weight that grows at the decay rate. That orders circuits the same way, and
+    every count is scaled back down once the weights get large.
+    """
+
+    # Seconds for a circuit's activity count to decay to half.
+    halflife = 30.0
+
+    def __init__(self):
+        self.circuits = {}
+        self.active = []
+        self.counter = itertools.count()
+        self.epoch = now()
+        self.rate = math.log(2) / self.halflife
+        self.queued = 0
+
+    def __len__(self):
+        return self.queued
+
+    def append(self, circuit_id, data, count=1):
+        """
+        Queues packed cells on a circuit, data holds count cells. A batch of cells is
+        sent as a whole but weighs as much as its cells.
+        """
+        queue = self.circuits.get(circuit_id)
+        if queue is None:
+            queue = self.circuits[circuit_id] = CircuitQueue(circuit_id)
+
+        queue.cells.append((data, count))
+        queue.depth += count
+        queue.queued += count
+        self.queued += count
+
+        if queue.depth > queue.max_depth:
+            queue.max_depth = queue.depth
+
+        if not queue.active:
+            queue.active = True
+            heapq.heappush(self.active, (queue.ewma, next(self.counter), queue))
+
+    def pop(self, count):
+        """
+        Takes about count cells off the queues, one entry at a time from the circuit
+        with the lowest activity count. A batch is never split, so it can go over.
+        """
+        cells = []
+        weight = self.weight()
+        active = self.active
+
+        while active and count > 0:
+            queue = heapq.heappop(active)[2]
+
+            data, n = queue.cells.popleft()
+            cells.append(data)
+            count -= n
+
+            queue.depth -= n
+            queue.sent += n
+            queue.ewma += weight * n
+            self.queued -= n
+
+            if queue.cells:
+                heapq.heappush(active, (queue.ewma, next(self.counter), queue))
+            else:
+                queue.active = False
+                if queue.closing:
+                    del self.circuits[queue.circuit_id]
+
+        return cells
+
+    def weight(self):
+        """
+        Returns the weight of a cell sent now, rescaling every count first if the
+        weights have grown too large.
+        """
+        elapsed = now() - self.epoch
+
+        if elapsed * self.rate > 50:
+            self.rescale(math.exp(-elapsed * self.rate))
+            elapsed = 0.0
+
+        return math.exp(elapsed * self.rate)
+
+    def rescale(self, factor):
+        """
+        Scales every count down by factor and moves the epoch up to now.
+        """
+        self.epoch = now()
+
+        for queue in self.circuits.values():
+            queue.ewma *= factor
+
+        # In place, pop() may be holding on to the list.
+        self.active[:] = [ (entry[2].ewma, entry[1], entry[2]) for entry in self.active ]
+        heapq.heapify(self.active)
+
+    def forget(self, circuit_id):
+        """
+        Drops a circuit that's gone. Cells it still has queued, like its DESTROY, are
+        sent first.
+        """
+        queue = self.circuits.get(circuit_id)
+        if queue is None:
+            return
+
+        if queue.active:
+            queue.closing = True
+        else:
+            del self.circuits[circuit_id]
+
+    def clear(self):
+        """
+        Drops everything, the connection has closed.
+        """
+        self.circuits = {}
+        self.active = []
+        self.queued = 0
+
+    def stats(self):
+        """
+        Returns the queue depth counters for each circuit as a dict of circuit id to
+        (queue depth, deepest queue, cells queued, cells sent).
+        """
+        stats = {}
+        for circuit_id, queue in self.circuits.items():
+            stats[circuit_id] = (queue.depth, queue.max_depth, queue.queued, queue.sent)
+        return stats
@@ -7,8 +7,12 @@ from cryptography.hazmat.primitives.kdf.hkdf import HKDFExpand
 from cryptography.hazmat.backends import default_backend
 import curve25519
 
+from collections import deque
+import threading
 import struct
 import base64
+import logging
+log = logging.getLogger(__name__)
 
 bend = default_backend()
 
@@ -29,12 +33,222 @@ def hkdf(key, length=16, info=''):
     hkdf = HKDFExpand(algorithm=SHA256(), length=length, info=info, backend=bend)
     return hkdf.derive(key)
 
+def kdf_tor(key, length):
+    """
+    KDF-TOR (5.2.1), K = H(K0 | [00]) | H(K0 | [01]) | ... with SHA1.
+    """
+    out = b''
+    i = 0
+    while len(out) < length:
+        out += sha1(key + struct.pack('>B', i))
+        i += 1
+    return out[:length]
+
 def hash_func(shared):
     return shared
 
-class NtorError(Exception):
+class HandshakeError(Exception):
+    pass
+
+class NtorError(HandshakeError):
     pass
 
+def generate_keypair():
+    """
+    KEYGEN() for ntor, returns the private key and the serialized public key.
+    """
+    x = curve25519.Private()
+    return x, x.get_public().serialize()
+
+class KeyPool(object):
+    """
+    Pool of pre-generated ephemeral curve25519 keypairs so that starting an ntor
+    handshake doesn't have to generate one. Once the pool drops below low_watermark a
+    background thread tops it back up to high_watermark. hits and misses count the
+    keypairs served from the pool and the ones that had to be generated on the spot.
+    """
+    def __init__(self, low_watermark=8, high_watermark=32):
+        self.low_watermark = low_watermark
+        self.high_watermark = high_watermark
+
+        self.keys = deque()
+        self.hits = 0
+        self.misses = 0
+
+        self.wanted = threading.Event()
+        self.thread = None
+
+    def get(self):
+        """
+        Take a keypair from the pool, generating one if the pool is empty.
+        """
+        try:
+            key = self.keys.popleft()
+            self.hits += 1
+        except IndexError:
+            key = generate_keypair()
+            self.misses += 1
+
+        if len(self.keys) < self.low_watermark:
+            self.refill()
+
+        return key
+
+    def refill(self):
+        """
+        Wake up the background thread, starting it if needed.
+        """
+        self.wanted.set()
+
+        if not self.thread:
+            self.thread = threading.Thread(target=self.run, name='ntor-key-pool')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        while True:
+            self.wanted.wait()
+            self.wanted.clear()
+
+            while len(self.keys) < self.high_watermark:
+                self.keys.append(generate_keypair())
+
+            log.debug('ntor key pool refilled, %d hits, %d misses.' % (self.hits,
+                self.misses))
+
+    def stats(self):
+        return { 'size': len(self.keys), 'hits': self.hits, 'misses': self.misses }
+
+# Ephemeral keypairs for ntor handshakes.
+key_pool = KeyPool()
+
+# Decoded key material for the nodes we have extended to, see node_keys().
+node_key_cache = {}
+
+def node_keys(node):
+    """
+    Returns a node's identity digest and ntor onion key, decoded from base64 once and
+    then cached.
+    """
+    key = (node['identity'], node['ntor-onion-key'])
+
+    try:
+        return node_key_cache[key]
+    except KeyError:
+        pass
+
+    # Keys get rotated, don't hold on to old ones forever.
+    if len(node_key_cache) >= 16384:
+        node_key_cache.clear()
+
+    keys = node_key_cache[key] = (b64decode(node['identity']),
+        b64decode(node['ntor-onion-key']))
+    return keys
+
+def ntor_derive(x, X, B, identity, Y, auth):
+    """
+    The client side of the ntor key agreement (5.1.4), split out of ntor so that it
+    can run in a worker pool. Takes our keypair, the server's onion key, its identity
+    digest and its reply, all as bytes, and returns the 72 bytes of key material.
+
+    Raises NtorError if the server's auth doesn't check out.
+    """
+    protoid = b'ntor-curve25519-sha256-1'
+
+    x = curve25519.Private(secret=x)
+    B_key = curve25519.Public(B)
+
+    # The server's handshake reply is:
+    # SERVER_PK   Y                       [G_LENGTH bytes]
+    # AUTH        H(auth_input, t_mac)    [H_LENGTH bytes]
+
+    # The client then checks Y is in G^* [see NOTE below], and computes
+
+    # secret_input = EXP(Y,x) | EXP(B,x) | ID | B | X | Y | PROTOID
+    si  = x.get_shared_key(curve25519.Public(Y), hash_func)
+    si += x.get_shared_key(B_key, hash_func)
+    si += identity + B + X + Y + protoid
+
+    # KEY_SEED = H(secret_input, t_key)
+    # verify = H(secret_input, t_verify)
+    key_seed = hmac(protoid + b':key_extract', si)
+    verify = hmac(protoid + b':verify', si)
+
+    # auth_input = verify | ID | B | Y | X | PROTOID | "Server"
+    ai = verify + identity + B + Y + X + protoid + b'Server'
+
+    # The client verifies that AUTH == H(auth_input, t_mac).
+    if auth != hmac(protoid + b':mac', ai):
+        raise NtorError('auth input does not match.')
+
+    # Both parties check that none of the EXP() operations produced the
+    # point at infinity. [NOTE: This is an adequate replacement for
+    # checking Y for group membership, if the group is curve25519.]
+
+    # Both parties now have a shared value for KEY_SEED.  They expand this
+    # into the keys needed for the Tor relay protocol, using the KDF
+    # described in 5.2.2 and the tag m_expand.
+
+    # 5.2.2. KDF-RFC5869
+
+    # For newer KDF needs, Tor uses the key derivation function HKDF from
+    # RFC5869, instantiated with SHA256.  (This is due to a construction
+    # from Krawczyk.)  The generated key material is:
+
+    #     K = K_1 | K_2 | K_3 | ...
+
+    #     Where H(x,t) is HMAC_SHA256 with value x and key t
+    #       and K_1     = H(m_expand | INT8(1) , KEY_SEED )
+    #       and K_(i+1) = H(K_i | m_expand | INT8(i+1) , KEY_SEED )
+    #       and m_expand is an arbitrarily chosen value,
+    #       and INT8(i) is a octet with the value "i".
+
+    # In RFC5869's vocabulary, this is HKDF-SHA256 with info == m_expand,
+    # salt == t_key, and IKM == secret_input.
+    return hkdf(key_seed, length=72, info=protoid + b':key_expand')
+
+class Hop(object):
+    """
+    The relay crypto state of one hop in a circuit, set up from its key material. The
+    cipher update functions are bound once here since they're called for every cell
+    that passes through the hop.
+    """
+    __slots__ = ('node', 'send_digest', 'recv_digest', 'encrypt', 'decrypt')
+
+    def __init__(self, node, Df, Db, Kf, Kb):
+        self.node = node
+
+        self.send_digest = Hash(SHA1(), backend=bend)
+        self.send_digest.update(Df)
+        self.recv_digest = Hash(SHA1(), backend=bend)
+        self.recv_digest.update(Db)
+
+        self.encrypt = Cipher(AES(Kf), CTR(b'\x00' * 16), backend=bend).encryptor().update
+        self.decrypt = Cipher(AES(Kb), CTR(b'\x00' * 16), backend=bend).decryptor().update
+
+    def recognize(self, body, offset=0):
+        """
+        Checks whether the decrypted relay cell body at offset is meant for this hop.
+        The recognized field has to be zero, which rules out nearly every cell that
+        isn't, before the digest is checked. Returns the running digest including the
+        cell if it is ours, None otherwise.
+        """
+        if body[offset + 1:offset + 3] != b'\x00\x00':
+            return None
+
+        view = memoryview(body)
+
+        # The digest covers the cell with its own digest field zeroed.
+        digest = self.recv_digest.copy()
+        digest.update(view[offset:offset + 5])
+        digest.update(b'\x00' * 4)
+        digest.update(view[offset + 9:offset + 509])
+
+        if digest.copy().finalize()[:4] != body[offset + 5:offset + 9]:
+            return None
+
+        return digest
+
 class ntor(object):
     def __init__(self, node):
         # 5.1.4. The "ntor" handshake
@@ -80,79 +294,35 @@ class ntor(object):
         # key) for that server. Call the ntor onion key "B".  The client
         # generates a temporary keypair:
         #     x,X = KEYGEN()
-        self.x = curve25519.Private()
-        self.X = self.x.get_public()
+        # which we take from the pre-generated pool.
+        self.x, self.X = key_pool.get()
 
-        self.B = curve25519.Public(b64decode(self.node['ntor-onion-key']))
+        self.identity, self.B = node_keys(self.node)
 
         # and generates a client-side handshake with contents:
         #   NODEID      Server identity digest  [ID_LENGTH bytes]
         #   KEYID       KEYID(B)                [H_LENGTH bytes]
         #   CLIENT_PK   X                       [G_LENGTH bytes]
-        self.handshake  = b64decode(self.node['identity'])
-        self.handshake += self.B.serialize()
-        self.handshake += self.X.serialize()
+        self.handshake = self.identity + self.B + self.X
 
     def complete_handshake(self, Y, auth):
-        # The server's handshake reply is:
-        # SERVER_PK   Y                       [G_LENGTH bytes]
-        # AUTH        H(auth_input, t_mac)    [H_LENGTH bytes]
-
-        # The client then checks Y is in G^* [see NOTE below], and computes
-
-        # secret_input = EXP(Y,x) | EXP(B,x) | ID | B | X | Y | PROTOID
-        si  = self.x.get_shared_key(curve25519.Public(Y), hash_func)
-        si += self.x.get_shared_key(self.B, hash_func)
-        si += b64decode(self.node['identity'])
-        si += self.B.serialize()
-        si += self.X.serialize()
-        si += Y
-        si += 'ntor-curve25519-sha256-1'
-
-        # KEY_SEED = H(secret_input, t_key)
-        # verify = H(secret_input, t_verify)
-        key_seed = hmac(self.t_key, si)
-        verify = hmac(self.t_verify, si)
-
-        # auth_input = verify | ID | B | Y | X | PROTOID | "Server"
-        ai = verify
-        ai += b64decode(self.node['identity'])
-        ai += self.B.serialize()
-        ai += Y
-        ai += self.X.serialize()
-        ai += self.protoid
-        ai += 'Server'
-
-        # The client verifies that AUTH == H(auth_input, t_mac).
-        if auth != hmac(self.t_mac, ai):
-            raise NtorError('auth input does not match.')
-
-        # Both parties check that none of the EXP() operations produced the
-        # point at infinity. [NOTE: This is an adequate replacement for
-        # checking Y for group membership, if the group is curve25519.]
-
-        # Both parties now have a shared value for KEY_SEED.  They expand this
-        # into the keys needed for the Tor relay protocol, using the KDF
-        # described in 5.2.2 and the tag m_expand.
-
-        # 5.2.2. KDF-RFC5869
-
-        # For newer KDF needs, Tor uses the key derivation function HKDF from
-        # RFC5869, instantiated with SHA256.  (This is due to a construction
-        # from Krawczyk.)  The generated key material is:
-
-        #     K = K_1 | K_2 | K_3 | ...
-
-        #     Where H(x,t) is HMAC_SHA256 with value x and key t
-        #       and K_1     = H(m_expand | INT8(1) , KEY_SEED )
-        #       and K_(i+1) = H(K_i | m_expand | INT8(i+1) , KEY_SEED )
-        #       and m_expand is an arbitrarily chosen value,
-        #       and INT8(i) is a octet with the value "i".
-
-        # In RFC5869's vocabulary, this is HKDF-SHA256 with info == m_expand,
-        # salt == t_key, and IKM == secret_input.
-        keys = hkdf(key_seed, length=72, info=self.m_expand)
-
+        """
+        Finish the handshake with the server's reply.
+        """
+        self.finish(ntor_derive(*self.derive_args(Y, auth)))
+
+    def derive_args(self, Y, auth):
+        """
+        Arguments for ntor_derive() given the server's reply. They are all plain bytes so
+        that the key agreement can be handed to a worker thread or process.
+        """
+        return (self.x.serialize(), self.X, self.B, self.identity, Y, auth)
+
+    def finish(self, keys):
+        """
+        Set up the hop's digests and ciphers from the key material returned by
+        ntor_derive(), the hop is left in self.hop.
+        """
         # When used in the ntor handshake, the first HASH_LEN bytes form the
         # forward digest Df; the next HASH_LEN form the backward digest Db; the
         # next KEY_LEN form Kf, the next KEY_LEN form Kb, and the final
@@ -164,23 +334,34 @@ class ntor(object):
         del self.X
         del self.x
         del self.B
-        del key_seed
         del keys
-        del verify
-        del ai
-        del auth
-        del si
-        del Y
 
-        self.send_digest = Hash(SHA1(), backend=bend)
-        self.send_digest.update(Df)
-        self.recv_digest = Hash(SHA1(), backend=bend)
-        self.recv_digest.update(Db)
-
-        self.encrypt = Cipher(AES(Kf), CTR('\x00' * 16), backend=bend).encryptor()
-        self.decrypt = Cipher(AES(Kb), CTR('\x00' * 16), backend=bend).decryptor()
+        self.hop = Hop(self.node, Df, Db, Kf, Kb)
 
     def get_handshake(self):
         return self.handshake
 
+class create_fast(object):
+    """
+    The CREATE_FAST handshake (5.1.3) for the first hop. There's no public key work,
+    the keys come from our and the guard's random key material, so it relies on the
+    TLS link for secrecy.
+    """
+    def __init__(self, node, X):
+        self.node = node
+        self.X = X
+
+    def complete_handshake(self, Y, KH):
+        """
+        Derive the hop's keys from the guard's CREATED_FAST reply. The derivative key KH
+        it sends back has to match ours.
+        """
+        # K0 = X | Y, expanded with KDF-TOR into KH | Df | Db | Kf | Kb.
+        keys = kdf_tor(self.X + Y, 92)
+        if keys[:20] != KH:
+            raise HandshakeError('CREATED_FAST derivative key does not match.')
+
+        Df, Db, Kf, Kb = struct.unpack('>20s20s16s16s', keys[20:])
+        del self.X
 
+        self.hop = Hop(self.node, Df, Db, Kf, Kb)
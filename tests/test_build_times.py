@@ -0,0 +1,100 @@
+"""
+Run from the repository root:
+
+    python -m unittest tests.test_build_times
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from modules.Tor.build_times import CircuitBuildTimes
+
+def pareto(xm, alpha, n):
+    """
+    Returns n build times in seconds spread evenly over the quantiles of a Pareto
+    distribution, so the estimate doesn't depend on chance.
+    """
+    return [ xm / (1 - (i + 0.5) / n) ** (1 / alpha) for i in range(n) ]
+
+class CircuitBuildTimesTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.times = CircuitBuildTimes(os.path.join(self.dir, 'build_times'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_initial_timeout(self):
+        """
+        The initial timeout holds until min_builds builds have completed.
+        """
+        for seconds in pareto(1.0, 1.5, self.times.min_builds - 1):
+            self.times.add(seconds)
+
+        self.assertEqual(self.times.timeout(), self.times.initial_timeout)
+
+    def test_timeout_matches_distribution(self):
+        """
+        The learned timeout is close to the distribution's quantile cutoff, Xm over
+        (1 - quantile) ** (1 / alpha).
+        """
+        for seconds in pareto(1.0, 1.5, 1000):
+            self.times.add(seconds)
+
+        self.assertAlmostEqual(self.times.xm(), 1010, delta=10)
+        self.assertAlmostEqual(self.times.timeout(), 1.0 / 0.2 ** (1 / 1.5), delta=0.15)
+
+    def test_min_timeout(self):
+        """
+        Fast builds don't bring the timeout below min_timeout.
+        """
+        for seconds in pareto(0.1, 3.0, 1000):
+            self.times.add(seconds)
+
+        self.assertEqual(self.times.timeout(), self.times.min_timeout)
+
+    def test_abandoned_builds_raise_timeout(self):
+        """
+        Abandoned builds are censored, they make the estimated tail heavier.
+        """
+        for seconds in pareto(1.0, 1.5, 800):
+            self.times.add(seconds)
+        timeout = self.times.timeout()
+
+        for _ in range(200):
+            self.times.add_abandoned(timeout)
+
+        self.assertGreater(self.times.timeout(), timeout)
+
+    def test_abandoned_builds_age_out(self):
+        """
+        Completed and abandoned builds share one window, old abandoned builds drop out
+        of it as new builds complete.
+        """
+        for _ in range(100):
+            self.times.add_abandoned(60.0)
+        for seconds in pareto(1.0, 1.5, self.times.max_builds):
+            self.times.add(seconds)
+
+        builds, abandoned, _, _ = self.times.stats()
+        self.assertEqual((builds, abandoned), (self.times.max_builds, 0))
+
+    def test_save_and_load(self):
+        """
+        A saved histogram loads back into the same timeout, to within a bin.
+        """
+        for seconds in pareto(1.0, 1.5, 900):
+            self.times.add(seconds)
+        for _ in range(100):
+            self.times.add_abandoned(3.0)
+        self.times.save()
+
+        loaded = CircuitBuildTimes(self.times.path)
+        loaded.load()
+
+        self.assertEqual(loaded.stats()[:2], (900, 100))
+        self.assertAlmostEqual(loaded.timeout(), self.times.timeout(), delta=0.05)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+"""
+Run from the repository root:
+
+    python -m unittest tests.test_cell
+"""
+import struct
+import unittest
+
+from modules.Tor.cell import cell
+from modules.Tor.cell.parser import CellFramer
+
+def fixed(circuit_id, cell_type, body=b''):
+    return struct.pack('>IB509s', circuit_id, cell_type, body)
+
+class CellFramerTest(unittest.TestCase):
+    def setUp(self):
+        self.framer = CellFramer(cell.CellCodec(4))
+
+    def feed(self, *chunks):
+        cells = []
+        for chunk in chunks:
+            cells.extend(self.framer.feed(chunk))
+        return cells
+
+    def test_cells_in_one_read(self):
+        """
+        Every complete cell in a read is framed, in order.
+        """
+        data = fixed(1, 0) + fixed(2, 3, b'relay') + fixed(3, 0)
+        cells = self.feed(data)
+
+        self.assertEqual([ (c.__class__, c.circuit_id) for c in cells ], [
+            (cell.Padding, 1), (cell.Relay, 2), (cell.Padding, 3) ])
+        self.assertEqual(bytes(cells[1].data[:5]), b'relay')
+
+    def test_split_cell(self):
+        """
+        A cell split across reads, header and all, comes out once it's complete.
+        """
+        data = fixed(1, 3, b'first') + fixed(2, 3, b'second')
+
+        for step in [ 1, 3, 100, 513, 600 ]:
+            chunks = [ data[i:i + step] for i in range(0, len(data), step) ]
+            cells = self.feed(*chunks)
+
+            self.assertEqual([ c.circuit_id for c in cells ], [ 1, 2 ])
+            self.assertEqual(bytes(cells[1].data[:6]), b'second')
+            self.assertEqual(self.framer.partial, b'')
+
+    def test_partial_cell_is_kept(self):
+        """
+        An incomplete cell at the end of a read is held back until the rest of it
+        arrives.
+        """
+        data = fixed(1, 0) + fixed(2, 0)
+
+        self.assertEqual(len(self.feed(data[:700])), 1)
+        self.assertEqual(len(self.framer.partial), 700 - 514)
+        self.assertEqual([ c.circuit_id for c in self.feed(data[700:]) ], [ 2 ])
+
+    def test_variable_length_cells(self):
+        """
+        Variable length cells are sized from their length field, whole or split.
+        """
+        versions = struct.pack('>IBH', 0, 7, 4) + struct.pack('>HH', 3, 4)
+        data = versions + fixed(5, 0) + versions
+
+        cells = self.feed(data[:5], data[5:8], data[8:530], data[530:])
+
+        self.assertEqual([ c.__class__ for c in cells ], [
+            cell.Versions, cell.Padding, cell.Versions ])
+        self.assertEqual(cells[0].versions, (3, 4))
+        self.assertEqual(cells[2].versions, (3, 4))
+
+    def test_unknown_cell_type(self):
+        """
+        An unknown cell type can't be framed, the connection can't carry on.
+        """
+        with self.assertRaises(cell.CellError):
+            self.feed(fixed(1, 200))
+
+class CellCodecTest(unittest.TestCase):
+    def test_circuit_id_width(self):
+        """
+        Each connection packs cells with the circuit id width of its own link protocol
+        version, 2 bytes before version 4 and 4 bytes from then on.
+        """
+        old, new = cell.CellCodec(3), cell.CellCodec(4)
+
+        self.assertEqual(cell.Padding(1).pack(b'', old),
+            struct.pack('>HB509s', 1, 0, b''))
+        self.assertEqual(cell.Padding(1).pack(b'', new), fixed(1, 0))
+
+        old.set_version(4)
+        self.assertEqual(cell.Padding(1).pack(b'', old), fixed(1, 0))
+        self.assertEqual(new.version, 4)
+
+    def test_versions_cell(self):
+        """
+        VERSIONS cells keep 2 byte circuit ids whatever the connection has negotiated.
+        """
+        data = cell.Versions().pack(None, cell.CellCodec(4))
+        self.assertEqual(data[:5], struct.pack('>HBH', 0, 7, len(data) - 5))
+
+    def test_framer_follows_the_connection(self):
+        """
+        The framer reads headers as wide as the connection's version says, from the
+        first cell after the version changes.
+        """
+        codec = cell.CellCodec(3)
+        framer = CellFramer(codec)
+
+        cells = list(framer.feed(struct.pack('>HB509s', 1, 0, b'')))
+        codec.set_version(4)
+        cells.extend(framer.feed(fixed(2, 3, b'relay')))
+
+        self.assertEqual([ (c.__class__, c.circuit_id) for c in cells ], [
+            (cell.Padding, 1), (cell.Relay, 2) ])
+
+class RelayFreeListTest(unittest.TestCase):
+    def setUp(self):
+        del cell.relay_free_list[:]
+
+    def test_released_cells_are_reused(self):
+        """
+        A released relay cell is handed out again, emptied.
+        """
+        c = cell.Relay.acquire(1)
+        c.data = b'data'
+        c.release()
+
+        again = cell.Relay.acquire(2)
+        self.assertIs(again, c)
+        self.assertEqual(again.circuit_id, 2)
+        self.assertIsNone(again.data)
+
+    def test_release_twice(self):
+        """
+        Releasing a cell twice only puts it on the free-list once, so it can't be
+        handed out to two users.
+        """
+        c = cell.Relay.acquire(1)
+        c.data = b'data'
+        c.release()
+        c.release()
+
+        self.assertIsNot(cell.Relay.acquire(1), cell.Relay.acquire(1))
+
+if __name__ == '__main__':
+    unittest.main()
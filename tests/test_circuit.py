@@ -0,0 +1,195 @@
+"""
+Run from the repository root:
+
+    python -m unittest tests.test_circuit
+"""
+from concurrent.futures import Future
+import os
+import unittest
+
+from core.events import Events, events
+from modules.Tor import Circuit as circuit_module
+from modules.Tor import crypto
+from modules.Tor.Circuit import Circuit
+from modules.Tor.build_times import circuit_build_times
+from modules.Tor.cell import cell
+from tests.test_crypto import relay_node, ntor_reply
+
+class Proxy(object):
+    """
+    Stands in for the connection a circuit shares its events with.
+    """
+    def __init__(self):
+        self._events = Events()
+
+class Created2(object):
+    def __init__(self, Y, auth):
+        self.Y = Y
+        self.auth = auth
+
+class OffloadTest(unittest.TestCase):
+    def setUp(self):
+        self.path = circuit_module.circuit
+        self.node, self.b = relay_node()
+        circuit_module.circuit = [ self.node ]
+
+        circuit_build_times.save = lambda: None
+
+        self.offloaded = []
+        events.register('run_in_executor', self.run_in_executor)
+
+        self.circuit = Circuit(Proxy(), 7)
+        self.circuit.offload_handshakes = True
+
+        self.initialized = []
+        self.circuit.register_local('7_circuit_initialized', self.initialized.append)
+
+    def tearDown(self):
+        events.unregister('run_in_executor', self.run_in_executor)
+        del circuit_build_times.save
+        circuit_module.circuit = self.path
+
+    def run_in_executor(self, function, callback, *args):
+        self.offloaded.append((function, callback, args))
+        return True
+
+    def reply(self):
+        """
+        The relay answers the CREATE2, the key agreement is handed to the pool and
+        its result returned in a future.
+        """
+        Y, auth, keys = ntor_reply(self.node, self.b, self.circuit.pending_ntor.X)
+        self.circuit.crypt_init_ntor(7, Created2(Y, auth))
+
+        self.assertEqual(len(self.offloaded), 1)
+        function, callback, args = self.offloaded[0]
+        self.assertIs(function, crypto.ntor_derive)
+
+        future = Future()
+        future.set_result(function(*args))
+        return callback, future
+
+    def test_handshake_finished_on_the_loop(self):
+        """
+        The circuit waits for the pool and carries on with the derived keys.
+        """
+        callback, future = self.reply()
+        self.assertEqual(self.circuit.circuit, [])
+
+        callback(future)
+
+        self.assertEqual(len(self.circuit.circuit), 1)
+        self.assertEqual(self.initialized, [ 7 ])
+
+    def test_abandoned_build(self):
+        """
+        Keys that come back for a build that was given up on in the meantime are
+        dropped.
+        """
+        callback, future = self.reply()
+        self.circuit.abandon()
+
+        callback(future)
+
+        self.assertEqual(self.circuit.circuit, [])
+        self.assertEqual(self.initialized, [])
+
+class BatchCryptTest(unittest.TestCase):
+    def setUp(self):
+        self.keys = [ (os.urandom(20), os.urandom(20), os.urandom(16), os.urandom(16))
+            for _ in range(2) ]
+
+        # The relays' side of each hop, their send digest and key are our receive
+        # ones.
+        self.relays = [ crypto.Hop({ 'name': 'relay' }, Db, Df, Kb, Kf)
+            for Df, Db, Kf, Kb in self.keys ]
+
+    def circuit(self):
+        """
+        Returns a two hop circuit set up with the test keys, and the cell bodies it
+        sends.
+        """
+        circuit = Circuit(Proxy(), 7)
+        circuit.stop_timer()
+        circuit.circuit = [ crypto.Hop({ 'name': 'relay' }, *keys) for keys in self.keys ]
+
+        sent = []
+        circuit.register_local('send_cell', lambda c: sent.append(cell.to_bytes(c.data)))
+        circuit.register_local('send_cells', lambda circuit_id, data, count:
+            sent.append(bytes(data)))
+        return circuit, sent
+
+    def test_send(self):
+        """
+        A batch is encrypted to the same bytes as the cells sent one by one, and the
+        exit recognizes every cell in it.
+        """
+        payloads = [ os.urandom(498), b'short', os.urandom(100) ]
+
+        single, single_sent = self.circuit()
+        for payload in payloads:
+            single.send_relay_cell('RELAY_DATA', 3, data=payload)
+
+        batch, batch_sent = self.circuit()
+        batch.send_relay_cells('RELAY_DATA', 3, payloads)
+
+        self.assertEqual(b''.join(single_sent), b''.join(batch_sent))
+
+        body = b''.join(batch_sent)
+        for relay in self.relays:
+            body = relay.decrypt(body)
+
+        exit = self.relays[-1]
+        for i, payload in enumerate(payloads):
+            digest = exit.recognize(body, i * cell.relay_body.size)
+            self.assertIsNotNone(digest)
+            exit.recv_digest = digest
+
+            start = i * cell.relay_body.size + cell.relay_header.size
+            self.assertEqual(body[start:start + len(payload)], payload)
+
+    def relay_cell(self, hop, stream_id, payload):
+        """
+        Packs a RELAY_DATA cell the way the relay at hop does, with its digest.
+        """
+        relay = self.relays[hop]
+
+        body = bytearray(cell.relay_body.pack(2, 0, stream_id, b'\x00' * 4,
+            len(payload), payload))
+        relay.send_digest.update(bytes(body))
+        body[5:9] = relay.send_digest.copy().finalize()[:4]
+        return bytes(body)
+
+    def test_recv(self):
+        """
+        A run of cells from different hops is decrypted in one go and each cell goes
+        to the stream it is for.
+        """
+        circuit, _ = self.circuit()
+
+        received = []
+        for stream_id in (1, 2):
+            circuit.register_local((7, stream_id, 'RELAY_DATA'), lambda circuit_id,
+                stream_id, c: received.append((stream_id, c.payload)))
+
+        # From the exit, the middle relay, then the exit again. Every cell passes
+        # through the middle relay's cipher in the order it is sent.
+        middle, exit = self.relays
+        bodies = [
+            middle.encrypt(exit.encrypt(self.relay_cell(1, 1, b'exit'))),
+            middle.encrypt(self.relay_cell(0, 2, b'middle')),
+            middle.encrypt(exit.encrypt(self.relay_cell(1, 1, b'exit again')))
+        ]
+
+        cells = []
+        for body in bodies:
+            c = cell.Relay(7)
+            c.unpack(body)
+            cells.append(c)
+
+        circuit.recv_relay_cells(7, cells)
+
+        self.assertEqual(received, [ (1, b'exit'), (2, b'middle'), (1, b'exit again') ])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+"""
+Run from the repository root:
+
+    python -m unittest tests.test_circuitmux
+"""
+import unittest
+
+from modules.Tor import circuitmux
+from modules.Tor.circuitmux import CircuitMux
+
+class CircuitMuxTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = 1000.0
+        self.now = circuitmux.now
+        circuitmux.now = lambda: self.clock
+
+    def tearDown(self):
+        circuitmux.now = self.now
+
+    def test_pop_that_rescales(self):
+        """
+        A pop that rescales the counts must leave no entries behind for the queues it
+        emptied.
+        """
+        mux = CircuitMux()
+        mux.append(1, b'a')
+        mux.append(2, b'b')
+
+        self.clock += 3000
+        self.assertEqual(sorted(mux.pop(2)), [ b'a', b'b' ])
+        self.assertEqual(mux.active, [])
+
+        mux.append(1, b'c')
+        mux.append(2, b'd')
+        self.assertEqual(sorted(mux.pop(2)), [ b'c', b'd' ])
+        self.assertEqual(len(mux), 0)
+
+if __name__ == '__main__':
+    unittest.main()
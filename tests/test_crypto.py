@@ -0,0 +1,224 @@
+"""
+Run from the repository root:
+
+    python -m unittest tests.test_crypto
+"""
+from binascii import unhexlify
+import base64
+import os
+import time
+import unittest
+
+import curve25519
+
+from modules.Tor import crypto
+from modules.Tor.cell import cell
+
+node = { 'name': 'guard' }
+
+# KDF-TOR of the bytes 0 to 39, from an implementation of tor-spec.txt 5.2.1 with
+# hashlib.
+kdf_tor_key = bytes(bytearray(range(40)))
+kdf_tor_vector = unhexlify(
+    'ee4290b7cadc050642954479851159fd567f8cf39e917161fbf90a6e0016f447e7b0c384fea2312a'
+    'cdb67f371199aade028288f642c193300a48d9e169024d75bc21fa80d52349328e7d0ce219337e74'
+    'a980c2672535f15661c9aa31')
+
+def relay_node():
+    """
+    Returns a relay's descriptor fields and its private onion key.
+    """
+    b = curve25519.Private()
+    encode = lambda key: base64.b64encode(key).rstrip(b'=').decode('ascii')
+
+    return {
+        'name': 'relay',
+        'identity': encode(os.urandom(20)),
+        'ntor-onion-key': encode(b.get_public().serialize())
+    }, b
+
+def ntor_reply(node, b, X):
+    """
+    The relay's side of the ntor handshake, returns Y, AUTH and the key material.
+    """
+    protoid = b'ntor-curve25519-sha256-1'
+    identity, B = crypto.node_keys(node)
+
+    y = curve25519.Private()
+    Y = y.get_public().serialize()
+
+    si  = y.get_shared_key(curve25519.Public(X), crypto.hash_func)
+    si += b.get_shared_key(curve25519.Public(X), crypto.hash_func)
+    si += identity + B + X + Y + protoid
+
+    key_seed = crypto.hmac(protoid + b':key_extract', si)
+    verify = crypto.hmac(protoid + b':verify', si)
+    auth = crypto.hmac(protoid + b':mac', verify + identity + B + Y + X + protoid +
+        b'Server')
+
+    return Y, auth, crypto.hkdf(key_seed, length=72, info=protoid + b':key_expand')
+
+class RecognizeTest(unittest.TestCase):
+    def setUp(self):
+        Df, Db, Kf, Kb = os.urandom(20), os.urandom(20), os.urandom(16), os.urandom(16)
+
+        self.hop = crypto.Hop(node, Df, Db, Kf, Kb)
+        # The relay's side, its send digest is our receive digest.
+        self.relay = crypto.Hop(node, Db, Df, Kb, Kf)
+
+    def relay_cell(self, payload, digest=None):
+        """
+        Packs a relay cell body the way the relay does, its digest is added to the
+        relay's running send digest.
+        """
+        body = bytearray(cell.relay_body.pack(2, 0, 1, b'\x00' * 4, len(payload),
+            payload))
+
+        self.relay.send_digest.update(bytes(body))
+        body[5:9] = digest or self.relay.send_digest.copy().finalize()[:4]
+        return bytes(body)
+
+    def test_recognized(self):
+        """
+        Cells for the hop are recognized in turn, each one moving the running digest
+        on, including cells further into a batch.
+        """
+        first, second = self.relay_cell(b'one'), self.relay_cell(b'two')
+
+        digest = self.hop.recognize(first)
+        self.assertIsNotNone(digest)
+        self.hop.recv_digest = digest
+
+        batch = os.urandom(509) + second
+        digest = self.hop.recognize(batch, 509)
+        self.assertIsNotNone(digest)
+
+    def test_not_recognized(self):
+        """
+        Cells with a non zero recognized field or a digest that doesn't match aren't
+        for this hop, and leave the running digest alone.
+        """
+        body = bytearray(self.relay_cell(b'one'))
+        body[1] = 1
+        self.assertIsNone(self.hop.recognize(bytes(body)))
+
+        self.assertIsNone(self.hop.recognize(self.relay_cell(b'two', b'\xff' * 4)))
+
+    def test_still_recognized_after_a_miss(self):
+        """
+        A cell that wasn't ours doesn't throw off the digest for the next one.
+        """
+        first = self.relay_cell(b'one')
+
+        self.assertIsNone(self.hop.recognize(os.urandom(509)))
+        self.assertIsNotNone(self.hop.recognize(first))
+
+class CreateFastTest(unittest.TestCase):
+    def test_kdf_tor(self):
+        """
+        KDF-TOR matches the known vector, and shorter outputs are its prefixes.
+        """
+        self.assertEqual(crypto.kdf_tor(kdf_tor_key, 92), kdf_tor_vector)
+        self.assertEqual(crypto.kdf_tor(kdf_tor_key, 20), kdf_tor_vector[:20])
+
+    def test_handshake(self):
+        """
+        The hop's keys are KDF-TOR(X | Y) past the derivative key, Df, Db, Kf and Kb.
+        """
+        X, Y = os.urandom(20), os.urandom(20)
+        keys = crypto.kdf_tor(X + Y, 92)
+
+        handshake = crypto.create_fast(node, X)
+        handshake.complete_handshake(Y, keys[:20])
+        hop = handshake.hop
+
+        relay = crypto.Hop(node, keys[40:60], keys[20:40], keys[76:92], keys[60:76])
+        self.assertEqual(relay.decrypt(hop.encrypt(b'forward')), b'forward')
+        self.assertEqual(hop.decrypt(relay.encrypt(b'backward')), b'backward')
+
+    def test_derivative_key_mismatch(self):
+        """
+        A CREATED_FAST whose derivative key doesn't match ours fails the handshake.
+        """
+        handshake = crypto.create_fast(node, os.urandom(20))
+
+        with self.assertRaises(crypto.HandshakeError):
+            handshake.complete_handshake(os.urandom(20), b'\x00' * 20)
+
+class NtorTest(unittest.TestCase):
+    def setUp(self):
+        self.node, self.b = relay_node()
+        self.handshake = crypto.ntor(self.node)
+
+    def test_derive(self):
+        """
+        The key agreement run on its own, as the worker pool runs it, comes up with the
+        relay's key material, and the hop set up from it talks to the relay.
+        """
+        Y, auth, keys = ntor_reply(self.node, self.b, self.handshake.X)
+
+        self.assertEqual(crypto.ntor_derive(*self.handshake.derive_args(Y, auth)), keys)
+
+        self.handshake.finish(keys)
+        hop = self.handshake.hop
+
+        relay = crypto.Hop(self.node, keys[20:40], keys[:20], keys[56:72], keys[40:56])
+        self.assertEqual(relay.decrypt(hop.encrypt(b'forward')), b'forward')
+        self.assertEqual(hop.decrypt(relay.encrypt(b'backward')), b'backward')
+
+    def test_bad_auth(self):
+        """
+        A reply whose AUTH doesn't check out fails the handshake.
+        """
+        Y, auth, keys = ntor_reply(self.node, self.b, self.handshake.X)
+
+        with self.assertRaises(crypto.NtorError):
+            crypto.ntor_derive(*self.handshake.derive_args(Y, b'\x00' * 32))
+
+class KeyPoolTest(unittest.TestCase):
+    def wait_for(self, pool, size):
+        deadline = time.time() + 5
+        while len(pool.keys) < size and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_refill(self):
+        """
+        An empty pool generates the keypair on the spot and gets topped up in the
+        background, after which keypairs come from the pool.
+        """
+        pool = crypto.KeyPool(low_watermark=2, high_watermark=4)
+
+        x, X = pool.get()
+        self.assertEqual(X, x.get_public().serialize())
+        self.assertEqual((pool.hits, pool.misses), (0, 1))
+
+        self.wait_for(pool, 4)
+        self.assertEqual(len(pool.keys), 4)
+
+        keys = list(pool.keys)
+        self.assertIs(pool.get(), keys[0])
+        self.assertIs(pool.get(), keys[1])
+        self.assertEqual((pool.hits, pool.misses), (2, 1))
+
+    def test_keypairs_are_not_reused(self):
+        """
+        Each handshake gets a keypair of its own.
+        """
+        pool = crypto.KeyPool(low_watermark=2, high_watermark=4)
+
+        keys = [ pool.get()[1] for _ in range(10) ]
+        self.assertEqual(len(set(keys)), 10)
+
+    def test_node_keys_are_cached(self):
+        """
+        A node's keys are decoded once and then handed out from the cache.
+        """
+        node, b = relay_node()
+
+        identity, B = crypto.node_keys(node)
+        self.assertEqual(len(identity), 20)
+        self.assertEqual(B, b.get_public().serialize())
+        self.assertIs(crypto.node_keys(dict(node)), crypto.node_keys(node))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+"""
+Run from the repository root:
+
+    python -m unittest tests.test_events
+"""
+import unittest
+
+from core.events import Events
+
+class EventHandleTest(unittest.TestCase):
+    def setUp(self):
+        self.events = Events()
+        self.calls = []
+
+    def callback(self, *args):
+        self.calls.append(args)
+
+    def test_handle_sees_registrations(self):
+        """
+        A handle fires the callbacks registered for its event, including ones registered
+        or unregistered by name after it was taken.
+        """
+        handle = self.events.handle((1, 'Relay'))
+        handle(1)
+        self.assertEqual(self.calls, [])
+
+        self.events.register((1, 'Relay'), self.callback)
+        handle(2)
+        self.events.trigger((1, 'Relay'), 3)
+
+        self.events.unregister((1, 'Relay'), self.callback)
+        handle(4)
+
+        self.assertEqual(self.calls, [ (2,), (3,) ])
+
+    def test_handles_are_shared(self):
+        """
+        Every handle for an event is the same object, counting its holders.
+        """
+        first = self.events.handle('send_cell')
+        second = self.events.handle('send_cell')
+
+        self.assertIs(first, second)
+        self.assertEqual(first.refs, 2)
+
+    def test_released_on_last_release(self):
+        """
+        A handle without callbacks is dropped once its last holder releases it.
+        """
+        handle = self.events.handle('send_cell')
+        self.events.handle('send_cell')
+
+        self.events.release(handle)
+        self.assertIn('send_cell', self.events.events)
+
+        self.events.release(handle)
+        self.assertNotIn('send_cell', self.events.events)
+
+    def test_kept_while_held_or_registered(self):
+        """
+        A handle stays while it has callbacks, even once released, and while it is
+        held, even once its callbacks are gone.
+        """
+        handle = self.events.handle('send_cell')
+        self.events.register('send_cell', self.callback)
+
+        self.events.release(handle)
+        self.assertIs(self.events.events['send_cell'], handle)
+
+        handle = self.events.handle('send_cell')
+        self.events.unregister('send_cell', self.callback)
+        self.assertIs(self.events.events['send_cell'], handle)
+
+        self.events.release(handle)
+        self.assertNotIn('send_cell', self.events.events)
+
+    def test_fire_once(self):
+        """
+        Callbacks registered once are dropped after the handle fires them.
+        """
+        handle = self.events.handle('connected')
+        self.events.register_once('connected', self.callback)
+
+        handle()
+        handle()
+
+        self.assertEqual(self.calls, [ () ])
+        self.assertFalse(self.events.registered('connected'))
+
+    def test_first_true_return_stops(self):
+        """
+        A callback returning a true value ends the event and its value is returned.
+        """
+        self.events.register('score', lambda: 0)
+        self.events.register('score', lambda: 5)
+        self.events.register('score', self.callback)
+
+        self.assertEqual(self.events.handle('score')(), 5)
+        self.assertEqual(self.calls, [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,231 @@
+"""
+Run from the repository root:
+
+    python -m unittest tests.test_flow_control
+"""
+import unittest
+
+from core.events import Events, events
+from core.LocalModule import LocalModule
+from modules.Tor.Circuit import Circuit
+from modules.Tor.TorStream import TorStream
+from modules.Tor.cell import cell
+
+class FakeCircuit(LocalModule):
+    """
+    Circuit stand in for streams, it counts the relay cells sent through it.
+    """
+    circuit_id = 7
+
+    def __init__(self):
+        super(FakeCircuit, self).__init__()
+
+        self.streams = {}
+        self.package_window = Circuit.window
+        self.sent = []
+
+        self.register_local('7_send_relay_cell', self.send_relay_cell)
+        self.register_local((7, 'send_relay_cells'), self.send_relay_cells)
+
+    def send_relay_cell(self, command, stream_id=None, data=None, last=None):
+        self.sent.append((command, stream_id))
+
+    def send_relay_cells(self, command, stream_id, payloads):
+        self.sent.extend([ (command, stream_id) ] * len(payloads))
+
+    def observe_rtt(self, rtt):
+        pass
+
+class Proxy(object):
+    """
+    Stands in for the connection a circuit shares its events with.
+    """
+    def __init__(self):
+        self._events = Events()
+
+def relay_data(payload=b'x'):
+    c = cell.Relay(7)
+    c.data = c.payload = payload
+    return c
+
+class StreamFlowControlTest(unittest.TestCase):
+    def setUp(self):
+        self.circuit = FakeCircuit()
+        self.stream = TorStream(self.circuit, 1234)
+
+    def data_sent(self):
+        return self.circuit.sent.count(('RELAY_DATA', 1234))
+
+    def test_deliver_window_sends_sendme(self):
+        """
+        A stream SENDME goes out for every window_increment RELAY_DATA cells received,
+        and opens the deliver window back up.
+        """
+        for _ in range(TorStream.window_increment - 1):
+            self.stream.got_relay_data(7, 1234, relay_data())
+
+        self.assertEqual(self.circuit.sent, [])
+        self.assertEqual(self.stream.deliver_window, 451)
+
+        self.stream.got_relay_data(7, 1234, relay_data())
+
+        self.assertEqual(self.circuit.sent, [ ('RELAY_SENDME', 1234) ])
+        self.assertEqual(self.stream.deliver_window, 500)
+
+    def test_package_window(self):
+        """
+        Data is only sent while the stream's package window is open, the rest waits for
+        a SENDME, which opens the window by window_increment cells.
+        """
+        self.stream.send(b'\x00' * (498 * 600))
+
+        self.assertEqual(self.data_sent(), 500)
+        self.assertEqual(self.stream.package_window, 0)
+
+        self.stream.got_sendme(7, 1234, None)
+
+        self.assertEqual(self.data_sent(), 550)
+        self.assertEqual(self.stream.package_window, 0)
+
+        self.stream.got_sendme(7, 1234, None)
+        self.stream.got_sendme(7, 1234, None)
+
+        self.assertEqual(self.data_sent(), 600)
+        self.assertEqual(self.stream.package_window, 50)
+
+    def test_circuit_package_window(self):
+        """
+        A closed circuit package window holds the stream's data back too, until the
+        circuit is unblocked.
+        """
+        self.circuit.package_window = 0
+        self.stream.send(b'\x00' * 498)
+        self.assertEqual(self.data_sent(), 0)
+
+        self.circuit.package_window = 100
+        self.circuit.trigger_local((7, 'unblocked'))
+        self.assertEqual(self.data_sent(), 1)
+
+    def test_watermarks(self):
+        """
+        The stream is blocked once more than high_water bytes are queued behind its
+        windows, and unblocked once they have gone down to low_water.
+        """
+        raised = []
+        def blocked():
+            raised.append('blocked')
+        def unblocked():
+            raised.append('unblocked')
+
+        events.register('tor_stream_1234_blocked', blocked)
+        events.register('tor_stream_1234_unblocked', unblocked)
+
+        try:
+            self.stream.package_window = 0
+            self.stream.send(b'\x00' * TorStream.high_water)
+            self.assertEqual(raised, [])
+
+            self.stream.send(b'\x00')
+            self.assertEqual(raised, [ 'blocked' ])
+
+            # Each SENDME lets 50 cells of 498 bytes go.
+            for _ in range(3):
+                self.stream.got_sendme(7, 1234, None)
+            self.assertEqual(raised, [ 'blocked' ])
+            self.assertGreater(self.stream.queued, TorStream.low_water)
+
+            self.stream.got_sendme(7, 1234, None)
+            self.assertEqual(raised, [ 'blocked', 'unblocked' ])
+            self.assertLessEqual(self.stream.queued, TorStream.low_water)
+        finally:
+            events.unregister('tor_stream_1234_blocked', blocked)
+            events.unregister('tor_stream_1234_unblocked', unblocked)
+
+class PayloadCircuit(FakeCircuit):
+    """
+    Keeps the payloads of the relay cells sent through it.
+    """
+    def send_relay_cells(self, command, stream_id, payloads):
+        self.sent.extend(payloads)
+
+class StreamChunkingTest(unittest.TestCase):
+    def setUp(self):
+        self.circuit = PayloadCircuit()
+        self.stream = TorStream(self.circuit, 1234)
+
+    def test_chunks(self):
+        """
+        Data is sent in full relay payloads, the last one holds what is left over.
+        """
+        data = bytes(bytearray(range(256))) * 5
+        self.stream.send(data)
+
+        self.assertEqual([ len(p) for p in self.circuit.sent ], [ 498, 498, 284 ])
+        self.assertEqual(b''.join(bytes(p) for p in self.circuit.sent), data)
+
+    def test_caller_reuses_buffer(self):
+        """
+        Data still queued is copied, a caller reusing its buffer doesn't change what
+        gets sent.
+        """
+        self.stream.package_window = 0
+
+        data = bytearray(b'x' * 1000)
+        self.stream.send(data)
+        view = memoryview(bytearray(b'y' * 600))
+        self.stream.send(view)
+
+        data[:] = b'z' * 1000
+        view[:] = b'z' * 600
+
+        self.stream.package_window = TorStream.window
+        self.stream.flush()
+
+        self.assertEqual(b''.join(bytes(p) for p in self.circuit.sent),
+            b'x' * 1000 + b'y' * 600)
+
+class CircuitFlowControlTest(unittest.TestCase):
+    def setUp(self):
+        self.circuit = Circuit(Proxy(), 7)
+        self.circuit.stop_timer()
+
+        self.sent = []
+        event = '7_send_relay_cell'
+        self.circuit.unregister_local(event, self.circuit.send_relay_cell)
+        self.circuit.register_local(event, lambda command, *args, **kwargs:
+            self.sent.append(command))
+
+    def test_deliver_window_sends_sendme(self):
+        """
+        A circuit SENDME goes out for every window_increment RELAY_DATA cells received
+        on the circuit, whichever streams they are for.
+        """
+        data = cell.relay_name_to_command('RELAY_DATA')
+
+        for i in range(Circuit.window_increment * 2 - 1):
+            c = relay_data()
+            c.command, c.stream_id = data, 1 + i % 3
+            self.circuit.recv_relay_cell(c)
+
+        self.assertEqual(self.sent, [ 'RELAY_SENDME' ])
+        self.assertEqual(self.circuit.deliver_window, 901)
+
+    def test_package_window(self):
+        """
+        Sending RELAY_DATA closes the circuit package window, a SENDME opens it by
+        window_increment cells and unblocks the streams.
+        """
+        unblocked = []
+        self.circuit.register_local((7, 'unblocked'), lambda: unblocked.append(True))
+
+        for _ in range(Circuit.window_increment):
+            self.circuit.send_relay_cell('RELAY_DATA', 1, data=b'x')
+        self.assertEqual(self.circuit.package_window, 900)
+
+        self.circuit.got_sendme(7, 0, None)
+
+        self.assertEqual(self.circuit.package_window, 1000)
+        self.assertEqual(unblocked, [ True ])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+"""
+Run from the repository root:
+
+    python -m unittest tests.test_httpclient
+"""
+import unittest
+
+import modules.HTTPClient
+from modules.HTTPClient import HTTPRequest
+
+class Request(HTTPRequest):
+    """
+    A request that never opens a stream.
+    """
+    def connect(self):
+        pass
+
+class HTTPRequestTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = 0.0
+        self.now = modules.HTTPClient.now
+        modules.HTTPClient.now = lambda: self.clock
+
+    def tearDown(self):
+        modules.HTTPClient.now = self.now
+
+    def test_timeout_is_put_off_by_received_data(self):
+        """
+        Data received puts the timeout off without a new timer for each read, the timer
+        is scheduled again for what's left when it runs out. The request is closed once
+        nothing has been received for the whole timeout.
+        """
+        request = Request('http://127.0.0.1/')
+
+        events = []
+        request.trigger = lambda event, *args: events.append((event,) + args[:1])
+        request.module_load()
+        self.assertEqual(events, [ ('call_later', 60) ])
+
+        for clock in [ 10.0, 20.0, 30.0 ]:
+            self.clock = clock
+            request.trigger_local('received', 'data')
+        self.assertEqual(len(events), 1)
+
+        self.clock = 60.0
+        request.timed_out()
+        self.assertEqual(events[-1], ('call_later', 30.0))
+        self.assertFalse(request.closed)
+
+        self.clock = 90.0
+        request.timed_out()
+        self.assertTrue(request.closed)
+        self.assertEqual(events[-1], ('tor_stream_%d_close' % request.stream_id,))
+
+if __name__ == '__main__':
+    unittest.main()
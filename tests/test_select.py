@@ -0,0 +1,332 @@
+"""
+Run from the repository root:
+
+    python -m unittest tests.test_select
+"""
+import select
+import socket
+import threading
+import unittest
+
+import modules.Select
+from modules.Select import Scheduler, Select
+from core.events import events
+from core.TCPClient import TCPClient
+
+class SelectTest(unittest.TestCase):
+    def loop(self, backend, writable):
+        """
+        Runs a Select loop on the given backend for a few iterations with one end of a
+        socket pair registered for writing.
+        """
+        modules.Select.backend = backend
+        self.select = Select()
+        self.select.module_load()
+
+        self.sock, other = socket.socketpair()
+        self.sock.setblocking(False)
+
+        iterations = [ 0 ]
+        def tick():
+            iterations[0] += 1
+            if iterations[0] < 5:
+                self.select.call_later(0.001, tick)
+            else:
+                self.select.quit()
+
+        self.select.fd_register(self.sock, None, writable, None)
+        self.select.fd_writable(self.sock)
+        self.select.call_later(0.001, tick)
+        self.select.booted()
+
+        self.select.fd_unregister(self.sock)
+        self.select.module_unload()
+        self.sock.close()
+        other.close()
+
+    @unittest.skipUnless(hasattr(select, 'epoll'), 'needs epoll')
+    def test_write_interest_dropped_and_wanted_again(self):
+        """
+        With an edge-triggered backend, write interest dropped and asked for again in
+        the same iteration must still get the fd reported writable again.
+        """
+        calls = []
+
+        def writable(fd):
+            calls.append(fd)
+            self.select.fd_unwritable(fd)
+
+            if len(calls) == 1:
+                self.select.fd_writable(fd)
+
+        self.loop('epoll_et', writable)
+        self.assertEqual(len(calls), 2)
+
+    @unittest.skipUnless(hasattr(select, 'epoll'), 'needs epoll')
+    def test_write_more_than_max_iov(self):
+        """
+        With an edge-triggered backend a send buffer that takes more than one write
+        must keep being written without the socket being reported writable again.
+        """
+        modules.Select.backend = 'epoll_et'
+        self.select = Select()
+        self.select.module_load()
+
+        sock, other = socket.socketpair()
+        sock.setblocking(False)
+
+        client = TCPClient('127.0.0.1', 1)
+        client.sock = sock
+        client.connecting = False
+        client.closed = False
+        client.trigger = lambda event, *args: getattr(self.select, event)(*args)
+
+        # Nothing is read until the loop is done, reading would free up space in the
+        # socket and get it reported writable again.
+        iterations = [ 0 ]
+        def tick():
+            iterations[0] += 1
+            if iterations[0] < 20:
+                self.select.call_later(0.001, tick)
+            else:
+                self.select.quit()
+
+        self.select.fd_register(sock, client.readable, client.writable, None)
+        for _ in range(client.max_iov + 344):
+            client.send(b'y' * 10)
+        self.select.call_later(0.001, tick)
+        self.select.booted()
+
+        self.assertEqual(len(client.write_buffer), 0)
+        self.assertEqual(len(other.recv(65536)), (client.max_iov + 344) * 10)
+
+        self.select.fd_unwritable(sock)
+        self.select.fd_unregister(sock)
+        self.select.module_unload()
+        sock.close()
+        other.close()
+
+class DispatchTest(unittest.TestCase):
+    def run_loop(self, backend, setup):
+        """
+        Runs a Select loop on the given backend for a few iterations with one end of a
+        socket pair that has data waiting, setup() registers it.
+        """
+        modules.Select.backend = backend
+        loop = Select()
+        loop.module_load()
+
+        sock, other = socket.socketpair()
+        sock.setblocking(False)
+        other.send(b'data')
+
+        setup(loop, sock)
+
+        iterations = [ 0 ]
+        def tick():
+            iterations[0] += 1
+            if iterations[0] < 5:
+                loop.call_later(0.001, tick)
+            else:
+                loop.quit()
+
+        loop.call_later(0.001, tick)
+        loop.booted()
+
+        loop.fd_unreadable(sock)
+        loop.fd_unregister(sock)
+        loop.module_unload()
+        sock.close()
+        other.close()
+
+    def backends(self):
+        return [ name for name, available, _ in modules.Select.backends if available() ]
+
+    def test_dispatch_to_callbacks(self):
+        """
+        An fd in the dispatch table has its callback called with the fd object, on every
+        backend.
+        """
+        for backend in self.backends():
+            calls = []
+            def readable(fd):
+                calls.append(fd)
+                fd.recv(4096)
+
+            def setup(loop, sock):
+                loop.fd_register(sock, readable, None, None)
+                loop.fd_readable(sock)
+                self.sock = sock
+
+            self.run_loop(backend, setup)
+            self.assertEqual(calls, [ self.sock ], backend)
+
+    def test_events_without_dispatch(self):
+        """
+        An fd that isn't in the dispatch table gets the fd_<object>_readable event
+        instead.
+        """
+        calls = []
+        def readable(fd):
+            calls.append(fd)
+            fd.recv(4096)
+
+        def setup(loop, sock):
+            self.event = 'fd_%s_readable' % sock
+            events.register(self.event, readable)
+            loop.fd_readable(sock)
+            self.sock = sock
+
+        try:
+            self.run_loop('auto', setup)
+        finally:
+            events.unregister(self.event, readable)
+
+        self.assertEqual(calls, [ self.sock ])
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = 100.0
+        self.now = modules.Select.now
+        modules.Select.now = lambda: self.clock
+
+        self.scheduler = Scheduler()
+        self.ran = []
+
+    def tearDown(self):
+        modules.Select.now = self.now
+
+    def call_later(self, delay, name):
+        return self.scheduler.call_later(delay, self.ran.append, name)
+
+    def test_order(self):
+        """
+        Timers run in the order they are due, timers due at the same time in the order
+        they were scheduled. Timers that aren't due yet wait.
+        """
+        self.call_later(3, 'c')
+        self.call_later(1, 'a')
+        self.call_later(2, 'b1')
+        self.call_later(2, 'b2')
+        self.call_later(10, 'later')
+
+        self.assertEqual(self.scheduler.timeout(), 1)
+
+        self.clock += 5
+        self.scheduler.run()
+
+        self.assertEqual(self.ran, [ 'a', 'b1', 'b2', 'c' ])
+        self.assertEqual(len(self.scheduler), 1)
+        self.assertEqual(self.scheduler.timeout(), 5)
+
+    def test_cancel(self):
+        """
+        Cancelled timers don't run and don't hold up the timeout.
+        """
+        first = self.call_later(1, 'first')
+        self.call_later(2, 'second')
+        first.cancel()
+        first.cancel()
+
+        self.assertEqual(len(self.scheduler), 1)
+        self.assertEqual(self.scheduler.timeout(), 2)
+
+        self.clock += 2
+        self.scheduler.run()
+
+        self.assertEqual(self.ran, [ 'second' ])
+        self.assertIsNone(self.scheduler.timeout())
+
+    def test_cancelled_timers_are_purged(self):
+        """
+        Once cancelled timers make up more than half of the heap they are dropped from
+        it.
+        """
+        timers = [ self.call_later(i, i) for i in range(200) ]
+        for timer in timers[:150]:
+            timer.cancel()
+
+        self.assertEqual(len(self.scheduler), 50)
+        self.assertLess(len(self.scheduler.timers), 200)
+
+        self.clock += 200
+        self.scheduler.run()
+        self.assertEqual(self.ran, list(range(150, 200)))
+
+    def test_cancel_from_callback(self):
+        """
+        A callback can cancel another timer that is due in the same pass.
+        """
+        second = []
+        self.scheduler.call_later(1, lambda: second[0].cancel())
+        second.append(self.call_later(1, 'second'))
+
+        self.clock += 1
+        self.scheduler.run()
+        self.assertEqual(self.ran, [])
+
+    def test_scheduled_from_callback(self):
+        """
+        Timers scheduled by a callback run on the next pass, even if they are due.
+        """
+        self.scheduler.call_later(1, lambda: self.call_later(0, 'next'))
+
+        self.clock += 1
+        self.scheduler.run()
+        self.assertEqual(self.ran, [])
+
+        self.scheduler.run()
+        self.assertEqual(self.ran, [ 'next' ])
+
+class WakerTest(unittest.TestCase):
+    def test_call_soon_threadsafe(self):
+        """
+        A callback posted from another thread wakes the loop up and runs in the loop's
+        thread.
+        """
+        modules.Select.backend = 'auto'
+        loop = Select()
+        loop.module_load()
+
+        ran = []
+        def posted(value):
+            ran.append((value, threading.current_thread()))
+            loop.quit()
+
+        # Only there to end the loop if the wakeup never comes.
+        timer = loop.call_later(5, loop.quit)
+
+        thread = threading.Thread(target=loop.call_soon_threadsafe, args=(posted, 1))
+        thread.start()
+        loop.booted()
+        thread.join()
+
+        timer.cancel()
+        loop.module_unload()
+
+        self.assertEqual(ran, [ (1, threading.current_thread()) ])
+
+    def test_posted_callbacks_run_in_order(self):
+        """
+        Callbacks posted before the loop gets to them all run, in order, off one
+        wakeup.
+        """
+        modules.Select.backend = 'auto'
+        loop = Select()
+        loop.module_load()
+
+        ran = []
+        for i in range(5):
+            loop.call_soon_threadsafe(ran.append, i)
+        loop.call_soon_threadsafe(loop.quit)
+
+        timer = loop.call_later(5, loop.quit)
+        loop.booted()
+
+        timer.cancel()
+        loop.module_unload()
+
+        self.assertEqual(ran, list(range(5)))
+
+if __name__ == '__main__':
+    unittest.main()
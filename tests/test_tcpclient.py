@@ -0,0 +1,192 @@
+"""
+Run from the repository root:
+
+    python -m unittest tests.test_tcpclient
+"""
+import errno
+import socket
+import unittest
+
+from core.TCPClient import TCPClient
+from core.TLSClient import TLSClient
+
+class Sock(object):
+    """
+    Socket that takes up to limit bytes a call, keeps what was written and counts the
+    calls that write to it.
+    """
+    def __init__(self, limit=None):
+        self.calls = []
+        self.data = b''
+        self.limit = limit
+
+    def send(self, data):
+        return self.write(bytes(data))
+
+    def sendmsg(self, buffers):
+        return self.write(b''.join(bytes(b) for b in buffers))
+
+    def write(self, data):
+        data = data[:self.limit]
+        self.calls.append(len(data))
+        self.data += data
+        return len(data)
+
+class ReadSock(object):
+    """
+    Socket that hands out the given reads, one per recv_into(), and then would block.
+    pending is what a TLS socket would still hold after each read.
+    """
+    def __init__(self, reads, pending=None):
+        self.reads = list(reads)
+        self.pending_after = list(pending or [])
+        self.held = 0
+
+    def recv_into(self, buf):
+        if not self.reads:
+            raise socket.error(errno.EAGAIN, 'would block')
+
+        data = self.reads.pop(0)
+        buf[:len(data)] = data
+        self.held = self.pending_after.pop(0) if self.pending_after else 0
+        return len(data)
+
+    def pending(self):
+        return self.held
+
+class TCPClientTest(unittest.TestCase):
+    def client(self, scatter_gather):
+        client = TCPClient('127.0.0.1', 1)
+        client.sock = Sock()
+        client.connecting = False
+        client.closed = False
+        client.scatter_gather = scatter_gather
+
+        self.events = []
+        client.trigger = lambda event, *args: self.events.append(event)
+        return client
+
+    def test_partial_writes(self):
+        """
+        Queued buffers go out in order across partial writes, whether they are written
+        scatter-gather or joined up first.
+        """
+        for scatter_gather in (True, False):
+            client = self.client(scatter_gather)
+            client.sock.limit = 3
+
+            client.send(b'abcd')
+            client.send(bytearray(b'efg'))
+            client.send(memoryview(b'hijkl'))
+
+            while client.writable(None):
+                pass
+
+            self.assertEqual(client.sock.data, b'abcdefghijkl')
+            self.assertEqual(client.write_size, 0)
+            self.assertEqual(self.events[-1], 'fd_unwritable')
+
+    def test_nothing_queued(self):
+        """
+        A send without data still asks for write interest, writing then finds nothing
+        queued and drops it again.
+        """
+        client = self.client(True)
+        client.send(None)
+
+        self.assertFalse(client.writable(None))
+        self.assertEqual(client.sock.calls, [])
+        self.assertEqual(self.events, [ 'fd_writable', 'fd_unwritable' ])
+
+    def burst(self, scatter_gather):
+        client = self.client(scatter_gather)
+
+        for _ in range(100):
+            client.send(b'\x00' * 514)
+        client.writable(None)
+
+        self.assertEqual(client.sock.calls, [ 100 * 514 ])
+        self.assertEqual(self.events, [ 'fd_writable', 'fd_unwritable' ])
+
+    @unittest.skipUnless(hasattr(socket.socket, 'sendmsg'), 'needs sendmsg')
+    def test_burst_is_one_sendmsg(self):
+        """
+        Everything sent before the socket is writable goes out in one sendmsg() call,
+        with write interest asked for once.
+        """
+        self.burst(True)
+
+    def test_burst_is_one_send(self):
+        self.burst(False)
+
+    def test_watermarks(self):
+        """
+        Senders are paused once more than high_water bytes are queued, and resumed once
+        the queue has been written down to low_water.
+        """
+        client = self.client(True)
+        client.sock.sendmsg = lambda buffers: 64 * 1024
+
+        raised = []
+        client.register_local('pause_writing', lambda: raised.append('pause'))
+        client.register_local('resume_writing', lambda: raised.append('resume'))
+
+        for _ in range(4):
+            client.send(b'\x00' * (64 * 1024))
+        self.assertEqual(raised, [])
+
+        client.send(b'\x00')
+        self.assertEqual(raised, [ 'pause' ])
+
+        for _ in range(3):
+            client.writable(None)
+        self.assertEqual(raised, [ 'pause' ])
+
+        client.writable(None)
+        self.assertEqual(raised, [ 'pause', 'resume' ])
+
+    def reader(self, client, reads, pending=None):
+        client.sock = ReadSock(reads, pending)
+        client.connecting = False
+        client.closed = False
+
+        self.received = []
+        client.register_local('received', lambda data: self.received.append(
+            data.tobytes()))
+        return client
+
+    def test_short_reads_carry_on_until_would_block(self):
+        """
+        A short read doesn't end the readable callback, the socket is read until it
+        would block and there is nothing more to read.
+        """
+        client = self.reader(TCPClient('127.0.0.1', 1), [ b'a' * 10, b'b' * 20 ])
+
+        self.assertFalse(client.readable(None))
+        self.assertEqual(self.received, [ b'a' * 10, b'b' * 20 ])
+
+    def test_max_reads(self):
+        """
+        Reading stops after max_reads, and says there may be more.
+        """
+        client = self.reader(TCPClient('127.0.0.1', 1), [ b'x' ] * 10)
+
+        self.assertTrue(client.readable(None))
+        self.assertEqual(len(self.received), client.max_reads)
+
+    def test_tls_pending_is_drained(self):
+        """
+        Data a TLS socket has already decrypted is read even once max_reads has run
+        out, the select loop would never report it.
+        """
+        client = TLSClient('127.0.0.1', 1)
+        client.handshook = True
+
+        reads = [ b'x' ] * 6
+        self.reader(client, reads, [ 0, 0, 0, 1, 0, 0 ])
+
+        self.assertTrue(client.readable(None))
+        self.assertEqual(len(self.received), client.max_reads + 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,211 @@
+"""
+Run from the repository root:
+
+    python -m unittest tests.test_torconnection
+"""
+import unittest
+
+from core.events import events
+from modules.Tor.TorConnection import TorConnection
+from modules.Tor.build_times import circuit_build_times
+
+class Sock(object):
+    """
+    TLS socket stand in that takes everything and counts the sends.
+    """
+    def __init__(self):
+        self.calls = []
+
+    def send(self, data):
+        self.calls.append(len(data))
+        return len(data)
+
+class Connection(TorConnection):
+    """
+    A connection that never connects.
+    """
+    def init(self):
+        pass
+
+class Timer(object):
+    def cancel(self):
+        pass
+
+def connection():
+    """
+    Returns a connection that is up, with the timers it starts never going off.
+    """
+    connection = Connection({ 'name': 'guard', 'ip': '127.0.0.1', 'or_port': 9001 })
+    connection.sock = Sock()
+    connection.connecting = False
+    connection.closed = False
+    connection.trigger = lambda event, *args: Timer()
+    connection.codec.set_version(4)
+    return connection
+
+class TorConnectionTest(unittest.TestCase):
+    def test_relay_cell_burst_is_one_send(self):
+        """
+        A burst of relay cells on several circuits is taken off the circuit mux and
+        written in a single send once the socket is writable.
+        """
+        connection = Connection({ 'name': 'guard', 'ip': '127.0.0.1', 'or_port': 9001 })
+        connection.sock = Sock()
+        connection.connecting = False
+        connection.closed = False
+
+        events = []
+        connection.trigger = lambda event, *args: events.append(event)
+
+        for i in range(100):
+            connection.trigger_local('send_cells', 1 + i % 3, b'\x00' * 509, 1)
+
+        connection.writable(None)
+
+        size = connection.codec.header.size + 509
+        self.assertEqual(connection.sock.calls, [ 100 * size ])
+        self.assertEqual(events, [ 'fd_writable', 'fd_unwritable' ])
+        self.assertEqual(len(connection.mux), 0)
+
+    def test_dropped_circuits_stop_listening(self):
+        """
+        Circuits dropped with the connection give up their handshakes and stop listening
+        on the connection's events, so nothing can carry on building them.
+        """
+        connection = Connection({ 'name': 'guard', 'ip': '127.0.0.1', 'or_port': 9001 })
+        connection.sock = Sock()
+        connection.connecting = False
+        connection.closed = False
+        connection.trigger = lambda event, *args: None
+        connection.codec.set_version(4)
+
+        circuit = connection.circuit_map[connection.init_circuit()]
+        handlers = list(circuit.handlers)
+        self.assertTrue(circuit.pending_ntor)
+
+        connection.drop_circuits()
+
+        self.assertIsNone(circuit.pending_ntor)
+        self.assertEqual(circuit.pending_ntors, [])
+        self.assertEqual(circuit.send_cell_event.refs, 0)
+        self.assertEqual(circuit.send_cells_event.refs, 0)
+        for event, function in handlers:
+            handle = connection._events.events.get(event)
+            self.assertTrue(handle is None or function not in handle.functions)
+
+    def test_dropped_circuits_close_their_streams(self):
+        """
+        Streams attached to a circuit are closed when the connection goes, not left to
+        time out.
+        """
+        connection = Connection({ 'name': 'guard', 'ip': '127.0.0.1', 'or_port': 9001 })
+        connection.sock = Sock()
+        connection.connecting = False
+        connection.closed = False
+        connection.trigger = lambda event, *args: None
+        connection.codec.set_version(4)
+
+        circuit = connection.circuit_map[connection.init_circuit()]
+        circuit.init_stream(4242)
+        stream = circuit.streams[4242]
+
+        closed = []
+        def stream_closed():
+            closed.append(4242)
+
+        events.register('tor_stream_4242_closed', stream_closed)
+        try:
+            connection.drop_circuits()
+        finally:
+            events.unregister('tor_stream_4242_closed', stream_closed)
+
+        self.assertEqual(closed, [ 4242 ])
+        self.assertTrue(stream.closed)
+        self.assertEqual(circuit.streams, {})
+        self.assertFalse(connection._events.registered((circuit.circuit_id, 4242,
+            'RELAY_DATA')))
+
+class CircuitBuildTest(unittest.TestCase):
+    def setUp(self):
+        circuit_build_times.save = lambda: None
+        self.connection = connection()
+
+    def tearDown(self):
+        self.connection.drop_circuits()
+        del circuit_build_times.save
+
+    def test_streams_share_one_build(self):
+        """
+        Streams that arrive while there is no circuit all wait on the same build, and
+        are attached to it once it is built.
+        """
+        for stream_id in (1, 2, 3):
+            self.connection.init_stream(stream_id)
+
+        self.assertEqual(len(self.connection.building), 1)
+        circuit_id, = self.connection.building
+        self.assertEqual(self.connection.waiting, { circuit_id: [ 1, 2, 3 ] })
+
+        circuit = self.connection.circuit_map[circuit_id]
+        circuit.circuit_initialized()
+
+        self.assertEqual(sorted(circuit.streams), [ 1, 2, 3 ])
+        self.assertEqual(self.connection.waiting, {})
+        self.assertEqual(self.connection.circuits, [ circuit_id ])
+
+    def test_failed_build_is_retried(self):
+        """
+        Streams waiting on a build that fails move to a single new build.
+        """
+        self.connection.init_stream(1)
+        self.connection.init_stream(2)
+        circuit_id, = self.connection.building
+
+        self.connection.circuit_map[circuit_id].build_failed()
+
+        self.assertNotIn(circuit_id, self.connection.circuit_map)
+        self.assertEqual(len(self.connection.building), 1)
+        retry, = self.connection.building
+        self.assertEqual(self.connection.waiting, { retry: [ 1, 2 ] })
+
+class StreamPolicyTest(unittest.TestCase):
+    def setUp(self):
+        self.connection = connection()
+
+        self.busy, self.quiet, self.unmeasured = [
+            self.connection.circuit_map[self.connection.init_circuit()]
+            for _ in range(3) ]
+        self.connection.circuits = [ c.circuit_id for c in
+            (self.busy, self.quiet, self.unmeasured) ]
+
+        self.busy.streams = { 1: None, 2: None }
+        self.busy.rtt = 0.1
+        self.quiet.streams = { 3: None }
+        self.quiet.rtt = 0.5
+        self.unmeasured.streams = { 4: None, 5: None, 6: None }
+
+    def tearDown(self):
+        for circuit in (self.busy, self.quiet, self.unmeasured):
+            circuit.streams = {}
+        self.connection.drop_circuits()
+
+    def test_least_loaded(self):
+        """
+        least_loaded picks the circuit with the fewest streams.
+        """
+        self.connection.stream_policy = 'least_loaded'
+        self.assertEqual(self.connection.best_circuit(), self.quiet.circuit_id)
+
+    def test_lowest_rtt(self):
+        """
+        lowest_rtt picks a circuit that hasn't been measured yet, then the one with the
+        lowest round trip time.
+        """
+        self.connection.stream_policy = 'lowest_rtt'
+        self.assertEqual(self.connection.best_circuit(), self.unmeasured.circuit_id)
+
+        self.unmeasured.rtt = 1.0
+        self.assertEqual(self.connection.best_circuit(), self.busy.circuit_id)
+
+if __name__ == '__main__':
+    unittest.main()